@@ -7,20 +7,52 @@ from flask_login import LoginManager, login_required
 from datetime import datetime
 import os
 import json
+import fcntl
+import math
+import queue
+import threading
+import time
+import paho.mqtt.client as mqtt
+from backend.services.stream_analytics import StreamAnalytics
+from backend.services.reports import RollupStore, ReportGenerator, FileSender, SendGridSender
+from backend.services.metrics import init_metrics
+from backend.services.profiling import init_profiling
+from backend.services.presence import PresenceTracker
+from backend.services.database import database_config, init_database, routing_session_class
+from backend.services.native_api import (NativeAPIPool, NativeAPIError, CommandError, PoolExhausted,
+                                         parse_switch_state)
+from backend.services.commands import (CommandDispatcher, DispatchError, GroupIndex, bump_group_version,
+                                       group_version, parse_tags, track_groups)
+from backend.services.esphome import (COMPILE_DURATION, COMPILE_QUEUE_DEPTH, COMPILES, UPLOAD_DURATION, UPLOADS,
+                                      ESPHomeManager, fleet_api_key, node_name)
+from backend.services.config_sync import ConfigSync
+from backend.services.metrics import BACKGROUND_THREADS
+from backend.services.queries import (QueryError, apply_filters, keyset_paginate,
+                                      track_child_count, refresh_child_counts)
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import joinedload
 
 # Initialize Flask app
 app = Flask(__name__, static_folder='frontend', template_folder='frontend')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'smart-sites-dev-key-change-in-production')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:////opt/smart-sites/data/smart_sites.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config.update(database_config(app.config['SQLALCHEMY_DATABASE_URI']))
 
 # Initialize extensions
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': routing_session_class()})
+write_queue = init_database(app, db)
 migrate = Migrate(app, db)
 cors = CORS(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+init_metrics(app, db)
+request_profiler = init_profiling(app, db)
+stream_analytics = StreamAnalytics()
+rollup_store = RollupStore(os.environ.get('ROLLUP_FILE', os.path.join(os.environ.get('REPORT_DIR', 'data/reports'),
+                                                                        'rollups.json')))
+stream_analytics.add_listener(rollup_store.record_alert)
 
 # Basic Models
 class User(db.Model):
@@ -32,15 +64,102 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
 
+class SiteLocation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    description = db.Column(db.Text)
+    device_count = db.Column(db.Integer, default=0, nullable=False)  # maintained by track_child_count
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
     device_type = db.Column(db.String(50), nullable=False)
     mac_address = db.Column(db.String(17), unique=True)
     ip_address = db.Column(db.String(15))
+    site_location_id = db.Column(db.Integer, db.ForeignKey('site_location.id'))
     status = db.Column(db.String(20), default='offline')
+    tags = db.Column(db.String(255))  # comma-separated command groups, e.g. "lights,signage"
     last_seen = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    site_location = db.relationship('SiteLocation', backref=db.backref('devices', lazy=True))
+
+    # Filter columns lead, the default sort (name, id) follows so filtered pages need no sort step
+    __table_args__ = (
+        db.Index('ix_device_status_name', 'status', 'name', 'id'),
+        db.Index('ix_device_type_name', 'device_type', 'name', 'id'),
+        db.Index('ix_device_location_name', 'site_location_id', 'name', 'id'),
+    )
+
+class ESPHomeDevice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    device_type = db.Column(db.String(50), nullable=False)
+    mac_address = db.Column(db.String(17), unique=True)
+    ip_address = db.Column(db.String(15))
+    esphome_config = db.Column(db.Text)  # YAML configuration
+    config_params = db.Column(db.Text)  # JSON render inputs: name, type, pins
+    config_fragments = db.Column(db.Text)  # JSON fragment key -> hash the stored config was rendered from
+    firmware_version = db.Column(db.String(20))
+    compilation_status = db.Column(db.String(20), default='pending')  # pending, compiling, success, error
+    last_seen = db.Column(db.DateTime)
+    site_location_id = db.Column(db.Integer, db.ForeignKey('site_location.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    site_location = db.relationship('SiteLocation', backref=db.backref('esphome_devices', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_esphome_device_status_name', 'compilation_status', 'name', 'id'),
+        db.Index('ix_esphome_device_type_name', 'device_type', 'name', 'id'),
+        db.Index('ix_esphome_device_location_name', 'site_location_id', 'name', 'id'),
+    )
+
+class CommandGroupVersion(db.Model):
+    """Single row bumped whenever a device's command groups change"""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+track_child_count(Device, 'site_location_id', SiteLocation, 'device_count')
+
+# Location/type/tag -> device names for group commands, rebuilt per worker when the version moves
+command_groups = GroupIndex()
+track_groups(Device, ('name', 'site_location_id', 'device_type', 'tags'), CommandGroupVersion.__table__)
+
+DEVICE_FILTERS = {
+    'status': Device.status,
+    'type': Device.device_type,
+    'location': (Device.site_location_id, int)
+}
+DEVICE_SORTS = {
+    'id': Device.id,
+    'name': Device.name,
+    'type': Device.device_type,
+    'status': Device.status,
+    'created_at': Device.created_at
+}
+ESPHOME_DEVICE_FILTERS = {
+    'status': ESPHomeDevice.compilation_status,
+    'type': ESPHomeDevice.device_type,
+    'location': (ESPHomeDevice.site_location_id, int)
+}
+ESPHOME_DEVICE_SORTS = {
+    'id': ESPHomeDevice.id,
+    'name': ESPHomeDevice.name,
+    'type': ESPHomeDevice.device_type,
+    'status': ESPHomeDevice.compilation_status,
+    'created_at': ESPHomeDevice.created_at
+}
+
+@app.errorhandler(QueryError)
+def handle_query_error(error):
+    return jsonify({'error': str(error)}), 400
+
+@app.errorhandler(NativeAPIError)
+def handle_native_api_error(error):
+    if isinstance(error, CommandError):
+        return jsonify({'error': str(error)}), 400
+    return jsonify({'error': str(error)}), 503 if isinstance(error, PoolExhausted) else 502
 
 # Routes
 @app.route('/')
@@ -49,13 +168,24 @@ def index():
 
 @app.route('/api/devices')
 def get_devices():
-    devices = Device.query.all()
-    return jsonify([{
-        'id': device.id,
-        'name': device.name,
-        'type': device.device_type,
-        'status': device.status
-    } for device in devices])
+    """Get devices, filtered by status/type/location and paginated by cursor"""
+    query = apply_filters(Device.query.options(joinedload(Device.site_location)), request.args, DEVICE_FILTERS)
+    if request.args.get('q'):
+        query = query.filter(Device.name.startswith(request.args['q'], autoescape=True))
+    devices, pagination = keyset_paginate(query, request.args, DEVICE_SORTS, Device.id, 'name')
+    return jsonify({
+        'devices': [{
+            'id': device.id,
+            'name': device.name,
+            'type': device.device_type,
+            'status': device.status,
+            'tags': parse_tags(device.tags),
+            'location_id': device.site_location_id,
+            'location': device.site_location.name if device.site_location else None,
+            'last_seen': device.last_seen.isoformat() if device.last_seen else None
+        } for device in devices],
+        'pagination': pagination
+    })
 
 @app.route('/api/dashboard-stats')
 def get_dashboard_stats():
@@ -66,17 +196,24 @@ def get_dashboard_stats():
         'total_devices': total_devices,
         'online_devices': online_devices,
         'total_power': 0,
-        'recent_alerts': 0
+        'recent_alerts': len(stream_analytics.recent_alerts())
     })
 
 # Initialize database
 def create_tables():
     db.create_all()
 
-if __name__ == '__main__':
-    with app.app_context():
-        create_tables()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Create default site locations on first run
+    if not SiteLocation.query.first():
+        for name, description in [('Main Office', 'Main office building'),
+                                  ('Workshop', 'Main workshop area'),
+                                  ('Storage', 'Equipment storage area')]:
+            db.session.add(SiteLocation(name=name, description=description))
+
+    # Device counts are maintained incrementally; resync after bulk loads
+    refresh_child_counts(db.session, Device, 'site_location_id', SiteLocation, 'device_count')
+    bump_group_version(db.session, CommandGroupVersion.__table__)
+    db.session.commit()
 
 # Static file routes for modular frontend
 @app.route('/components/<path:filename>')
@@ -130,19 +267,55 @@ def get_esphome_templates():
 
 @app.route('/api/esphome/devices')
 def get_esphome_devices():
-    """Get ESPHome devices"""
-    # Return empty list for now
-    return jsonify([])
+    """Get ESPHome devices, filtered by status/type/location and paginated by cursor"""
+    query = apply_filters(ESPHomeDevice.query.options(joinedload(ESPHomeDevice.site_location)),
+                          request.args, ESPHOME_DEVICE_FILTERS)
+    if request.args.get('q'):
+        query = query.filter(ESPHomeDevice.name.startswith(request.args['q'], autoescape=True))
+    devices, pagination = keyset_paginate(query, request.args, ESPHOME_DEVICE_SORTS, ESPHomeDevice.id, 'name')
+    return jsonify({
+        'devices': [{
+            'id': device.id,
+            'name': device.name,
+            'type': device.device_type,
+            'mac_address': device.mac_address,
+            'ip_address': device.ip_address,
+            'compilation_status': device.compilation_status,
+            'last_seen': device.last_seen.isoformat() if device.last_seen else None,
+            'location': device.site_location.name if device.site_location else None,
+            'firmware_version': device.firmware_version,
+            'created_at': device.created_at.isoformat()
+        } for device in devices],
+        'pagination': pagination
+    })
 
 @app.route('/api/locations')
 def get_locations():
-    """Get site locations"""
-    locations = [
-        {'id': 1, 'name': 'Main Office', 'description': 'Main office building', 'device_count': 0},
-        {'id': 2, 'name': 'Workshop', 'description': 'Main workshop area', 'device_count': 0}, 
-        {'id': 3, 'name': 'Storage', 'description': 'Equipment storage area', 'device_count': 0}
-    ]
-    return jsonify(locations)
+    """Get site locations with their materialized device counts"""
+    locations = SiteLocation.query.order_by(SiteLocation.name).all()
+    return jsonify([{
+        'id': location.id,
+        'name': location.name,
+        'description': location.description,
+        'device_count': location.device_count
+    } for location in locations])
+
+@app.route('/api/locations', methods=['POST'])
+def add_location():
+    """Add a new site location"""
+    data = request.get_json()
+    if not data or not data.get('name'):
+        return jsonify({'error': 'Name is required'}), 400
+
+    location = SiteLocation(
+        name=data['name'],
+        description=data.get('description', '')
+    )
+
+    db.session.add(location)
+    db.session.commit()
+
+    return jsonify({'id': location.id, 'message': 'Location added successfully'})
 
 @app.route('/api/history')
 def get_history():
@@ -153,3 +326,629 @@ def get_history():
 def get_automations():
     """Get automations"""
     return jsonify([])
+
+@app.route('/api/alerts')
+def get_alerts():
+    """Get recent compliance alerts and rules currently in alert"""
+    return jsonify({
+        'recent': stream_analytics.recent_alerts(),
+        'active': stream_analytics.active_alerts()
+    })
+
+@app.route('/api/analytics/<device_name>/<sensor_name>')
+def get_sensor_analytics(device_name, sensor_name):
+    """Get sliding-window statistics for a device sensor"""
+    stats = stream_analytics.get_stats(device_name, sensor_name)
+    if stats is None:
+        return jsonify({'error': 'No readings for this sensor'}), 404
+    return jsonify(stats)
+
+# MQTT client for real-time sensor readings
+mqtt_client = None
+
+def init_mqtt():
+    global mqtt_client
+    mqtt_client = mqtt.Client()
+    mqtt_client.on_connect = on_mqtt_connect
+    mqtt_client.on_message = on_mqtt_message
+    command_dispatcher.attach(mqtt_client)
+
+    try:
+        mqtt_client.connect(os.environ.get('MQTT_BROKER', 'localhost'), int(os.environ.get('MQTT_PORT', 1883)), 60)
+        mqtt_client.loop_start()
+        print("MQTT client connected successfully")
+    except Exception as e:
+        print(f"MQTT connection failed: {e}")
+
+def on_mqtt_connect(client, userdata, flags, rc):
+    print(f"Connected to MQTT with result code {rc}")
+    # ESPHome publishes state as smartsites/<device>/<component>/<sensor>/state
+    client.subscribe("smartsites/#")
+
+def on_mqtt_message(client, userdata, msg):
+    try:
+        topic_parts = msg.topic.split('/')
+        if len(topic_parts) < 3:
+            return
+
+        # Commands (including our own) are not device activity
+        if topic_parts[-1] == 'command':
+            return
+
+        # Every message is a heartbeat; <prefix>/status carries birth/will messages
+        if len(topic_parts) == 3 and topic_parts[2] == 'status':
+            presence_tracker.availability(topic_parts[1], msg.payload.decode())
+            return
+        presence_tracker.heartbeat(topic_parts[1])
+
+        if topic_parts[-1] == 'state':
+            command_dispatcher.handle_state(msg.topic, msg.payload)
+
+        if len(topic_parts) == 5 and topic_parts[4] == 'state' and topic_parts[2] == 'sensor':
+            device_name = topic_parts[1]
+            sensor_name = topic_parts[3]
+            try:
+                value = float(msg.payload.decode())
+            except ValueError:
+                return
+            record_reading(device_name, sensor_name, value)
+
+    except Exception as e:
+        print(f"Error processing MQTT message: {e}")
+
+def record_reading(device_name, sensor_name, value):
+    """Feed one sensor reading (from MQTT or the native API) to analytics and rollups"""
+    # Unavailable sensors report nan: the device is alive but there is no reading
+    if not math.isfinite(value):
+        return
+    if sensor_name == 'power_consumption':
+        rollup_store.record_power(device_name, value)
+    stream_analytics.ingest(device_name, sensor_name, value)
+
+# Group commands over MQTT
+command_dispatcher = CommandDispatcher(timeout=float(os.environ.get('COMMAND_TIMEOUT', 5)))
+
+def current_command_groups():
+    """The group index, rebuilt first if any worker has changed a group since it was built"""
+    version = group_version(db.session, CommandGroupVersion.__table__)
+    if version is None or version != command_groups.version:
+        rows = db.session.query(Device.id, Device.name, Device.site_location_id, Device.device_type, Device.tags).all()
+        command_groups.rebuild(rows, version)
+    return command_groups
+
+@app.route('/api/commands', methods=['POST'])
+def send_group_command():
+    """Send a command to every device in a location, type and/or tag group.
+
+    Body: {"location": 3, "type": "...", "tag": "...", "component": "switch",
+    "object_id": "relay", "payload": "ON"}. Each group may be a list; a device
+    must match every group given. Waits for the devices to echo the new state
+    and returns per-device and aggregate latency.
+    """
+    data = request.get_json(silent=True) or {}
+    selectors = {kind: data.get(kind) for kind in ('location', 'type', 'tag') if data.get(kind) is not None}
+    if not selectors:
+        return jsonify({'error': 'A location, type or tag is required'}), 400
+    if not data.get('component') or not data.get('object_id') or data.get('payload') is None:
+        return jsonify({'error': 'Component, object_id and payload are required'}), 400
+    try:
+        timeout = min(float(data['timeout']), 30.0) if data.get('timeout') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid timeout'}), 400
+
+    devices = current_command_groups().resolve(**selectors)
+    if not devices:
+        return jsonify({'error': 'No devices match this group'}), 404
+    try:
+        batch = command_dispatcher.send(devices, data['component'], data['object_id'], data['payload'],
+                                        expect=data.get('expect'), timeout=timeout)
+    except DispatchError as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify(batch.summary())
+
+# Native API sessions to ESPHome devices (states and commands without polling)
+native_api = NativeAPIPool(
+    encryption_key=fleet_api_key(),  # the key in secrets.yaml that firmware is compiled with
+    max_connections=int(os.environ.get('NATIVE_API_MAX_CONNECTIONS', 64))
+)
+
+def on_native_state(device_name, entity, state):
+    presence_tracker.heartbeat(device_name)
+    if entity['type'] == 'sensor':
+        record_reading(device_name, entity['object_id'], state)
+
+native_api.add_listener(on_native_state)
+
+def init_native_api():
+    """Keep a subscribed session open to ESPHome devices with a known address, up to the pool size"""
+    with app.app_context():
+        devices = db.session.query(ESPHomeDevice.name, ESPHomeDevice.ip_address) \
+            .filter(ESPHomeDevice.ip_address.isnot(None)).all()
+    subscribed = 0
+    for name, ip_address in devices:
+        try:
+            native_api.subscribe(node_name(name), ip_address)
+            subscribed += 1
+        except PoolExhausted:
+            print(f"Native API pool is full: {len(devices) - subscribed} devices not subscribed "
+                  f"(raise NATIVE_API_MAX_CONNECTIONS)")
+            break
+        except NativeAPIError as e:
+            print(f"Native API subscribe to {name} failed: {e}")
+
+def run_native_api_subscriber(lock_path):
+    """Subscribe from the one worker holding `lock_path`; the others wait and take over if it exits.
+
+    Devices accept a handful of API connections, so every gunicorn worker
+    subscribing would exhaust them. States and commands from the other
+    workers use short-lived on-demand sessions.
+    """
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    # Held (never closed) for the life of the process; the OS releases it on exit
+    lock_file = open(lock_path, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    init_native_api()
+
+def start_native_api_subscriber(lock_path):
+    threading.Thread(target=run_native_api_subscriber, args=(lock_path,), name='native-api-subscriber',
+                     daemon=True).start()
+
+def get_api_device(device_id):
+    device = ESPHomeDevice.query.get_or_404(device_id)
+    if not device.ip_address:
+        return device, (jsonify({'error': 'Device has no known IP address'}), 409)
+    return device, None
+
+@app.route('/api/esphome/devices/<int:device_id>/states')
+def get_esphome_device_states(device_id):
+    """Live entity states from the device's native API session"""
+    device, error = get_api_device(device_id)
+    if error:
+        return error
+    return jsonify({
+        'device': device.name,
+        'states': native_api.get_states(node_name(device.name), device.ip_address)
+    })
+
+@app.route('/api/esphome/devices/<int:device_id>/commands', methods=['POST'])
+def send_esphome_device_command(device_id):
+    """Switch an entity on/off or press a button over the native API"""
+    device, error = get_api_device(device_id)
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    if not data.get('entity'):
+        return jsonify({'error': 'Entity is required'}), 400
+    # Validate before connecting; a bad state is a 400 (CommandError), never a silent bool()
+    requested = parse_switch_state(data['state']) if data.get('state') is not None else None
+    state = native_api.command(node_name(device.name), device.ip_address, data['entity'], requested)
+    return jsonify({'device': device.name, 'entity': data['entity'], 'state': state})
+
+@app.route('/api/esphome/connections')
+def get_esphome_connections():
+    """Native API session pool status"""
+    return jsonify(native_api.status())
+
+# ESPHome configs and firmware (the logs and config routes are still in backend/app.py)
+esphome_manager = None
+config_sync = None
+
+# Compiles run on a small worker pool; ESPHome builds are CPU and memory heavy
+COMPILE_WORKERS = int(os.environ.get('ESPHOME_COMPILE_WORKERS', 2))
+
+compile_queue = queue.Queue()
+queued_compiles = set()
+compile_workers = []
+compile_lock = threading.Lock()
+
+def start_compile(device_id, device_name):
+    """Queue a background compile for a device; returns False if it is already queued"""
+    with compile_lock:
+        if device_id in queued_compiles:
+            return False
+        queued_compiles.add(device_id)
+        COMPILE_QUEUE_DEPTH.inc()
+        while len(compile_workers) < COMPILE_WORKERS:
+            worker = threading.Thread(target=compile_worker, name=f"esphome-compile-{len(compile_workers)}", daemon=True)
+            worker.start()
+            compile_workers.append(worker)
+    compile_queue.put((device_id, device_name))
+    return True
+
+def compile_worker():
+    while True:
+        device_id, device_name = compile_queue.get()
+        # A config change during this compile may queue the device again
+        with compile_lock:
+            queued_compiles.discard(device_id)
+        try:
+            compile_device_background(device_id, device_name)
+        except Exception as e:
+            print(f"Compile worker error for {device_name}: {e}")
+
+def compile_device_background(device_id, device_name):
+    """Compile device in background thread"""
+    try:
+        with BACKGROUND_THREADS.track_inprogress('compile'):
+            _compile_device(device_id, device_name)
+    finally:
+        COMPILE_QUEUE_DEPTH.dec()
+
+def update_esphome_device(session, device_id, **values):
+    """Write-queue job: update one ESPHome device's columns"""
+    table = ESPHomeDevice.__table__
+    session.execute(table.update().where(table.c.id == device_id).values(**values))
+
+def _compile_device(device_id, device_name):
+    # Status updates go through the write queue rather than this thread's own session
+    with app.app_context():
+        if db.session.get(ESPHomeDevice, device_id) is None:
+            return
+    write_queue.submit(update_esphome_device, device_id, compilation_status='compiling')
+
+    started = time.perf_counter()
+    outcome = 'failed'
+    values = {'compilation_status': 'error'}
+    try:
+        result = esphome_manager.compile_device(device_name)
+        if result['success']:
+            outcome = 'success'
+            values = {
+                'compilation_status': 'success',
+                'firmware_version': f"compiled_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            }
+        else:
+            print(f"Compilation failed for {device_name}: {result['error']}")
+    except Exception as e:
+        outcome = 'exception'
+        print(f"Compilation exception for {device_name}: {e}")
+
+    COMPILE_DURATION.observe(time.perf_counter() - started, outcome)
+    COMPILES.inc(outcome)
+    write_queue.submit(update_esphome_device, device_id, **values)
+
+def esphome_disabled():
+    return jsonify({'error': 'ESPHome manager is not enabled (set ESPHOME_MANAGER)'}), 503
+
+@app.route('/api/esphome/devices/<int:device_id>/compile', methods=['POST'])
+def compile_esphome_device(device_id):
+    """Compile ESPHome device configuration"""
+    if esphome_manager is None:
+        return esphome_disabled()
+    device = ESPHomeDevice.query.get_or_404(device_id)
+    start_compile(device_id, node_name(device.name))
+    return jsonify({'message': 'Compilation started'})
+
+@app.route('/api/esphome/devices', methods=['POST'])
+def create_esphome_device():
+    """Create an ESPHome device, write its config and queue a compile"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('name') or not data.get('type'):
+        return jsonify({'error': 'Name and type are required'}), 400
+
+    try:
+        # Simple and advanced mode both send the pins to use; template defaults fill in the rest
+        params = {'name': data['name'], 'type': data['type'], 'pins': data.get('pins') or {}}
+        fragments = None
+        config_file = None
+        device_name = node_name(data['name'])
+        if esphome_manager:
+            config_yaml, fragments = esphome_manager.render_device(params)
+            config_file, _ = esphome_manager.write_device_config(device_name, config_yaml)
+        else:
+            config_yaml = "# ESPHome configuration will be generated here"
+
+        # The render inputs let template changes re-render it later
+        device = ESPHomeDevice(
+            name=data['name'],
+            device_type=data['type'],
+            esphome_config=config_yaml,
+            config_params=json.dumps(params),
+            config_fragments=json.dumps(fragments) if fragments else None,
+            site_location_id=data.get('site_location_id'),
+            compilation_status='pending'
+        )
+        db.session.add(device)
+        db.session.commit()
+        if fragments:
+            config_sync.track(device.id, fragments)
+
+        if config_file:
+            start_compile(device.id, device_name)
+
+        return jsonify({
+            'id': device.id,
+            'message': 'Device created successfully',
+            'config': config_yaml,
+            'config_file': config_file
+        })
+    except ValueError as e:
+        # Unknown device type
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/esphome/devices/<int:device_id>/upload', methods=['POST'])
+def upload_esphome_firmware(device_id):
+    """Upload firmware to ESPHome device"""
+    if esphome_manager is None:
+        return esphome_disabled()
+    device = ESPHomeDevice.query.get_or_404(device_id)
+    if device.compilation_status != 'success':
+        return jsonify({'error': 'Device must be compiled successfully first'}), 400
+
+    threading.Thread(
+        target=upload_device_background,
+        args=(device_id, node_name(device.name), device.ip_address),
+        name=f"esphome-upload-{device_id}"
+    ).start()
+    return jsonify({'message': 'Firmware upload started'})
+
+def register_flashed_device(session, esphome_device_id):
+    """Write-queue job: add the site Device for a flashed ESPHome device, or refresh its address"""
+    esphome_device = session.get(ESPHomeDevice, esphome_device_id)
+    if esphome_device is None:
+        return
+    device = session.query(Device).filter_by(name=esphome_device.name).first()
+    if device is None:
+        device = Device(name=esphome_device.name, device_type=esphome_device.device_type,
+                        site_location_id=esphome_device.site_location_id)
+        session.add(device)
+    device.ip_address = esphome_device.ip_address or device.ip_address
+    device.mac_address = esphome_device.mac_address or device.mac_address
+
+def upload_device_background(device_id, device_name, device_ip):
+    """Upload firmware in background thread"""
+    with BACKGROUND_THREADS.track_inprogress('upload'):
+        started = time.perf_counter()
+        outcome = 'failed'
+        try:
+            result = esphome_manager.upload_device(device_name, device_ip)
+            if result['success']:
+                outcome = 'success'
+                print(f"Firmware uploaded successfully to {device_name}")
+                write_queue.submit(register_flashed_device, device_id)
+            else:
+                print(f"Upload failed for {device_name}: {result['error']}")
+        except Exception as e:
+            outcome = 'exception'
+            print(f"Upload exception for {device_name}: {e}")
+
+        UPLOAD_DURATION.observe(time.perf_counter() - started, outcome)
+        UPLOADS.inc(outcome)
+
+@app.route('/api/esphome/discover')
+def discover_esphome_devices():
+    """Discover ESPHome devices on the local network"""
+    if esphome_manager is None:
+        return esphome_disabled()
+    return jsonify(esphome_manager.discover_devices())
+
+def regenerate_configs(dry_run=False):
+    """Re-render devices affected by template or base config changes.
+
+    Only devices whose fragments changed are rendered, only changed files are
+    written and only devices whose effective config changed are compiled.
+    """
+    with app.app_context():
+        affected = sorted(config_sync.affected())
+        results = []
+        for start in range(0, len(affected), 500):
+            chunk = affected[start:start + 500]
+            devices = ESPHomeDevice.query.filter(ESPHomeDevice.id.in_(chunk)).all()
+            by_id = {device.id: device for device in devices}
+            for device_id in set(chunk) - set(by_id):
+                config_sync.remove(device_id)
+            batch = config_sync.regenerate(devices, dry_run=dry_run)
+            results.extend(batch)
+            if dry_run:
+                continue
+            for result in batch:
+                device = by_id[result['id']]
+                if 'fragments' in result:
+                    device.config_fragments = json.dumps(result['fragments'])
+                if result['changed']:
+                    device.esphome_config = result['yaml']
+                    device.compilation_status = 'pending'
+            db.session.commit()
+
+        if not dry_run:
+            for result in results:
+                if result['changed']:
+                    result['compile_queued'] = start_compile(result['id'], node_name(result['name']))
+        return results
+
+def backfill_config_params():
+    """Store render inputs for devices created before they were kept (see ConfigSync.backfill)"""
+    with app.app_context():
+        devices = ESPHomeDevice.query.filter(ESPHomeDevice.config_params.is_(None)).all()
+        recovered = config_sync.backfill(devices)
+        for device in devices:
+            if device.id in recovered:
+                params, fragments = recovered[device.id]
+                device.config_params = json.dumps(params)
+                device.config_fragments = json.dumps(fragments)
+        db.session.commit()
+    return len(recovered), len(devices) - len(recovered)
+
+def init_config_sync():
+    """Backfill old devices, index the fragments each stored config was rendered from, then catch up.
+
+    Workers take turns under a file lock: the first one re-renders and queues
+    compiles, the rest find nothing left to do.
+    """
+    with open(esphome_manager.base_path / '.config-sync.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        recovered, skipped = backfill_config_params()
+        with app.app_context():
+            rows = db.session.query(ESPHomeDevice.id, ESPHomeDevice.config_fragments) \
+                .filter(ESPHomeDevice.config_params.isnot(None))
+            for device_id, fragments in rows:
+                config_sync.track(device_id, json.loads(fragments) if fragments else {})
+        results = regenerate_configs()
+    changed = sum(1 for result in results if result['changed'])
+    print(f"Config sync: {recovered} devices backfilled, {skipped} skipped, "
+          f"{len(results)} re-rendered, {changed} changed")
+
+@app.route('/api/esphome/configs/regenerate', methods=['POST'])
+def regenerate_esphome_configs():
+    """Propagate template/base config changes; `dry_run` returns the diffs only"""
+    if esphome_manager is None:
+        return esphome_disabled()
+    data = request.get_json(silent=True) or {}
+    results = regenerate_configs(dry_run=bool(data.get('dry_run')))
+    return jsonify({
+        'affected': len(results),
+        'changed': sum(1 for result in results if result['changed']),
+        'devices': [{key: value for key, value in result.items() if key not in ('yaml', 'fragments')}
+                    for result in results],
+        'skipped': [{'id': device_id, 'reason': reason} for device_id, reason in sorted(config_sync.skipped.items())]
+    })
+
+def init_esphome():
+    global esphome_manager, config_sync
+    esphome_manager = ESPHomeManager(app, db)
+    config_sync = ConfigSync(esphome_manager)
+    print("ESPHome manager initialized")
+    init_config_sync()
+
+# Device presence
+def flush_presence(changes):
+    """Write presence changes behind through the write queue (raises if the write failed)"""
+    write_queue.submit(apply_presence_changes, changes).result(timeout=60)
+
+# The tracker is keyed by ESPHome node name (the MQTT topic prefix), so rows
+# are matched through node_name(). Each table's node name -> ids map is
+# reloaded at most every NODE_MAP_REFRESH seconds, or after NODE_MAP_RETRY
+# seconds when a change names a node the map does not have yet.
+NODE_MAP_REFRESH = 60
+NODE_MAP_RETRY = 5
+node_maps = {}
+
+def node_ids(session, model, names):
+    """Node name -> ids of `model` rows (only called from the write queue thread)"""
+    loaded, ids = node_maps.get(model.__tablename__, (None, {}))
+    age = time.time() - loaded if loaded is not None else None
+    if age is None or age >= NODE_MAP_REFRESH or (age >= NODE_MAP_RETRY and any(name not in ids for name in names)):
+        table = model.__table__
+        ids = {}
+        for row_id, name in session.execute(select(table.c.id, table.c.name)):
+            ids.setdefault(node_name(name), []).append(row_id)
+        node_maps[model.__tablename__] = (time.time(), ids)
+    return ids
+
+def update_by_node(session, model, ids, changes, column):
+    """One batched UPDATE of `column` for every row whose node has a change to it"""
+    table = model.__table__
+    rows = [{'b_id': row_id, 'b_value': change[column]}
+            for name, change in changes.items() if column in change for row_id in ids.get(name, ())]
+    if rows:
+        session.execute(table.update().where(table.c.id == bindparam('b_id')).values({column: bindparam('b_value')}),
+                        rows)
+
+def apply_presence_changes(session, changes):
+    """Device status and last_seen, plus ESPHomeDevice.last_seen, one batched UPDATE each"""
+    device_ids = node_ids(session, Device, changes)
+    update_by_node(session, Device, device_ids, changes, 'status')
+    update_by_node(session, Device, device_ids, changes, 'last_seen')
+    seen = {name: change for name, change in changes.items() if 'last_seen' in change}
+    if seen:
+        update_by_node(session, ESPHomeDevice, node_ids(session, ESPHomeDevice, seen), seen, 'last_seen')
+
+presence_tracker = PresenceTracker(flush_presence, timeout=int(os.environ.get('PRESENCE_TIMEOUT', 90)))
+# Uptime in the reports is the time between presence transitions
+presence_tracker.add_listener(rollup_store.record_status)
+
+def init_presence():
+    """Seed the tracker from the database and start offline detection"""
+    with app.app_context():
+        for name, status, last_seen in db.session.query(Device.name, Device.status, Device.last_seen):
+            presence_tracker.track(node_name(name), status, last_seen)
+            if status == 'online':
+                rollup_store.record_status(node_name(name), 'online')
+    presence_tracker.start()
+
+# Scheduled reports
+def get_report_sites():
+    """Map each site location to its devices' node names (the names rollups are kept under)
+
+    Devices without a location are reported under SITE_NAME.
+    """
+    default_site = os.environ.get('SITE_NAME', 'Smart Sites')
+    with app.app_context():
+        rows = (db.session.query(SiteLocation.name, Device.name)
+                .select_from(Device)
+                .outerjoin(SiteLocation, Device.site_location_id == SiteLocation.id)
+                .order_by(SiteLocation.name, Device.name)
+                .all())
+    sites = {}
+    for site, name in rows:
+        sites.setdefault(site or default_site, []).append(node_name(name))
+    return sites
+
+def create_report_sender():
+    if os.environ.get('SENDGRID_API_KEY'):
+        return SendGridSender(
+            os.environ['SENDGRID_API_KEY'],
+            os.environ.get('REPORT_FROM_EMAIL', 'reports@smartsites.local'),
+            [email.strip() for email in os.environ.get('REPORT_RECIPIENTS', '').split(',') if email.strip()]
+        )
+    return FileSender(os.environ.get('REPORT_DIR', 'data/reports'))
+
+report_generator = ReportGenerator(rollup_store, get_report_sites, None)
+
+@app.route('/api/reports/generate', methods=['POST'])
+def generate_reports():
+    """Generate and deliver site reports now"""
+    data = request.get_json(silent=True) or {}
+    period = data.get('period', 'daily')
+    if period not in ('daily', 'weekly'):
+        return jsonify({'error': 'Period must be daily or weekly'}), 400
+
+    if report_generator.sender is None:
+        report_generator.sender = create_report_sender()
+    reports = report_generator.generate(period)
+    return jsonify([{
+        'site': report['site'],
+        'period': report['period'],
+        'start': report['start'],
+        'end': report['end'],
+        'delivery': report.get('delivery')
+    } for report in reports])
+
+def start_services():
+    """Start the broker connection, ESPHome manager, native API subscriber and report scheduler"""
+    # Rollups survive restarts through a snapshot file the workers share
+    rollup_store.load()
+    rollup_store.start_snapshots()
+
+    # Connect to the broker when one is configured (each gunicorn worker subscribes)
+    if os.environ.get('MQTT_BROKER'):
+        init_presence()
+        init_mqtt()
+
+    # Render configs and compile firmware here (needs the esphome CLI and /opt/smart-sites/esphome)
+    if os.environ.get('ESPHOME_MANAGER'):
+        init_esphome()
+
+    # Subscribe over the native API as well; a file lock keeps the sessions in one worker
+    if os.environ.get('NATIVE_API_SUBSCRIBE'):
+        start_native_api_subscriber(os.environ.get('NATIVE_API_LOCK_FILE', 'data/.native-api.lock'))
+
+    # Every worker starts the scheduler, a file lock lets only one of them send
+    if os.environ.get('REPORT_SCHEDULER'):
+        report_generator.sender = create_report_sender()
+        report_generator.start_scheduler(
+            os.environ.get('REPORT_TIME', '06:00'),
+            lock_path=os.environ.get('REPORT_LOCK_FILE', os.path.join(os.environ.get('REPORT_DIR', 'data/reports'),
+                                                                      '.scheduler.lock')))
+
+# Report render workers (forkserver) re-import __main__ as __mp_main__ under `python app.py`;
+# only the web process itself connects and schedules
+if __name__ != '__mp_main__':
+    start_services()
+
+if __name__ == '__main__':
+    with app.app_context():
+        create_tables()
+    app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,378 @@
+# commands.py - Group command fan-out over MQTT
+# GroupIndex maps each location, device type and tag to the devices in it, so
+# a group resolves to command topics with set lookups instead of a query.
+# Every gunicorn worker holds its own copy. A one-row version counter is
+# bumped in the same transaction as any group change, so each worker rebuilds
+# its copy when the stored version no longer matches.
+# CommandDispatcher publishes one QoS 1 command per device over the app's
+# persistent MQTT client. Topics use the device's ESPHome node name, the prefix
+# its firmware subscribes under, not its display name. Many publishes are in
+# flight at once. Each device is tracked from publish, to the broker's PUBACK,
+# to completion (the device publishing the expected state back). Every batch
+# reports aggregate latency.
+
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import paho.mqtt.client as mqtt
+from sqlalchemy import event, inspect, select
+
+from backend.services.esphome import node_name
+from backend.services.metrics import registry
+
+TOPIC_PREFIX = 'smartsites'
+
+# Group kinds a command can be addressed to
+GROUP_KINDS = ('location', 'type', 'tag')
+
+# Unacknowledged QoS 1 publishes the client keeps on the wire (paho defaults to 20)
+MAX_INFLIGHT = 1000
+
+# Seconds a batch waits for devices to report the new state
+COMMAND_TIMEOUT = 5.0
+
+# Seconds a PUBACK that arrived before its publish was registered is kept
+EARLY_ACK_TTL = 30
+
+COMMAND_LATENCY = registry.histogram(
+    'smartsites_command_latency_seconds', 'Time from publishing a device command to its PUBACK or state echo',
+    ['stage'], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+COMMAND_RESULTS = registry.counter(
+    'smartsites_commands_total', 'Device commands by outcome', ['result'])
+COMMAND_BATCH_DURATION = registry.histogram(
+    'smartsites_command_batch_seconds', 'Time for a group command to complete on every device',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+
+class DispatchError(RuntimeError):
+    """The command could not be sent at all (no MQTT client)"""
+
+
+def parse_tags(tags):
+    """Tags are stored as a comma-separated string"""
+    return [tag.strip() for tag in (tags or '').split(',') if tag.strip()]
+
+
+def group_keys(location_id, device_type, tags):
+    """The (kind, value) groups a device belongs to"""
+    keys = {('type', device_type)}
+    if location_id is not None:
+        keys.add(('location', location_id))
+    keys.update(('tag', tag) for tag in parse_tags(tags))
+    return keys
+
+
+class GroupIndex:
+    """(kind, value) -> ids of the devices in that group, plus id -> device name"""
+
+    def __init__(self):
+        self.groups = defaultdict(set)
+        self.devices = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def rebuild(self, rows, version=None):
+        """Replace the index from (id, name, location_id, device_type, tags) rows"""
+        groups = defaultdict(set)
+        devices = {}
+        for device_id, name, location_id, device_type, tags in rows:
+            keys = group_keys(location_id, device_type, tags)
+            devices[device_id] = (name, keys)
+            for key in keys:
+                groups[key].add(device_id)
+        with self.lock:
+            self.groups, self.devices = groups, devices
+            self.version = version
+
+    def resolve(self, **selectors):
+        """Names of devices matching every given kind (any of its values).
+
+        `resolve(location=3, tag=['lights', 'signage'])` is the lights and
+        signage at site 3. Selectors that are None are ignored.
+        """
+        with self.lock:
+            matched = None
+            for kind, values in selectors.items():
+                if kind not in GROUP_KINDS:
+                    raise ValueError(f"Unknown group kind {kind}")
+                if values is None:
+                    continue
+                if not isinstance(values, (list, tuple, set)):
+                    values = [values]
+                members = set()
+                for value in values:
+                    members |= self.groups.get((kind, value), set())
+                matched = members if matched is None else matched & members
+                if not matched:
+                    return []
+            if matched is None:
+                return []
+            return sorted(self.devices[device_id][0] for device_id in matched)
+
+
+def group_version(connection, version_table):
+    """The stored group version (None before the first bump)"""
+    return connection.execute(select(version_table.c.version).where(version_table.c.id == 1)).scalar()
+
+
+def bump_group_version(connection, table):
+    """Mark every worker's GroupIndex stale (call after bulk loads that bypass the ORM)"""
+    if connection.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1)).rowcount == 0:
+        connection.execute(table.insert().values(id=1, version=1))
+
+
+def track_groups(model, columns, version_table):
+    """Bump the group version in the same flush as any change to a device's groups.
+
+    Inserts and deletes of `model` always count; updates count when one of
+    `columns` changed. A rolled back transaction rolls the bump back too.
+    """
+
+    @event.listens_for(model, 'after_insert')
+    @event.listens_for(model, 'after_delete')
+    def _added_or_deleted(mapper, connection, target):
+        bump_group_version(connection, version_table)
+
+    @event.listens_for(model, 'after_update')
+    def _updated(mapper, connection, target):
+        state = inspect(target)
+        if any(state.attrs[column].history.has_changes() for column in columns):
+            bump_group_version(connection, version_table)
+
+
+def _latency(values):
+    """p50/p95/max of a list of seconds, in milliseconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        'p50': round(ordered[len(ordered) // 2] * 1000, 2),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+        'max': round(ordered[-1] * 1000, 2)
+    }
+
+
+class _Target:
+    """One device's command within a batch"""
+    __slots__ = ('batch', 'device', 'topic', 'state_topic', 'published', 'acked', 'completed', 'error')
+
+    def __init__(self, batch, device, topic, state_topic):
+        self.batch = batch
+        self.device = device
+        self.topic = topic
+        self.state_topic = state_topic
+        self.published = None
+        self.acked = None
+        self.completed = None
+        self.error = None
+
+
+class CommandBatch:
+    """A command sent to a group of devices and its per-device progress"""
+
+    def __init__(self, command, expect):
+        self.id = uuid.uuid4().hex[:12]
+        self.command = command
+        self.expect = expect
+        self.targets = []
+        self.started = time.perf_counter()
+        self.finished = None
+        self.remaining = 0
+        self.done = threading.Event()
+
+    def _finish_target(self):
+        # Called with the dispatcher lock held
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.finished = time.perf_counter()
+            self.done.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def summary(self):
+        ack_latency = [t.acked - t.published for t in self.targets if t.acked is not None]
+        completion_latency = [t.completed - t.published for t in self.targets if t.completed is not None]
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return {
+            'id': self.id,
+            'command': self.command,
+            'devices': len(self.targets),
+            'acked': len(ack_latency),
+            'completed': len(completion_latency),
+            'failed': sum(1 for t in self.targets if t.error is not None),
+            'duration_ms': round((end - self.started) * 1000, 2),
+            'ack_latency_ms': _latency(ack_latency),
+            'completion_latency_ms': _latency(completion_latency),
+            'results': [{
+                'device': t.device,
+                'acked_ms': round((t.acked - t.published) * 1000, 2) if t.acked is not None else None,
+                'completed_ms': round((t.completed - t.published) * 1000, 2) if t.completed is not None else None,
+                'error': t.error
+            } for t in self.targets]
+        }
+
+
+class CommandDispatcher:
+    """Fans a command out to many devices over one persistent MQTT client.
+
+    Attach the app's client with `attach(client)` and feed every incoming
+    state message to `handle_state(topic, payload)`. `send` publishes to
+    <prefix>/<node name>/<component>/<object_id>/command on each device. A device
+    completes when it publishes `expect` (the payload itself by default) on
+    the matching /state topic.
+    """
+
+    def __init__(self, topic_prefix=TOPIC_PREFIX, qos=1, timeout=COMMAND_TIMEOUT, max_inflight=MAX_INFLIGHT):
+        self.topic_prefix = topic_prefix
+        self.qos = qos
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.client = None
+        self.by_mid = {}
+        self.early_acks = {}
+        self.waiting = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def attach(self, client):
+        client.max_inflight_messages_set(self.max_inflight)
+        client.on_publish = self.on_publish
+        self.client = client
+
+    def send(self, devices, component, object_id, payload, expect=None, timeout=None):
+        """Publish the command to every device and wait until all complete or time out.
+
+        `expect` is the state payload that marks a device as done; pass
+        expect='' to complete on any state update (e.g. after TOGGLE).
+        Returns the finished CommandBatch.
+        """
+        client = self.client
+        if client is None:
+            raise DispatchError('MQTT is not connected')
+        payload = str(payload)
+        expect = payload if expect is None else str(expect)
+        timeout = self.timeout if timeout is None else timeout
+
+        batch = CommandBatch(f"{component}/{object_id}={payload}", expect)
+        base = f"{self.topic_prefix}/{{}}/{component}/{object_id}/"
+        batch.targets = []
+        for device in devices:
+            prefix = base.format(node_name(device))
+            batch.targets.append(_Target(batch, device, prefix + 'command', prefix + 'state'))
+        batch.remaining = len(batch.targets)
+        if not batch.targets:
+            batch.finished = batch.started
+            batch.done.set()
+            return batch
+
+        # Register for state echoes first, a fast device can answer before publish() returns
+        with self.lock:
+            for target in batch.targets:
+                self.waiting[target.state_topic].append(target)
+
+        # Publishes are pipelined: paho writes each one without waiting for earlier PUBACKs
+        for target in batch.targets:
+            target.published = time.perf_counter()
+            try:
+                info = client.publish(target.topic, payload, qos=self.qos)
+            except ValueError as e:
+                # Invalid topic (a wildcard in the component or object id) or payload
+                with self.lock:
+                    self._fail(target, str(e))
+                continue
+            with self.lock:
+                if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                    # NO_CONN publishes are queued by paho and sent on reconnect
+                    self._fail(target, mqtt.error_string(info.rc))
+                elif self.early_acks.pop(info.mid, 0) >= target.published:
+                    target.acked = time.perf_counter()
+                else:
+                    self.by_mid[info.mid] = target
+
+        batch.wait(timeout)
+        self._expire(batch)
+        self._record(batch)
+        return batch
+
+    def on_publish(self, client, userdata, mid):
+        """PUBACK from the broker (paho's loop thread)"""
+        now = time.perf_counter()
+        with self.lock:
+            target = self.by_mid.pop(mid, None)
+            if target is None:
+                # PUBACK raced ahead of send() registering the mid
+                self.early_acks[mid] = now
+                if len(self.early_acks) > self.max_inflight:
+                    cutoff = now - EARLY_ACK_TTL
+                    self.early_acks = {m: t for m, t in self.early_acks.items() if t >= cutoff}
+                return
+            target.acked = now
+
+    def handle_state(self, topic, payload):
+        """State message from MQTT; completes any command waiting on this topic"""
+        if topic not in self.waiting:
+            return
+        now = time.perf_counter()
+        if isinstance(payload, bytes):
+            payload = payload.decode(errors='replace')
+        with self.lock:
+            targets = self.waiting.get(topic)
+            if not targets:
+                return
+            remaining = []
+            for target in targets:
+                if target.published is None:
+                    # An echo of an earlier command, this one is not out yet
+                    remaining.append(target)
+                elif target.batch.expect == '' or payload == target.batch.expect:
+                    target.completed = now
+                    target.batch._finish_target()
+                else:
+                    remaining.append(target)
+            if remaining:
+                self.waiting[topic] = remaining
+            else:
+                del self.waiting[topic]
+
+    def _fail(self, target, error):
+        target.error = error
+        self._unwait(target)
+        target.batch._finish_target()
+
+    def _unwait(self, target):
+        targets = self.waiting.get(target.state_topic)
+        if targets and target in targets:
+            targets.remove(target)
+            if not targets:
+                del self.waiting[target.state_topic]
+
+    def _expire(self, batch):
+        """Give up on devices that have not completed by the deadline"""
+        with self.lock:
+            for target in batch.targets:
+                if target.completed is not None or target.error is not None:
+                    continue
+                target.error = 'timeout' if target.acked is not None else 'not acknowledged'
+                self._unwait(target)
+                batch._finish_target()
+            if batch.finished is None:
+                batch.finished = time.perf_counter()
+            stale = [mid for mid, target in self.by_mid.items() if target.batch is batch]
+            for mid in stale:
+                del self.by_mid[mid]
+
+    def _record(self, batch):
+        for target in batch.targets:
+            if target.acked is not None:
+                COMMAND_LATENCY.observe(target.acked - target.published, 'ack')
+            if target.completed is not None:
+                COMMAND_LATENCY.observe(target.completed - target.published, 'complete')
+                COMMAND_RESULTS.inc('completed')
+            else:
+                COMMAND_RESULTS.inc('timeout' if target.error in ('timeout', 'not acknowledged') else 'failed')
+        COMMAND_BATCH_DURATION.observe(batch.finished - batch.started)
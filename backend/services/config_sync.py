@@ -0,0 +1,157 @@
+# config_sync.py - Incremental fleet config regeneration
+# Every device's YAML is rendered from the shared base fragments and its
+# template (see esphome.fragment_hashes). ConfigIndex remembers which
+# fragment versions each device was rendered from, so a fragment change
+# finds the affected devices without rendering the whole fleet. ConfigSync
+# re-renders only those devices, diffs the result against the stored YAML,
+# writes only the files that changed and reports which devices need a compile.
+# Devices stored before render inputs were kept are backfilled when their
+# inputs can be recovered exactly, and reported as skipped otherwise.
+
+import difflib
+import json
+import threading
+from collections import defaultdict
+
+from backend.services.esphome import fragment_hashes, node_name
+from backend.services.metrics import registry
+
+CONFIG_RENDERS = registry.counter(
+    'smartsites_esphome_config_renders_total', 'Device configs re-rendered by result', ['result'])
+
+# Diff lines returned per device before truncating
+MAX_DIFF_LINES = 200
+
+
+class ConfigIndex:
+    """Fragment key -> fragment hash -> ids of devices rendered from that version"""
+
+    def __init__(self):
+        self.devices = {}
+        self.dependents = defaultdict(lambda: defaultdict(set))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def track(self, device_id, hashes):
+        with self.lock:
+            self._remove(device_id)
+            self.devices[device_id] = dict(hashes)
+            for key, digest in hashes.items():
+                self.dependents[key][digest].add(device_id)
+
+    def remove(self, device_id):
+        with self.lock:
+            self._remove(device_id)
+
+    def _remove(self, device_id):
+        for key, digest in self.devices.pop(device_id, {}).items():
+            versions = self.dependents[key]
+            versions[digest].discard(device_id)
+            if not versions[digest]:
+                del versions[digest]
+            if not versions:
+                del self.dependents[key]
+
+    def affected(self, current):
+        """Ids of devices rendered from a fragment version that is no longer current.
+
+        `current` maps every fragment key to its hash. Devices missing a base
+        fragment that has since been added, or holding one that has been
+        removed, are affected too.
+        """
+        affected = set()
+        with self.lock:
+            for key, versions in self.dependents.items():
+                digest = current.get(key)
+                for version, ids in versions.items():
+                    if version != digest:
+                        affected.update(ids)
+            for key in current:
+                if not key.startswith('base:'):
+                    continue
+                versions = self.dependents.get(key, {})
+                if sum(len(ids) for ids in versions.values()) != len(self.devices):
+                    affected.update(device_id for device_id, hashes in self.devices.items() if key not in hashes)
+        return affected
+
+
+class ConfigSync:
+    """Re-renders devices whose fragments changed and writes only changed files"""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.index = ConfigIndex()
+        self.skipped = {}
+
+    def track(self, device_id, hashes):
+        self.index.track(device_id, hashes)
+
+    def remove(self, device_id):
+        self.index.remove(device_id)
+
+    def affected(self):
+        return self.index.affected(fragment_hashes())
+
+    def backfill(self, devices):
+        """Recover render inputs for devices (id, name, device_type, esphome_config) without any.
+
+        A device gets default-pin params only when rendering them with the
+        current fragments reproduces its stored YAML exactly. Anything else
+        (custom pins, an older template, an unknown type) is left alone and
+        recorded in `skipped`, since guessing its inputs could silently change
+        its firmware. Returns id -> (params, fragment hashes).
+        """
+        recovered = {}
+        for device in devices:
+            params = {'name': device.name, 'type': device.device_type, 'pins': {}}
+            try:
+                config_yaml, hashes = self.manager.render_device(params)
+            except (TypeError, ValueError, KeyError) as e:
+                self.skipped[device.id] = f"No render inputs and cannot render: {e}"
+                continue
+            if config_yaml != (device.esphome_config or ''):
+                self.skipped[device.id] = 'No render inputs and the stored config is not a default render'
+                continue
+            self.skipped.pop(device.id, None)
+            recovered[device.id] = (params, hashes)
+        return recovered
+
+    def regenerate(self, devices, dry_run=False):
+        """Re-render devices (objects with id, config_params and esphome_config).
+
+        Returns one result per device: its new YAML and fragment hashes,
+        whether the effective config changed, a unified diff against the
+        stored YAML and whether the file on disk was rewritten. Devices that
+        fail to render keep their current config and report the error.
+        """
+        results = []
+        for device in devices:
+            result = {'id': device.id, 'changed': False, 'written': False}
+            try:
+                params = json.loads(device.config_params)
+                result['name'] = params['name']
+                config_yaml, hashes = self.manager.render_device(params)
+            except (TypeError, ValueError, KeyError) as e:
+                result['error'] = str(e)
+                CONFIG_RENDERS.inc('error')
+                results.append(result)
+                continue
+
+            result['yaml'] = config_yaml
+            result['fragments'] = hashes
+            # yaml.dump sorts keys, so equal text means an equal effective config
+            if config_yaml != (device.esphome_config or ''):
+                result['changed'] = True
+                diff = list(difflib.unified_diff(
+                    (device.esphome_config or '').splitlines(), config_yaml.splitlines(),
+                    'stored', 'rendered', lineterm=''))
+                result['diff'] = '\n'.join(diff[:MAX_DIFF_LINES])
+            if not dry_run:
+                result['config_file'], result['written'] = self.manager.write_device_config(
+                    node_name(params['name']), config_yaml)
+                self.index.track(device.id, hashes)
+            CONFIG_RENDERS.inc('changed' if result['changed'] else 'unchanged')
+            results.append(result)
+        return results
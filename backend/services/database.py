@@ -0,0 +1,230 @@
+# database.py - SQLite concurrency: WAL, read-only API reads and a write-behind queue
+# The web workers, background threads and the celery container share one
+# SQLite file. Connections run in WAL mode, so readers never block the writer,
+# with a busy timeout long enough for writers to queue on the lock instead of
+# failing with "database is locked". GET requests read through a separate
+# query-only engine. Background threads hand their writes to a single
+# write-behind queue that commits them in batches. Lock waits and lock errors
+# are exported as metrics.
+
+import concurrent.futures
+import queue
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from backend.services.metrics import registry
+
+# Bind key of the read-only engine
+READ_BIND = 'readonly'
+
+# Milliseconds a connection waits for the write lock before giving up
+BUSY_TIMEOUT_MS = 15000
+
+# Writes committed per transaction, and how long the queue waits to fill a batch
+MAX_BATCH = 200
+BATCH_DELAY = 0.02
+
+DB_LOCK_WAIT = registry.histogram(
+    'smartsites_db_lock_wait_seconds', 'Time to take the SQLite write lock (first write of each transaction)', ['source'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0))
+DB_LOCK_ERRORS = registry.counter(
+    'smartsites_db_lock_errors_total', '"database is locked" errors', ['source'])
+WRITE_QUEUE_DEPTH = registry.gauge(
+    'smartsites_db_write_queue_depth', 'Writes waiting in the write-behind queue')
+WRITE_QUEUE_LATENCY = registry.histogram(
+    'smartsites_db_write_queue_seconds', 'Time from queueing a write to its commit')
+WRITE_BATCH_SIZE = registry.histogram(
+    'smartsites_db_write_batch_size', 'Writes committed per write-behind transaction',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+def _is_sqlite_file(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def database_config(url):
+    """Flask config to apply before SQLAlchemy(app) is created.
+
+    SQLite files get a second bind for read-only connections. Other
+    databases (or in-memory SQLite) keep a single engine.
+    """
+    if not _is_sqlite_file(url):
+        return {}
+    return {'SQLALCHEMY_BINDS': {READ_BIND: url}}
+
+
+_local = threading.local()
+
+
+def _source():
+    from flask import has_request_context
+    if getattr(_local, 'write_queue', False):
+        return 'write_queue'
+    return 'request' if has_request_context() else 'background'
+
+
+def _is_read_request():
+    from flask import has_request_context, request
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+def routing_session_class():
+    """Session class sending GET/HEAD request reads to the read-only engine"""
+    from flask_sqlalchemy.session import Session
+
+    class RoutingSession(Session):
+        def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+            if bind is None and not self._flushing and READ_BIND in self._db.engines and _is_read_request():
+                return self._db.engines[READ_BIND]
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    return RoutingSession
+
+
+_WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'BEGIN')
+
+
+def configure_sqlite(engine, read_only=False):
+    """Apply WAL, busy timeout and lock-wait instrumentation to every new connection"""
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+        else:
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+    if not read_only:
+        # The driver opens a transaction with its first write, which is where
+        # the write lock is taken; time that statement as the lock wait
+        @event.listens_for(engine, 'before_cursor_execute')
+        def _before_execute(conn, cursor, statement, parameters, context, executemany):
+            if (not conn.connection.dbapi_connection.in_transaction
+                    and statement.lstrip()[:7].upper().startswith(_WRITE_PREFIXES)):
+                conn.info['lock_wait_started'] = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def _after_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info.pop('lock_wait_started', None)
+            if started is not None:
+                DB_LOCK_WAIT.observe(time.perf_counter() - started, _source())
+
+    @event.listens_for(engine, 'handle_error')
+    def _on_error(context):
+        if context.connection is not None:
+            context.connection.info.pop('lock_wait_started', None)
+        if 'database is locked' in str(context.original_exception):
+            DB_LOCK_ERRORS.inc(_source())
+
+
+class _Write:
+    __slots__ = ('func', 'args', 'kwargs', 'future', 'queued')
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.queued = time.perf_counter()
+
+
+class WriteQueue:
+    """One writer thread applying queued writes in batched transactions.
+
+    `submit(func, *args)` queues func(session, *args) and returns a Future.
+    Writes that arrive together share one transaction and one commit; if a
+    batch fails, its writes are retried one by one so a bad write only fails
+    its own Future.
+    """
+
+    def __init__(self, app, db, max_batch=MAX_BATCH, batch_delay=BATCH_DELAY, begin_immediate=False):
+        self.app = app
+        self.db = db
+        self.begin_immediate = begin_immediate
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, func, *args, **kwargs):
+        write = _Write(func, args, kwargs)
+        WRITE_QUEUE_DEPTH.inc()
+        self.queue.put(write)
+        self._ensure_thread()
+        return write.future
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed"""
+        return self.submit(lambda session: None).result(timeout)
+
+    def _ensure_thread(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='db-write-queue', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        _local.write_queue = True
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.batch_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            WRITE_QUEUE_DEPTH.dec(amount=len(batch))
+            try:
+                self._apply(batch)
+            except Exception as e:
+                print(f"Write queue error: {e}")
+
+    def _apply(self, batch):
+        with self.app.app_context():
+            session = self.db.session
+            try:
+                if self.begin_immediate:
+                    # Take the write lock before any job reads, so no job has to upgrade a read lock
+                    session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+                results = [write.func(session, *write.args, **write.kwargs) for write in batch]
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                results = None
+                error = e
+
+        if results is None:
+            if len(batch) == 1:
+                batch[0].future.set_exception(error)
+            else:
+                for write in batch:
+                    self._apply([write])
+            return
+
+        committed = time.perf_counter()
+        WRITE_BATCH_SIZE.observe(len(batch))
+        for write, result in zip(batch, results):
+            WRITE_QUEUE_LATENCY.observe(committed - write.queued)
+            write.future.set_result(result)
+
+
+def init_database(app, db):
+    """Configure the engines behind `db` and return the app's write queue"""
+    with app.app_context():
+        engines = dict(db.engines)
+    sqlite = _is_sqlite_file(str(engines[None].url))
+    if sqlite:
+        configure_sqlite(engines[None])
+        if READ_BIND in engines:
+            configure_sqlite(engines[READ_BIND], read_only=True)
+    return WriteQueue(app, db, begin_immediate=sqlite)
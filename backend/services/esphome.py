@@ -0,0 +1,602 @@
+# esphome.py - ESPHome device templates and configuration/compile manager
+# Shared by the ESPHome API integration (backend/app.py) and the benchmarks
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import re
+import yaml
+import subprocess
+import requests
+import socket
+import threading
+import time
+from pathlib import Path
+
+from backend.services.metrics import registry
+
+DISCOVERY_DURATION = registry.histogram(
+    'smartsites_esphome_discovery_duration_seconds', 'Duration of ESPHome network discovery sweeps',
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+DISCOVERY_HOSTS = registry.gauge(
+    'smartsites_esphome_discovery_hosts', 'Hosts seen in the last discovery sweep', ['result'],
+    aggregate='latest')
+COMPILE_DURATION = registry.histogram(
+    'smartsites_esphome_compile_duration_seconds', 'ESPHome firmware compile duration', ['outcome'],
+    buckets=(5, 15, 30, 60, 120, 180, 300, 600))
+COMPILES = registry.counter(
+    'smartsites_esphome_compiles_total', 'ESPHome firmware compiles by outcome', ['outcome'])
+COMPILE_QUEUE_DEPTH = registry.gauge(
+    'smartsites_esphome_compile_queue_depth', 'Compiles queued or in progress')
+UPLOAD_DURATION = registry.histogram(
+    'smartsites_esphome_upload_duration_seconds', 'ESPHome firmware upload duration', ['outcome'],
+    buckets=(5, 15, 30, 60, 120, 300))
+UPLOADS = registry.counter(
+    'smartsites_esphome_uploads_total', 'ESPHome firmware uploads by outcome', ['outcome'])
+
+# Enhanced ESPHome Device Templates
+ESPHOME_TEMPLATES = {
+    'motion_sensor': {
+        'name': 'Motion Sensor',
+        'description': 'PIR or mmWave motion detection for construction site monitoring',
+        'sensors': ['binary_sensor'],
+        'pins': {
+            'motion_pin': {'type': 'digital', 'default': 'GPIO2', 'required': True}
+        },
+        'config': {
+            'binary_sensor': [{
+                'platform': 'gpio',
+                'pin': '{motion_pin}',
+                'name': 'Motion',
+                'device_class': 'motion',
+                'filters': [{
+                    'delayed_off': '10s'
+                }]
+            }]
+        }
+    },
+    'light_sensor': {
+        'name': 'Light Sensor',
+        'description': 'Ambient light monitoring with LDR or BH1750',
+        'sensors': ['sensor'],
+        'pins': {
+            'light_pin': {'type': 'analog', 'default': 'A0', 'required': True}
+        },
+        'config': {
+            'sensor': [{
+                'platform': 'adc',
+                'pin': '{light_pin}',
+                'name': 'Light Level',
+                'unit_of_measurement': 'V',
+                'update_interval': '30s',
+                'filters': [{
+                    'multiply': 3.3
+                }, {
+                    'lambda': 'return (x / 3.3) * 100;'
+                }]
+            }]
+        }
+    },
+    'air_quality': {
+        'name': 'Air Quality Monitor',
+        'description': 'Temperature, humidity, and air quality monitoring',
+        'sensors': ['sensor'],
+        'pins': {
+            'dht_pin': {'type': 'digital', 'default': 'GPIO4', 'required': True},
+            'mq135_pin': {'type': 'analog', 'default': 'A0', 'required': False}
+        },
+        'config': {
+            'sensor': [{
+                'platform': 'dht',
+                'pin': '{dht_pin}',
+                'model': 'DHT22',
+                'temperature': {
+                    'name': 'Temperature',
+                    'unit_of_measurement': '°C'
+                },
+                'humidity': {
+                    'name': 'Humidity',
+                    'unit_of_measurement': '%'
+                },
+                'update_interval': '30s'
+            }]
+        }
+    },
+    'noise_monitor': {
+        'name': 'Noise Level Monitor',
+        'description': 'Sound level monitoring for construction site noise control',
+        'sensors': ['sensor'],
+        'pins': {
+            'microphone_pin': {'type': 'analog', 'default': 'A0', 'required': True}
+        },
+        'config': {
+            'sensor': [{
+                'platform': 'adc',
+                'pin': '{microphone_pin}',
+                'name': 'Noise Level',
+                'unit_of_measurement': 'dB',
+                'update_interval': '5s',
+                'filters': [{
+                    'sliding_window_moving_average': {
+                        'window_size': 10,
+                        'send_every': 5
+                    }
+                }, {
+                    'lambda': 'return (x * 50) + 30;'  # Convert to rough dB estimate
+                }]
+            }]
+        }
+    },
+    'power_monitor': {
+        'name': 'Power Monitor',
+        'description': 'CT clamp power monitoring for electrical consumption',
+        'sensors': ['sensor'],
+        'pins': {
+            'ct_pin': {'type': 'analog', 'default': 'A0', 'required': True}
+        },
+        'config': {
+            'sensor': [{
+                'platform': 'ct_clamp',
+                'pin': '{ct_pin}',
+                'name': 'Power Consumption',
+                'unit_of_measurement': 'W',
+                'update_interval': '10s',
+                'sample_duration': '200ms',
+                'filters': [{
+                    'calibrate_linear': [
+                        {'0.0V': '0W'},
+                        {'1.0V': '1000W'}
+                    ]
+                }]
+            }]
+        }
+    },
+    'door_window_sensor': {
+        'name': 'Door/Window Sensor',
+        'description': 'Magnetic reed switch for door/window monitoring',
+        'sensors': ['binary_sensor'],
+        'pins': {
+            'reed_pin': {'type': 'digital', 'default': 'GPIO2', 'required': True}
+        },
+        'config': {
+            'binary_sensor': [{
+                'platform': 'gpio',
+                'pin': {
+                    'number': '{reed_pin}',
+                    'mode': 'INPUT_PULLUP'
+                },
+                'name': 'Door Status',
+                'device_class': 'door',
+                'filters': [{
+                    'delayed_on': '100ms'
+                }, {
+                    'delayed_off': '100ms'
+                }]
+            }]
+        }
+    }
+}
+
+# Configuration shared by every device, one fragment per top-level section.
+# `{node_name}` and `{name}` are filled in per device, like template pins.
+BASE_CONFIG = {
+    'esphome': {
+        'name': '{node_name}',
+        'platform': 'ESP32',
+        'board': 'esp32dev'
+    },
+    'wifi': {
+        'ssid': '!secret wifi_ssid',
+        'password': '!secret wifi_password',
+        'ap': {
+            'ssid': '{name} Fallback',
+            'password': 'smartsites123'
+        }
+    },
+    'captive_portal': {},
+    'logger': {
+        'level': 'INFO'
+    },
+    'api': {
+        'encryption': {
+            'key': '!secret api_encryption_key'
+        }
+    },
+    'ota': {
+        'password': '!secret ota_password'
+    },
+    'mqtt': {
+        'broker': '!secret mqtt_broker',
+        'port': 1883,
+        'username': '!secret mqtt_username',
+        'password': '!secret mqtt_password',
+        'topic_prefix': 'smartsites/{node_name}',
+        'discovery': True
+    },
+    'web_server': {
+        'port': 80
+    },
+    'time': {
+        'platform': 'sntp',
+        'id': 'my_time'
+    }
+}
+
+_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+def node_name(name):
+    """ESPHome node name for a device, as used in its config and MQTT topics"""
+    name = name.lower().replace(' ', '_').replace('-', '_')
+    return ''.join(c for c in name if c.isalnum() or c == '_')
+
+def _substitute(value, params):
+    """Deep copy of a fragment with {placeholders} filled in (unknown ones are kept)"""
+    if isinstance(value, dict):
+        return {key: _substitute(item, params) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_substitute(item, params) for item in value]
+    if isinstance(value, str) and '{' in value:
+        whole = _PLACEHOLDER.fullmatch(value)
+        if whole and whole.group(1) in params:
+            return params[whole.group(1)]
+        return _PLACEHOLDER.sub(lambda m: str(params.get(m.group(1), m.group(0))), value)
+    return value
+
+def render_device_config(device_data):
+    """Render a device from the base fragments and its type's template.
+
+    Pins not given in device_data fall back to the template defaults.
+    """
+    template = ESPHOME_TEMPLATES.get(device_data['type'])
+    if not template:
+        raise ValueError(f"Unknown device type: {device_data['type']}")
+
+    params = {name: spec['default'] for name, spec in template.get('pins', {}).items() if 'default' in spec}
+    params.update(device_data.get('pins') or {})
+    params['name'] = device_data['name']
+    params['node_name'] = node_name(device_data['name'])
+
+    config = _substitute(BASE_CONFIG, params)
+    config.update(_substitute(template['config'], params))
+    return config
+
+def dump_config(config):
+    return yaml.dump(config, default_flow_style=False, indent=2)
+
+def _fragment_hash(fragment):
+    return hashlib.sha256(json.dumps(fragment, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def fragment_hashes(device_type=None):
+    """Hash of every fragment a device type is rendered from (all fragments if no type).
+
+    Keys are `base:<section>` and `template:<type>`; a template's hash covers
+    its pin defaults as well as its config.
+    """
+    hashes = {f"base:{section}": _fragment_hash(fragment) for section, fragment in BASE_CONFIG.items()}
+    types = ESPHOME_TEMPLATES if device_type is None else [device_type]
+    for name in types:
+        template = ESPHOME_TEMPLATES.get(name)
+        if template is not None:
+            hashes[f"template:{name}"] = _fragment_hash({'config': template['config'],
+                                                         'pins': template.get('pins', {})})
+    return hashes
+
+DEFAULT_BASE_PATH = '/opt/smart-sites/esphome'
+
+def _generate_key():
+    """Generate a 32-byte encryption key (ESPHome expects it base64 encoded)"""
+    import secrets
+    return base64.b64encode(secrets.token_bytes(32)).decode()
+
+def _generate_password():
+    """Generate a random password"""
+    import secrets
+    import string
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(secrets.choice(alphabet) for _ in range(12))
+
+def load_secrets(secrets_file):
+    """Read secrets.yaml, filling in (and writing back) only the entries it lacks.
+
+    Existing keys and passwords are never replaced, so firmware compiled before
+    a restart still matches. ESPHOME_API_KEY, when set, is the fleet's API key
+    and is written into the file. A lock file serializes gunicorn workers that
+    start at the same time, so they all settle on one generated key.
+    """
+    secrets_file = Path(secrets_file)
+    secrets_file.parent.mkdir(exist_ok=True, parents=True)
+    with open(secrets_file.with_name('.secrets.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        existing = {}
+        if secrets_file.exists():
+            with open(secrets_file) as f:
+                existing = yaml.safe_load(f) or {}
+
+        secrets = {
+            'wifi_ssid': 'YourWiFiNetwork',
+            'wifi_password': 'YourWiFiPassword',
+            'mqtt_broker': '192.168.1.100',
+            'mqtt_username': 'smartsites',
+            'mqtt_password': 'smartsites123'
+        }
+        secrets.update(existing)
+        if os.environ.get('ESPHOME_API_KEY'):
+            secrets['api_encryption_key'] = os.environ['ESPHOME_API_KEY']
+        secrets.setdefault('api_encryption_key', _generate_key())
+        secrets.setdefault('ota_password', _generate_password())
+
+        if secrets != existing:
+            temp_path = secrets_file.with_suffix('.yaml.tmp')
+            with open(temp_path, 'w') as f:
+                yaml.dump(secrets, f, default_flow_style=False)
+            os.replace(temp_path, secrets_file)
+    return secrets
+
+def fleet_api_key(base_path=DEFAULT_BASE_PATH):
+    """The native API key compiled into every device (None if secrets.yaml cannot be created)"""
+    try:
+        return load_secrets(Path(base_path) / 'config' / 'secrets.yaml')['api_encryption_key']
+    except OSError as e:
+        print(f"Cannot read ESPHome secrets: {e}")
+        return os.environ.get('ESPHOME_API_KEY')
+
+class ESPHomeManager:
+    def __init__(self, app, db, base_path=DEFAULT_BASE_PATH):
+        self.app = app
+        self.db = db
+        self.base_path = Path(base_path)
+        self.base_path.mkdir(exist_ok=True, parents=True)
+        
+        # ESPHome paths
+        self.config_path = self.base_path / 'config'
+        self.build_path = self.base_path / 'build'
+        self.secrets_file = self.config_path / 'secrets.yaml'
+        
+        # Create directories
+        self.config_path.mkdir(exist_ok=True)
+        self.build_path.mkdir(exist_ok=True)
+        
+        # Initialize secrets file
+        self._create_secrets_file()
+        
+    def _create_secrets_file(self):
+        """Create the ESPHome secrets file, keeping any keys it already has"""
+        self.api_encryption_key = load_secrets(self.secrets_file)['api_encryption_key']
+    
+    def get_templates(self):
+        """Get available device templates"""
+        return ESPHOME_TEMPLATES
+    
+    def create_device_config(self, device_data):
+        """Create ESPHome configuration for a device"""
+        return render_device_config(device_data)
+
+    def render_device(self, device_data):
+        """Render a device's YAML and the hashes of the fragments it was built from"""
+        return dump_config(render_device_config(device_data)), fragment_hashes(device_data['type'])
+    
+    def save_device_config(self, device_name, config):
+        """Save device configuration to file"""
+        config_file = self.config_path / f"{device_name}.yaml"
+        
+        with open(config_file, 'w') as f:
+            f.write(dump_config(config))
+        
+        return str(config_file)
+
+    def write_device_config(self, device_name, config_yaml):
+        """Write rendered YAML unless the file already holds it; returns (path, written)"""
+        config_file = self.config_path / f"{device_name}.yaml"
+        try:
+            if config_file.read_text() == config_yaml:
+                return str(config_file), False
+        except FileNotFoundError:
+            pass
+        tmp_file = config_file.with_suffix('.yaml.tmp')
+        tmp_file.write_text(config_yaml)
+        os.replace(tmp_file, config_file)
+        return str(config_file), True
+    
+    def compile_device(self, device_name):
+        """Compile ESPHome configuration"""
+        config_file = self.config_path / f"{device_name}.yaml"
+        
+        if not config_file.exists():
+            raise FileNotFoundError(f"Configuration file not found: {config_file}")
+        
+        # Run ESPHome compile command
+        cmd = [
+            'esphome', 'compile', str(config_file)
+        ]
+        
+        try:
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=600,  # 10 minute timeout
+                cwd=str(self.base_path)
+            )
+            
+            return {
+                'success': result.returncode == 0,
+                'output': result.stdout,
+                'error': result.stderr,
+                'return_code': result.returncode
+            }
+            
+        except subprocess.TimeoutExpired:
+            return {
+                'success': False,
+                'output': '',
+                'error': 'Compilation timed out after 10 minutes',
+                'return_code': -1
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'output': '',
+                'error': str(e),
+                'return_code': -1
+            }
+    
+    def upload_device(self, device_name, device_ip=None):
+        """Upload firmware to device"""
+        config_file = self.config_path / f"{device_name}.yaml"
+        
+        if not config_file.exists():
+            raise FileNotFoundError(f"Configuration file not found: {config_file}")
+        
+        # Determine upload method
+        if device_ip:
+            # Over-the-air upload
+            cmd = [
+                'esphome', 'upload', str(config_file),
+                '--device', device_ip
+            ]
+        else:
+            # USB upload (will prompt for port)
+            cmd = [
+                'esphome', 'upload', str(config_file)
+            ]
+        
+        try:
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=300,  # 5 minute timeout
+                cwd=str(self.base_path)
+            )
+            
+            return {
+                'success': result.returncode == 0,
+                'output': result.stdout,
+                'error': result.stderr,
+                'return_code': result.returncode
+            }
+            
+        except subprocess.TimeoutExpired:
+            return {
+                'success': False,
+                'output': '',
+                'error': 'Upload timed out after 5 minutes',
+                'return_code': -1
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'output': '',
+                'error': str(e),
+                'return_code': -1
+            }
+    
+    def discover_devices(self, network=None, port=80):
+        """Discover ESPHome devices on the network (defaults to the local /24)"""
+        discovered = []
+        open_hosts = []
+        scanned = 0
+        started = time.perf_counter()
+        
+        # Get local network range
+        import ipaddress
+        
+        try:
+            if network is None:
+                # Get local IP to determine network
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                s.connect(("8.8.8.8", 80))
+                local_ip = s.getsockname()[0]
+                s.close()
+                
+                # Calculate network range
+                network = ipaddress.IPv4Network(f"{local_ip}/24", strict=False)
+            else:
+                network = ipaddress.IPv4Network(network, strict=False)
+            
+            # Scan for devices with the web server port open
+            def scan_ip(ip):
+                try:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.settimeout(1)
+                    result = sock.connect_ex((str(ip), port))
+                    sock.close()
+                    
+                    if result == 0:
+                        open_hosts.append(str(ip))
+                        # Check if it's ESPHome by trying to get the web interface
+                        try:
+                            response = requests.get(f"http://{ip}:{port}", timeout=2)
+                            if 'ESPHome' in response.text or 'esp' in response.text.lower():
+                                # Try to get device info
+                                info_response = requests.get(f"http://{ip}:{port}/text_sensor/device_info", timeout=2)
+                                device_info = info_response.text if info_response.status_code == 200 else "Unknown"
+                                
+                                discovered.append({
+                                    'ip': str(ip),
+                                    'hostname': self._get_hostname(str(ip)),
+                                    'info': device_info,
+                                    'status': 'discovered'
+                                })
+                        except:
+                            pass
+                except:
+                    pass
+            
+            # Use threading for faster scanning
+            threads = []
+            for ip in network.hosts():
+                scanned += 1
+                thread = threading.Thread(target=scan_ip, args=(ip,))
+                threads.append(thread)
+                thread.start()
+                
+                # Limit concurrent threads
+                if len(threads) >= 50:
+                    for t in threads:
+                        t.join()
+                    threads = []
+            
+            # Wait for remaining threads
+            for thread in threads:
+                thread.join()
+                
+        except Exception as e:
+            print(f"Discovery error: {e}")
+        
+        DISCOVERY_DURATION.observe(time.perf_counter() - started)
+        DISCOVERY_HOSTS.set(scanned, 'scanned')
+        DISCOVERY_HOSTS.set(len(open_hosts), 'responding')
+        DISCOVERY_HOSTS.set(len(discovered), 'discovered')
+        return discovered
+    
+    def _get_hostname(self, ip):
+        """Get hostname for IP address"""
+        try:
+            return socket.gethostbyaddr(ip)[0]
+        except:
+            return None
+    
+    def get_device_logs(self, device_name, device_ip=None):
+        """Get real-time logs from device"""
+        config_file = self.config_path / f"{device_name}.yaml"
+        
+        if device_ip:
+            cmd = ['esphome', 'logs', str(config_file), '--device', device_ip]
+        else:
+            cmd = ['esphome', 'logs', str(config_file)]
+        
+        try:
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                cwd=str(self.base_path)
+            )
+            
+            return process
+        except Exception as e:
+            return None
@@ -0,0 +1,361 @@
+# metrics.py - Prometheus-style metrics collectors and /metrics endpoint
+# In-process counters, gauges and histograms. When METRICS_DIR is set, each
+# gunicorn worker periodically writes its samples to <METRICS_DIR>/<pid>.json
+# and a scrape of any worker merges all of them, so totals cover the whole
+# server rather than whichever worker answered. Gauges are summed across
+# workers by default; gauges registered with aggregate='latest' report the
+# value most recently set by any worker instead.
+
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How often each worker flushes its samples to METRICS_DIR
+SNAPSHOT_INTERVAL = 5
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), self._copy(value)] for key, value in self.values.items()]
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), aggregate='sum'):
+        if aggregate not in ('sum', 'latest'):
+            raise ValueError(f"Unknown gauge aggregation {aggregate}")
+        super().__init__(name, documentation, labelnames)
+        self.aggregate = aggregate
+        self.updated = {}
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+            self.updated[key] = time.time()
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.updated[key] = time.time()
+
+    def snapshot(self):
+        if self.aggregate == 'sum':
+            return super().snapshot()
+        # 'latest' samples carry when they were set so the merge can pick the newest
+        with self.lock:
+            return [[list(key), value, self.updated[key]] for key, value in self.values.items()]
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    @contextmanager
+    def track_inprogress(self, *labels):
+        """Increment while the block runs"""
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts (last slot is +Inf), sum, count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the duration of the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+
+class MetricsRegistry:
+    """Named collection of metrics with optional cross-process aggregation"""
+
+    def __init__(self, directory=None):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.snapshot_thread = None
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), aggregate='sum'):
+        """aggregate='sum' adds workers' values (queue depths, sessions); 'latest' keeps the newest (last sweep)"""
+        return self._register(Gauge, name, documentation, labelnames, aggregate=aggregate)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def snapshot(self):
+        """Plain-data copy of every metric in this process"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {
+            metric.name: {
+                'type': metric.kind,
+                'help': metric.documentation,
+                'labels': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', [])),
+                'aggregate': getattr(metric, 'aggregate', 'sum'),
+                'values': metric.snapshot()
+            } for metric in metrics
+        }
+
+    # Multi-process support
+
+    def _write_snapshot(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_snapshots(self, interval=SNAPSHOT_INTERVAL):
+        """Flush this process's samples to the shared directory periodically"""
+        if not self.directory or (self.snapshot_thread and self.snapshot_thread.is_alive()):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+
+        def run():
+            while True:
+                try:
+                    self._write_snapshot()
+                except Exception as e:
+                    print(f"Metrics snapshot error: {e}")
+                time.sleep(interval)
+
+        self.snapshot_thread = threading.Thread(target=run, daemon=True)
+        self.snapshot_thread.start()
+
+    def collect(self):
+        """Samples merged across every worker sharing the directory"""
+        if not self.directory:
+            return self.snapshot()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_snapshot()
+        merged = {}
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, 'archive.json')
+            archive = _read_json(archive_path) or {}
+            archive_changed = False
+
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.json') or filename == 'archive.json':
+                    continue
+                path = os.path.join(self.directory, filename)
+                data = _read_json(path)
+                if data is None:
+                    continue
+                if _pid_alive(filename[:-5]):
+                    _merge(merged, data)
+                else:
+                    # Keep a dead worker's counters and histograms, drop its gauges
+                    _merge(archive, data, include_gauges=False)
+                    os.remove(path)
+                    archive_changed = True
+
+            if archive_changed:
+                with open(archive_path + '.tmp', 'w') as f:
+                    json.dump(archive, f)
+                os.replace(archive_path + '.tmp', archive_path)
+            _merge(merged, archive)
+        return merged
+
+    def exposition(self):
+        """Render metrics in the Prometheus text format"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labelnames = metric['labels']
+            for labels, value, *_ in sorted(metric['values'], key=lambda item: item[0]):
+                pairs = list(zip(labelnames, labels))
+                if metric['type'] == 'histogram':
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(metric['buckets'] + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_labels(pairs + [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(pairs)} {total}")
+                    lines.append(f"{name}_count{_labels(pairs)} {count}")
+                else:
+                    lines.append(f"{name}{_labels(pairs)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(target, source, include_gauges=True):
+    """Add one process's samples into target.
+
+    Counters, histograms and 'sum' gauges are added up; 'latest' gauges keep
+    whichever process set the value most recently.
+    """
+    for name, metric in source.items():
+        if metric['type'] == 'gauge' and not include_gauges:
+            continue
+        latest = metric['type'] == 'gauge' and metric.get('aggregate') == 'latest'
+        existing = target.setdefault(name, dict(metric, values=[]))
+        values = {tuple(entry[0]): entry[1:] for entry in existing['values']}
+        for labels, *sample in metric['values']:
+            key = tuple(labels)
+            value = sample[0]
+            if key not in values:
+                values[key] = [[list(value[0]), value[1], value[2]]] if metric['type'] == 'histogram' else list(sample)
+            elif metric['type'] == 'histogram':
+                current = values[key][0]
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+                current[2] += value[2]
+            elif latest:
+                if sample[1] >= values[key][1]:
+                    values[key] = list(sample)
+            else:
+                values[key][0] += value
+        existing['values'] = [[list(key)] + sample for key, sample in values.items()]
+
+
+# Shared registry for the application
+registry = MetricsRegistry(os.environ.get('METRICS_DIR'))
+
+HTTP_REQUESTS = registry.counter(
+    'smartsites_http_requests_total', 'HTTP requests by route, method and status',
+    ['route', 'method', 'status'])
+HTTP_LATENCY = registry.histogram(
+    'smartsites_http_request_duration_seconds', 'HTTP request latency by route',
+    ['route', 'method'])
+DB_QUERIES = registry.histogram(
+    'smartsites_db_queries_per_request', 'Database queries executed per HTTP request',
+    ['route'], buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+BACKGROUND_THREADS = registry.gauge(
+    'smartsites_background_threads_active', 'Background threads currently running', ['task'])
+
+
+def init_metrics(app, db):
+    """Instrument Flask routes and SQLAlchemy queries and serve /metrics"""
+    from flask import Response, g, has_request_context, request
+    from sqlalchemy import event
+
+    @app.before_request
+    def _start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+
+    @app.after_request
+    def _record_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_LATENCY.observe(time.perf_counter() - started, route, request.method)
+            HTTP_REQUESTS.inc(route, request.method, response.status_code)
+            DB_QUERIES.observe(g.pop('metrics_queries', 0), route)
+        return response
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'metrics_queries' in g:
+            g.metrics_queries += 1
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', _count_query)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(registry.exposition(), mimetype='text/plain; version=0.0.4')
+
+    registry.start_snapshots()
+    return registry
@@ -0,0 +1,510 @@
+# native_api.py - Pooled ESPHome native API sessions
+# Keeps one persistent session per device on a shared asyncio loop running in
+# a background thread. Each session is an aioesphomeapi APIClient carrying the
+# state subscription, commands and keepalive pings over a single connection,
+# so reads are served from the subscribed state instead of a fresh HTTP
+# request to the device. Sessions that are subscribed reconnect with
+# exponential backoff; on-demand sessions are closed when idle or evicted
+# when the pool is full.
+
+import asyncio
+import base64
+import concurrent.futures
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from aioesphomeapi import (APIClient, APIConnectionError, BinarySensorInfo, ButtonInfo, InvalidAuthAPIError,
+                           InvalidEncryptionKeyAPIError, RequiresEncryptionAPIError, SensorInfo, SwitchInfo)
+
+from backend.services.metrics import registry
+
+DEFAULT_PORT = 6053
+
+# Sessions held open at once, across all devices
+MAX_CONNECTIONS = 64
+
+# Seconds between keepalive pings, and before an unused on-demand session closes
+KEEPALIVE_INTERVAL = 20
+IDLE_TIMEOUT = 300
+
+# Reconnect backoff bounds in seconds (doubled per failure, with jitter)
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+
+# Entity kinds the pool exposes; others a device lists are ignored
+ENTITY_TYPES = {
+    BinarySensorInfo: 'binary_sensor',
+    SensorInfo: 'sensor',
+    SwitchInfo: 'switch',
+    ButtonInfo: 'button'
+}
+
+NATIVE_API_SESSIONS = registry.gauge(
+    'smartsites_native_api_sessions', 'Native API sessions by state', ['state'])
+NATIVE_API_CONNECTS = registry.counter(
+    'smartsites_native_api_connects_total', 'Native API connection attempts by outcome', ['outcome'])
+NATIVE_API_COMMANDS = registry.histogram(
+    'smartsites_native_api_command_seconds', 'Native API command latency, send to state echo', ['type'])
+
+
+class NativeAPIError(Exception):
+    """A device could not be reached or rejected a request"""
+
+
+class PoolExhausted(NativeAPIError):
+    """Every pooled session is pinned by a subscription"""
+
+
+class CommandError(NativeAPIError):
+    """The device has no such entity or the command is incomplete"""
+
+
+def parse_switch_state(state):
+    """True/False, or "ON"/"OFF"/"true"/"false" in any case; anything else is a CommandError"""
+    if isinstance(state, bool):
+        return state
+    if isinstance(state, str) and state.strip().lower() in ('on', 'true'):
+        return True
+    if isinstance(state, str) and state.strip().lower() in ('off', 'false'):
+        return False
+    raise CommandError(f"Invalid switch state {state!r}; use true/false or \"ON\"/\"OFF\"")
+
+
+def decode_psk(key):
+    """ESPHome encryption keys are 32 random bytes, base64 encoded"""
+    try:
+        psk = base64.b64decode(key, validate=True)
+    except ValueError:
+        psk = b''
+    if len(psk) != 32:
+        raise NativeAPIError('API encryption key must be 32 bytes, base64 encoded')
+    return psk
+
+
+def _describe(error):
+    if isinstance(error, InvalidEncryptionKeyAPIError):
+        return 'Invalid encryption key'
+    if isinstance(error, RequiresEncryptionAPIError):
+        return 'Device requires an encryption key'
+    if isinstance(error, InvalidAuthAPIError):
+        return 'Invalid API password'
+    if isinstance(error, asyncio.TimeoutError):
+        return 'Timed out'
+    return str(error) or type(error).__name__
+
+
+# Sessions
+
+class DeviceSession:
+    """One persistent, multiplexed API connection to a device"""
+
+    def __init__(self, pool, name, host, port=DEFAULT_PORT):
+        self.pool = pool
+        self.name = name
+        self.host = host
+        self.port = port
+        self.persistent = False
+        self.connected = False
+        self.closed = False
+        self.device_info = {}
+        self.entities = {}
+        self.keys = {}
+        self.states = {}
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.client = None
+        self.idle_task = None
+        self.connect_lock = asyncio.Lock()
+        self.initial_states = None
+        self.awaiting_states = set()
+        self.state_waiters = []
+        self.reconnect_task = None
+
+    # Connection lifecycle
+
+    async def ensure_connected(self):
+        self.last_used = time.monotonic()
+        if self.connected:
+            return
+        async with self.connect_lock:
+            if self.connected:
+                return
+            wait = self.retry_at - time.monotonic()
+            if wait > 0:
+                raise NativeAPIError(f"{self.name}: unreachable, retrying in {wait:.0f}s ({self.last_error})")
+            await self._attempt()
+
+    async def _attempt(self):
+        # A timeout rather than wait_for: aioesphomeapi turns the cancellation into its own error
+        deadline = asyncio.timeout(self.pool.connect_timeout)
+        try:
+            async with deadline:
+                await self._connect()
+        except (OSError, asyncio.TimeoutError, APIConnectionError) as e:
+            await self._teardown()
+            self.failures += 1
+            delay = min(self.pool.max_backoff, self.pool.min_backoff * 2 ** (self.failures - 1))
+            self.retry_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            self.last_error = 'Timed out' if deadline.expired() else _describe(e)
+            NATIVE_API_CONNECTS.inc('failed')
+            raise NativeAPIError(f"{self.name}: {self.last_error}") from e
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        NATIVE_API_CONNECTS.inc('success')
+        self.pool._update_gauges()
+
+    async def _connect(self):
+        # APIClient sends the keepalive pings and answers the device's own
+        client = self.client = APIClient(self.host, self.port, self.pool.password,
+                                         client_info=self.pool.client_info, keepalive=self.pool.keepalive,
+                                         noise_psk=self.pool.encryption_key)
+        await client.connect(on_stop=partial(self._on_stop, client), login=True)
+
+        info = await client.device_info()
+        self.device_info = {
+            'name': info.name,
+            'mac_address': info.mac_address,
+            'esphome_version': info.esphome_version,
+            'compilation_time': info.compilation_time,
+            'model': info.model
+        }
+
+        entity_infos, _ = await client.list_entities_services()
+        self.entities = {
+            entity.key: {
+                'object_id': entity.object_id,
+                'name': entity.name,
+                'type': ENTITY_TYPES[type(entity)],
+                'unit': entity.unit_of_measurement if isinstance(entity, SensorInfo) else None
+            } for entity in entity_infos if type(entity) in ENTITY_TYPES
+        }
+        self.keys = {entity['object_id']: key for key, entity in self.entities.items()}
+        self.states = {object_id: state for object_id, state in self.states.items() if object_id in self.keys}
+
+        # Devices answer with the current state of every entity, then push changes
+        self.awaiting_states = {entity['object_id'] for entity in self.entities.values()
+                                if entity['type'] != 'button'}
+        self.initial_states = asyncio.get_running_loop().create_future()
+        if not self.awaiting_states:
+            self.initial_states.set_result(True)
+        await client.subscribe_states(self._handle_state)
+
+        self.connected = True
+        self.idle_task = asyncio.ensure_future(self._idle_watch())
+
+    async def _on_stop(self, client, expected_disconnect):
+        # Stops of a client this session already tore down are not news
+        if client is self.client:
+            await self._connection_lost('Device closed the session' if expected_disconnect else 'Connection lost')
+
+    async def _idle_watch(self):
+        while True:
+            await asyncio.sleep(self.pool.keepalive)
+            if not self.persistent and time.monotonic() - self.last_used > self.pool.idle_timeout:
+                await self.close()
+                self.pool._forget(self)
+                return
+
+    async def _teardown(self):
+        if self.idle_task is not None and self.idle_task is not asyncio.current_task():
+            self.idle_task.cancel()
+        self.idle_task = None
+        client, self.client = self.client, None
+        self.connected = False
+        if self.initial_states is not None and not self.initial_states.done():
+            self.initial_states.set_result(False)
+        for future, _, _ in self.state_waiters:
+            if not future.done():
+                future.set_exception(NativeAPIError(f"{self.name}: connection lost"))
+        self.state_waiters = []
+        if client is not None:
+            # Sends a disconnect request if the session is up, without waiting for the reply
+            await client.disconnect(force=True)
+
+    async def _connection_lost(self, reason):
+        if not self.connected:
+            return
+        self.last_error = reason
+        print(f"Native API session to {self.name} lost: {self.last_error}")
+        await self._teardown()
+        self.pool._update_gauges()
+        if self.persistent and not self.closed:
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        while self.persistent and not self.closed and not self.connected:
+            await asyncio.sleep(max(0.0, self.retry_at - time.monotonic()))
+            async with self.connect_lock:
+                if self.connected or self.closed:
+                    return
+                try:
+                    await self._attempt()
+                except NativeAPIError:
+                    continue
+
+    async def close(self):
+        self.closed = True
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+            await asyncio.gather(self.reconnect_task, return_exceptions=True)
+        await self._teardown()
+        self.pool._update_gauges()
+
+    # State and commands
+
+    def _handle_state(self, state):
+        entity = self.entities.get(state.key)
+        if entity is None:
+            return
+        # Switch states have no missing_state flag; sensors report one until their first reading
+        missing = getattr(state, 'missing_state', False)
+        value = None if missing else state.state
+        self.states[entity['object_id']] = value
+        if self.awaiting_states:
+            self.awaiting_states.discard(entity['object_id'])
+            if not self.awaiting_states and not self.initial_states.done():
+                self.initial_states.set_result(True)
+
+        for waiter in list(self.state_waiters):
+            future, object_id, expected = waiter
+            if object_id == entity['object_id'] and value == expected:
+                self.state_waiters.remove(waiter)
+                if not future.done():
+                    future.set_result(value)
+        if not missing:
+            self.pool._notify(self.name, entity, value)
+
+    async def wait_initial_states(self):
+        """Wait for the state burst that follows a (re)connect"""
+        if self.initial_states is not None and not self.initial_states.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.initial_states), self.pool.command_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def snapshot(self):
+        return {
+            entity['object_id']: {
+                'name': entity['name'],
+                'type': entity['type'],
+                'unit': entity['unit'],
+                'state': self.states.get(entity['object_id'])
+            } for entity in self.entities.values()
+        }
+
+    def _entity_key(self, object_id, entity_type):
+        key = self.keys.get(object_id)
+        if key is None or self.entities[key]['type'] != entity_type:
+            raise CommandError(f"{self.name} has no {entity_type} '{object_id}'")
+        return key
+
+    async def _send(self, command, *args):
+        try:
+            await command(*args)
+        except APIConnectionError as e:
+            raise NativeAPIError(f"{self.name}: {_describe(e)}") from e
+
+    async def switch(self, object_id, state, wait=True):
+        await self.ensure_connected()
+        key = self._entity_key(object_id, 'switch')
+        started = time.perf_counter()
+        future = None
+        if wait and self.states.get(object_id) != bool(state):
+            future = asyncio.get_running_loop().create_future()
+            self.state_waiters.append((future, object_id, bool(state)))
+        await self._send(self.client.switch_command, key, bool(state))
+        if future is not None:
+            try:
+                await asyncio.wait_for(future, self.pool.command_timeout)
+            except asyncio.TimeoutError:
+                raise NativeAPIError(f"{self.name}: '{object_id}' did not report the new state")
+        NATIVE_API_COMMANDS.observe(time.perf_counter() - started, 'switch')
+        return self.states.get(object_id)
+
+    async def press(self, object_id):
+        await self.ensure_connected()
+        key = self._entity_key(object_id, 'button')
+        await self._send(self.client.button_command, key)
+        return None
+
+    def status(self):
+        return {
+            'name': self.name,
+            'host': self.host,
+            'connected': self.connected,
+            'subscribed': self.persistent,
+            'entities': len(self.entities),
+            'failures': self.failures,
+            'retry_in': max(0, round(self.retry_at - time.monotonic(), 1)) if self.retry_at else 0,
+            'last_error': self.last_error,
+            'device_info': self.device_info
+        }
+
+
+class NativeAPIPool:
+    """Bounded pool of device sessions with a blocking facade for Flask and worker threads"""
+
+    def __init__(self, encryption_key=None, password='', port=DEFAULT_PORT, max_connections=MAX_CONNECTIONS,
+                 connect_timeout=10, command_timeout=5, keepalive=KEEPALIVE_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT, min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+                 client_info='smart-sites'):
+        if encryption_key:
+            decode_psk(encryption_key)
+        self.encryption_key = encryption_key or None
+        self.password = password
+        self.port = port
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.client_info = client_info
+        self.sessions = OrderedDict()
+        self.listeners = []
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """Register callback(device_name, entity, state); runs on the pool's loop thread"""
+        self.listeners.append(callback)
+
+    def _notify(self, device_name, entity, state):
+        for callback in self.listeners:
+            try:
+                callback(device_name, entity, state)
+            except Exception as e:
+                print(f"Native API listener error: {e}")
+
+    # Event loop thread
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='native-api', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+        self._call(self._close_all(), timeout=self.connect_timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.thread = None
+
+    def _call(self, coro, timeout=None):
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout if timeout is not None else self.connect_timeout + self.command_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise NativeAPIError('Timed out waiting for the device')
+
+    async def _close_all(self):
+        for session in list(self.sessions.values()):
+            await session.close()
+        self.sessions.clear()
+
+    # Pool management (loop thread only)
+
+    async def _session(self, name, host, port=None):
+        port = port or self.port
+        session = self.sessions.get(name)
+        if session is not None:
+            if (session.host, session.port) != (host, port):
+                await session.close()
+                session = None
+            else:
+                self.sessions.move_to_end(name)
+                return session
+
+        if len(self.sessions) >= self.max_connections:
+            victim = next((s for s in self.sessions.values() if not s.persistent), None)
+            if victim is None:
+                raise PoolExhausted(f"All {self.max_connections} native API sessions are subscribed")
+            await victim.close()
+            self._forget(victim)
+
+        session = self.sessions[name] = DeviceSession(self, name, host, port)
+        return session
+
+    def _forget(self, session):
+        if self.sessions.get(session.name) is session:
+            del self.sessions[session.name]
+        self._update_gauges()
+
+    def _update_gauges(self):
+        connected = sum(1 for session in self.sessions.values() if session.connected)
+        NATIVE_API_SESSIONS.set(connected, 'connected')
+        NATIVE_API_SESSIONS.set(len(self.sessions) - connected, 'disconnected')
+
+    async def _subscribe(self, name, host, port):
+        session = await self._session(name, host, port)
+        session.persistent = True
+        session.closed = False
+        if not session.connected:
+            session.schedule_reconnect()
+        return session.status()
+
+    async def _unsubscribe(self, name):
+        session = self.sessions.get(name)
+        if session is not None:
+            await session.close()
+            self._forget(session)
+
+    async def _states(self, name, host, port):
+        session = await self._session(name, host, port)
+        await session.ensure_connected()
+        await session.wait_initial_states()
+        return session.snapshot()
+
+    async def _command(self, name, host, port, object_id, state):
+        session = await self._session(name, host, port)
+        await session.ensure_connected()
+        entity_type = session.entities[session.keys[object_id]]['type'] if object_id in session.keys else None
+        if entity_type == 'button':
+            return await session.press(object_id)
+        if state is None:
+            raise CommandError(f"A state is required to switch '{object_id}'")
+        return await session.switch(object_id, parse_switch_state(state))
+
+    # Blocking facade
+
+    def subscribe(self, name, host, port=None):
+        """Keep a session open to the device and reconnect it whenever it drops"""
+        return self._call(self._subscribe(name, host, port))
+
+    def unsubscribe(self, name):
+        self._call(self._unsubscribe(name))
+
+    def get_states(self, name, host, port=None):
+        """Current state of every entity, from the live subscription"""
+        return self._call(self._states(name, host, port))
+
+    def command(self, name, host, object_id, state=None, port=None):
+        """Turn a switch on/off (returns the echoed state) or press a button"""
+        return self._call(self._command(name, host, port, object_id, state))
+
+    def status(self):
+        if not self.thread:
+            return []
+
+        async def collect():
+            return [session.status() for session in self.sessions.values()]
+        return self._call(collect())
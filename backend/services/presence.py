@@ -0,0 +1,248 @@
+# presence.py - In-memory device presence tracking with timer-wheel offline detection
+# Liveness is tracked in memory from MQTT availability and heartbeat messages.
+# Offline transitions come from a hashed timer wheel, so the cost is O(1) per
+# heartbeat and no table scans are needed. Devices whose last availability
+# message was 'online' are exempt from the timeout: they may only publish on
+# state changes (motion, door sensors), and the broker publishes their last
+# will ('offline') if the connection drops. A write-behind flush persists only
+# status changes and coalesced last_seen values.
+
+import threading
+import time
+from datetime import datetime, timezone
+
+# Seconds without a message before a device is considered offline
+DEFAULT_TIMEOUT = 90
+
+# last_seen is only re-written once it has moved by at least this many seconds
+LAST_SEEN_RESOLUTION = 60
+
+# Seconds between write-behind flushes
+FLUSH_INTERVAL = 5
+
+
+class TimerWheel:
+    """Hashed timer wheel holding at most one entry per key.
+
+    Rescheduling only updates the key's deadline. The stale wheel entry is
+    checked lazily when its slot comes round and moved to the slot for the
+    new deadline, so frequent heartbeats never touch the wheel.
+    """
+
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.scheduled = set()
+        self.current_tick = int((now if now is not None else time.time()) / tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def _slot(self, deadline):
+        return self.slots[int(deadline / self.tick) % len(self.slots)]
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        if key not in self.scheduled:
+            self.scheduled.add(key)
+            self._slot(max(deadline, (self.current_tick + 1) * self.tick)).add(key)
+
+    def cancel(self, key):
+        # The wheel entry is dropped lazily when its slot fires
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        """Move the wheel up to `now` and return keys whose deadline passed"""
+        expired = []
+        target_tick = int(now / self.tick)
+        # A long pause only needs one full turn, every slot gets visited once
+        start_tick = max(self.current_tick + 1, target_tick - len(self.slots) + 1)
+        for tick in range(start_tick, target_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            pending = list(slot)
+            slot.clear()
+            for key in pending:
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    self.scheduled.discard(key)
+                elif deadline <= now:
+                    del self.deadlines[key]
+                    self.scheduled.discard(key)
+                    expired.append(key)
+                else:
+                    self._slot(max(deadline, (tick + 1) * self.tick)).add(key)
+        self.current_tick = max(self.current_tick, target_tick)
+        return expired
+
+
+class PresenceTracker:
+    """Tracks device liveness in memory and writes changes behind"""
+
+    def __init__(self, flush_callback=None, timeout=DEFAULT_TIMEOUT, tick=1.0,
+                 flush_interval=FLUSH_INTERVAL, last_seen_resolution=LAST_SEEN_RESOLUTION):
+        self.flush_callback = flush_callback
+        self.timeout = timeout
+        self.tick = tick
+        self.flush_interval = flush_interval
+        self.last_seen_resolution = last_seen_resolution
+        self.wheel = TimerWheel(tick=tick)
+        self.status = {}
+        self.last_seen = {}
+        self.flushed_last_seen = {}
+        self.dirty = {}
+        # Devices whose last availability message was 'online' (covered by their LWT)
+        self.announced = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """Register callback(device_name, status) for online/offline transitions"""
+        self.listeners.append(callback)
+
+    def track(self, device_name, status, last_seen=None, now=None):
+        """Seed state from the database without marking anything dirty"""
+        now = now if now is not None else time.time()
+        seen = last_seen
+        if isinstance(seen, datetime):
+            # Stored values are naive UTC (see flush), not local time
+            seen = seen.replace(tzinfo=timezone.utc).timestamp()
+        with self.lock:
+            self.status[device_name] = status
+            if seen is not None:
+                self.last_seen[device_name] = seen
+                self.flushed_last_seen[device_name] = seen
+            if status == 'online':
+                # Give silent devices one full timeout before marking them offline
+                self.wheel.schedule(device_name, now + self.timeout)
+
+    def heartbeat(self, device_name, timestamp=None):
+        """Record any message from a device"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        transition = False
+        with self.lock:
+            self.last_seen[device_name] = timestamp
+            if device_name not in self.announced:
+                self.wheel.schedule(device_name, timestamp + self.timeout)
+            changes = None
+            if self.status.get(device_name) != 'online':
+                self.status[device_name] = 'online'
+                changes = self.dirty.setdefault(device_name, {})
+                changes['status'] = 'online'
+                transition = True
+            flushed = self.flushed_last_seen.get(device_name)
+            if transition or flushed is None or timestamp - flushed >= self.last_seen_resolution:
+                if changes is None:
+                    changes = self.dirty.setdefault(device_name, {})
+                changes['last_seen'] = timestamp
+        if transition:
+            self._notify(device_name, 'online')
+
+    def availability(self, device_name, payload, timestamp=None):
+        """Handle an ESPHome availability message (birth 'online' / will 'offline')"""
+        if payload == 'online':
+            with self.lock:
+                self.announced.add(device_name)
+                self.wheel.cancel(device_name)
+            self.heartbeat(device_name, timestamp)
+        elif payload == 'offline':
+            with self.lock:
+                self.announced.discard(device_name)
+                self.wheel.cancel(device_name)
+                changed = self._mark_offline(device_name)
+            if changed:
+                self._notify(device_name, 'offline')
+
+    def _mark_offline(self, device_name):
+        if self.status.get(device_name) == 'offline':
+            return False
+        self.status[device_name] = 'offline'
+        self.dirty.setdefault(device_name, {})['status'] = 'offline'
+        return True
+
+    def get_status(self, device_name):
+        return self.status.get(device_name)
+
+    def counts(self):
+        with self.lock:
+            online = sum(1 for status in self.status.values() if status == 'online')
+            return {'online': online, 'offline': len(self.status) - online}
+
+    def expire(self, now=None):
+        """Advance the timer wheel and mark timed-out devices offline"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            expired = [name for name in self.wheel.advance(now) if self._mark_offline(name)]
+        for name in expired:
+            self._notify(name, 'offline')
+        return expired
+
+    def flush(self):
+        """Hand pending changes to the flush callback (write-behind)"""
+        with self.lock:
+            if not self.dirty:
+                return 0
+            pending, self.dirty = self.dirty, {}
+
+        changes = {}
+        for name, change in pending.items():
+            changes[name] = dict(change)
+            if 'last_seen' in change:
+                changes[name]['last_seen'] = datetime.utcfromtimestamp(change['last_seen'])
+
+        try:
+            if self.flush_callback:
+                self.flush_callback(changes)
+        except Exception as e:
+            print(f"Presence flush failed: {e}")
+            with self.lock:
+                # Re-queue, keeping anything newer that arrived meanwhile
+                for name, change in pending.items():
+                    merged = dict(change)
+                    merged.update(self.dirty.get(name, {}))
+                    self.dirty[name] = merged
+            return 0
+
+        with self.lock:
+            for name, change in pending.items():
+                if 'last_seen' in change:
+                    self.flushed_last_seen[name] = change['last_seen']
+        return len(changes)
+
+    def _notify(self, device_name, status):
+        for callback in self.listeners:
+            try:
+                callback(device_name, status)
+            except Exception as e:
+                print(f"Presence listener error: {e}")
+
+    def start(self):
+        """Run expiry ticks and periodic flushes in a background thread"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='presence-tracker', daemon=True)
+        self.thread.start()
+        print("Presence tracker started")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    def _run(self):
+        next_flush = time.time() + self.flush_interval
+        while self.running:
+            time.sleep(self.tick)
+            try:
+                self.expire()
+                if time.time() >= next_flush:
+                    self.flush()
+                    next_flush = time.time() + self.flush_interval
+            except Exception as e:
+                print(f"Presence tracker error: {e}")
@@ -0,0 +1,367 @@
+# profiling.py - On-demand request profiling and slow-request capture
+# A sampling profiler for the Flask app. It samples one request when that
+# request carries an `X-Profile` header with the profiling token, every
+# request while an admin-enabled window is open (in every worker, the window
+# deadline lives in a file under the profile directory), and any request that runs
+# longer than PROFILE_SLOW_THRESHOLD seconds. Stack samples are written in
+# the collapsed "folded" format used by flamegraph.pl and speedscope, next to
+# a JSON summary holding the SQL the request executed.
+
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+# Seconds between stack samples while a request is being profiled
+SAMPLE_INTERVAL = 0.005
+
+# Profiles kept on disk before the oldest are removed
+MAX_PROFILES = 200
+
+# SQL statements recorded per request
+MAX_STATEMENTS = 200
+
+# File holding the profiling window deadline, shared by all workers
+WINDOW_FILE = '.window'
+
+# Seconds between checks of the window file
+WINDOW_CHECK_INTERVAL = 1.0
+
+
+class _RequestState:
+    def __init__(self, method, path, profile):
+        self.method = method
+        self.path = path
+        self.route = path
+        self.started = time.perf_counter()
+        self.started_at = datetime.utcnow()
+        self.profile = profile
+        self.slow = False
+        self.samples = Counter()
+        self.statements = []
+        self.query_started = None
+
+    @property
+    def sampling(self):
+        return self.profile or self.slow
+
+
+class RequestProfiler:
+    """Samples stacks of selected in-flight requests from a helper thread"""
+
+    def __init__(self, output_dir, token=None, slow_threshold=None, interval=SAMPLE_INTERVAL,
+                 max_profiles=MAX_PROFILES):
+        self.output_dir = Path(output_dir)
+        self.token = token
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self.max_profiles = max_profiles
+        self.window_until = 0.0
+        self.window_checked = 0.0
+        self.window_stamp = None
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    # Request lifecycle
+
+    def should_track(self, header_value):
+        """Whether a request needs any bookkeeping at all"""
+        return bool(self.slow_threshold) or self._requested(header_value) or time.time() < self._window_until()
+
+    def _requested(self, header_value):
+        return bool(header_value) and bool(self.token) and _matches(header_value, self.token)
+
+    def begin(self, method, path, header_value=None):
+        profile = self._requested(header_value) or time.time() < self._window_until()
+        state = _RequestState(method, path, profile)
+        with self.lock:
+            self.active[threading.get_ident()] = state
+        self._ensure_thread()
+        if profile:
+            self.wakeup.set()
+        return state
+
+    def current(self):
+        return self.active.get(threading.get_ident())
+
+    def end(self, status_code=None, route=None):
+        """Finish the current request and write a profile if it was sampled"""
+        with self.lock:
+            state = self.active.pop(threading.get_ident(), None)
+        if state is None:
+            return None
+        duration = time.perf_counter() - state.started
+        if route:
+            state.route = route
+        slow = bool(self.slow_threshold) and duration >= self.slow_threshold
+        if not (state.profile or slow):
+            return None
+        try:
+            return self._write(state, duration, status_code, 'slow' if slow and not state.profile else 'profile')
+        except OSError as e:
+            print(f"Failed to write request profile: {e}")
+            return None
+
+    # SQL capture
+
+    def before_query(self):
+        state = self.current()
+        if state is not None:
+            state.query_started = time.perf_counter()
+
+    def after_query(self, statement):
+        state = self.current()
+        if state is None or state.query_started is None or len(state.statements) >= MAX_STATEMENTS:
+            return
+        state.statements.append({
+            'sql': statement,
+            'duration_ms': round((time.perf_counter() - state.query_started) * 1000, 3),
+            'offset_ms': round((state.query_started - state.started) * 1000, 3)
+        })
+        state.query_started = None
+
+    # Window control
+
+    def _window_path(self):
+        return self.output_dir / WINDOW_FILE
+
+    def _window_until(self):
+        """Window deadline, re-read from the shared file at most once per WINDOW_CHECK_INTERVAL"""
+        now = time.monotonic()
+        if now - self.window_checked < WINDOW_CHECK_INTERVAL:
+            return self.window_until
+        self.window_checked = now
+        try:
+            stat = os.stat(self._window_path())
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if stamp != self.window_stamp:
+                self.window_until = float(self._window_path().read_text())
+                self.window_stamp = stamp
+        except FileNotFoundError:
+            self.window_until = 0.0
+            self.window_stamp = None
+        except (OSError, ValueError) as e:
+            print(f"Failed to read profiling window: {e}")
+        return self.window_until
+
+    def _set_window(self, deadline):
+        # Atomic replace, other workers never read a half-written deadline
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        temp_path = self._window_path().with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_text(repr(deadline))
+        os.replace(temp_path, self._window_path())
+        self.window_until = deadline
+        self.window_checked = 0.0
+
+    def enable_window(self, seconds):
+        """Profile every request in every worker for the next `seconds`"""
+        self._set_window(time.time() + seconds)
+        self._ensure_thread()
+
+    def disable_window(self):
+        self._set_window(0.0)
+
+    def status(self):
+        return {
+            'window_active': time.time() < self._window_until(),
+            'window_remaining': max(0, round(self._window_until() - time.time(), 1)),
+            'slow_threshold': self.slow_threshold,
+            'header_enabled': bool(self.token),
+            'in_flight': len(self.active),
+            'profiles': self.list_profiles()
+        }
+
+    # Sampling thread
+
+    def _ensure_thread(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        # Slow requests are noticed at a quarter of the threshold granularity
+        idle_wait = self.slow_threshold / 4.0 if self.slow_threshold else 1.0
+        own_ident = threading.get_ident()
+        while True:
+            now = time.perf_counter()
+            with self.lock:
+                states = list(self.active.items())
+            sampling = []
+            for ident, state in states:
+                if not state.sampling and self.slow_threshold and now - state.started >= self.slow_threshold:
+                    state.slow = True
+                if state.sampling:
+                    sampling.append((ident, state))
+
+            if sampling:
+                frames = sys._current_frames()
+                for ident, state in sampling:
+                    frame = frames.get(ident)
+                    if frame is not None and ident != own_ident:
+                        state.samples[_collapse(frame)] += 1
+                del frames
+                time.sleep(self.interval)
+            else:
+                if not self.slow_threshold:
+                    with self.lock:
+                        if not self.active and time.time() >= self.window_until:
+                            self.thread = None
+                            return
+                self.wakeup.wait(idle_wait)
+                self.wakeup.clear()
+
+    # Output
+
+    def _write(self, state, duration, status_code, reason):
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        safe_route = ''.join(c if c.isalnum() else '_' for c in state.route).strip('_') or 'root'
+        name = f"{state.started_at.strftime('%Y%m%dT%H%M%S%f')}_{state.method}_{safe_route}_{int(duration * 1000)}ms"
+
+        with open(self.output_dir / f"{name}.folded", 'w') as f:
+            for stack, count in state.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        with open(self.output_dir / f"{name}.json", 'w') as f:
+            json.dump({
+                'name': name,
+                'reason': reason,
+                'method': state.method,
+                'path': state.path,
+                'route': state.route,
+                'status': status_code,
+                'started_at': state.started_at.isoformat(),
+                'duration_ms': round(duration * 1000, 3),
+                'sample_interval_ms': self.interval * 1000,
+                'samples': sum(state.samples.values()),
+                'statements': state.statements
+            }, f, indent=2)
+
+        self._prune()
+        return name
+
+    def _prune(self):
+        summaries = sorted(self.output_dir.glob('*.json'))
+        for summary in summaries[:max(0, len(summaries) - self.max_profiles)]:
+            summary.unlink(missing_ok=True)
+            summary.with_suffix('.folded').unlink(missing_ok=True)
+
+    def list_profiles(self):
+        if not self.output_dir.exists():
+            return []
+        return [path.stem for path in sorted(self.output_dir.glob('*.json'), reverse=True)]
+
+    def profile_path(self, name, kind):
+        if kind not in ('folded', 'json') or '/' in name or name.startswith('.'):
+            return None
+        path = self.output_dir / f"{name}.{kind}"
+        if path.resolve().parent != self.output_dir.resolve():
+            return None
+        return path if path.exists() else None
+
+
+def _matches(value, token):
+    """Constant-time token comparison"""
+    return hmac.compare_digest(value.encode(), token.encode())
+
+
+def _collapse(frame):
+    """Render a frame's stack root-first as `func (file:line);...`"""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    parts.reverse()
+    return ';'.join(parts)
+
+
+def init_profiling(app, db):
+    """Register profiling hooks and admin endpoints on the Flask app"""
+    from flask import abort, g, jsonify, request, send_file
+    from sqlalchemy import event
+
+    threshold = os.environ.get('PROFILE_SLOW_THRESHOLD')
+    profiler = RequestProfiler(
+        os.environ.get('PROFILE_DIR', 'data/profiles'),
+        token=os.environ.get('PROFILING_TOKEN'),
+        slow_threshold=float(threshold) if threshold else None
+    )
+
+    @app.before_request
+    def _start_profiling():
+        header = request.headers.get('X-Profile')
+        if profiler.should_track(header):
+            g.profiling = profiler.begin(request.method, request.path, header)
+
+    @app.teardown_request
+    def _finish_profiling(exc):
+        if g.pop('profiling', None) is not None:
+            route = request.url_rule.rule if request.url_rule else None
+            profiler.end(getattr(g, 'response_status', 500 if exc else None), route)
+
+    @app.after_request
+    def _remember_status(response):
+        state = g.get('profiling')
+        if state is not None:
+            g.response_status = response.status_code
+            if state.profile:
+                response.headers['X-Profile-Captured'] = 'true'
+        return response
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    def _profile_query_start(conn, cursor, statement, parameters, context, executemany):
+        if profiler.active:
+            profiler.before_query()
+
+    def _profile_query_end(conn, cursor, statement, parameters, context, executemany):
+        if profiler.active:
+            profiler.after_query(statement)
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', _profile_query_start)
+        event.listen(engine, 'after_cursor_execute', _profile_query_end)
+
+    def _authorized():
+        # Header only, in every mode: a query string token ends up in access logs and browser history
+        token = request.headers.get('X-Profile-Token')
+        return bool(profiler.token) and bool(token) and _matches(token, profiler.token)
+
+    @app.route('/api/admin/profiling', methods=['GET', 'POST', 'DELETE'])
+    def admin_profiling():
+        """Inspect profiling state, open a profiling window or close it"""
+        if not _authorized():
+            abort(403)
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            try:
+                seconds = min(float(data.get('duration', 60)), 3600)
+            except (TypeError, ValueError):
+                seconds = None
+            if seconds is None or not seconds > 0:
+                return jsonify({'error': 'Duration must be a positive number of seconds'}), 400
+            profiler.enable_window(seconds)
+        elif request.method == 'DELETE':
+            profiler.disable_window()
+        return jsonify(profiler.status())
+
+    @app.route('/api/admin/profiling/<name>.<kind>')
+    def download_profile(name, kind):
+        """Download a captured profile (.folded stacks or .json summary)"""
+        if not _authorized():
+            abort(403)
+        path = profiler.profile_path(name, kind)
+        if path is None:
+            abort(404)
+        return send_file(path.resolve(), mimetype='application/json' if kind == 'json' else 'text/plain')
+
+    return profiler
@@ -0,0 +1,154 @@
+# queries.py - Filtering, sorting and keyset pagination for list endpoints
+# plus materialized child counts kept up to date by SQLAlchemy mapper events.
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, event, func, inspect, or_, select
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class QueryError(ValueError):
+    """Invalid filter, sort or cursor parameter"""
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise QueryError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != 2:
+        raise QueryError('Invalid cursor')
+    last_value, last_id = values
+    # A tampered cursor must not reach the database as a list/dict bind parameter
+    if not isinstance(last_value, (str, int, float, type(None))) or isinstance(last_id, bool) \
+            or not isinstance(last_id, int):
+        raise QueryError('Invalid cursor')
+    return values
+
+
+def apply_filters(query, args, filters):
+    """Filter by request args; comma-separated values match any of them.
+
+    `filters` maps an argument name to a column, or to a (column, converter)
+    pair for non-string columns.
+    """
+    for name, spec in filters.items():
+        raw = args.get(name)
+        if not raw:
+            continue
+        column, convert = spec if isinstance(spec, tuple) else (spec, str)
+        try:
+            values = [convert(value) for value in raw.split(',') if value != '']
+        except ValueError:
+            raise QueryError(f"Invalid value for {name}")
+        query = query.filter(column == values[0] if len(values) == 1 else column.in_(values))
+    return query
+
+
+def keyset_paginate(query, args, sorts, id_column, default_sort):
+    """Return (rows, pagination) for one page ordered by the requested sort.
+
+    Pages are addressed by an opaque cursor holding the last row's sort value
+    and id, so every page is an index range scan, however deep it is.
+    """
+    sort = args.get('sort', default_sort)
+    descending = sort.startswith('-')
+    sort_column = sorts.get(sort.lstrip('-'))
+    if sort_column is None:
+        raise QueryError(f"Cannot sort by {sort.lstrip('-')}; use one of {', '.join(sorted(sorts))}")
+
+    try:
+        limit = min(max(int(args.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError:
+        raise QueryError('Invalid limit')
+
+    cursor = args.get('cursor')
+    if cursor:
+        last_value, last_id = decode_cursor(cursor)
+        if isinstance(sort_column.type, DateTime) and last_value is not None:
+            try:
+                last_value = datetime.fromisoformat(last_value)
+            except (TypeError, ValueError):
+                raise QueryError('Invalid cursor')
+        if descending:
+            query = query.filter(or_(sort_column < last_value,
+                                     and_(sort_column == last_value, id_column < last_id)))
+        else:
+            query = query.filter(or_(sort_column > last_value,
+                                     and_(sort_column == last_value, id_column > last_id)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        value = getattr(last, sort_column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        next_cursor = encode_cursor([value, getattr(last, id_column.key)])
+
+    return rows, {'limit': limit, 'sort': sort, 'next_cursor': next_cursor, 'has_more': has_more}
+
+
+def track_child_count(child_model, foreign_key, parent_model, count_attribute):
+    """Keep parent.count_attribute equal to the number of child rows.
+
+    Counts are adjusted inside the same flush as the child insert, update or
+    delete, so readers never compute them per request. Bulk operations that
+    bypass the ORM should call `refresh_child_counts` afterwards.
+    """
+    parent_table = parent_model.__table__
+    count_column = parent_table.c[count_attribute]
+
+    def adjust(connection, parent_id, delta):
+        if parent_id is None:
+            return
+        connection.execute(
+            parent_table.update()
+            .where(parent_table.c.id == parent_id)
+            .values({count_attribute: func.coalesce(count_column, 0) + delta})
+        )
+
+    @event.listens_for(child_model, 'after_insert')
+    def _child_inserted(mapper, connection, target):
+        adjust(connection, getattr(target, foreign_key), 1)
+
+    @event.listens_for(child_model, 'after_delete')
+    def _child_deleted(mapper, connection, target):
+        adjust(connection, getattr(target, foreign_key), -1)
+
+    @event.listens_for(child_model, 'after_update')
+    def _child_updated(mapper, connection, target):
+        history = inspect(target).attrs[foreign_key].history
+        if not history.has_changes():
+            return
+        for old in history.deleted:
+            adjust(connection, old, -1)
+        for new in history.added:
+            adjust(connection, new, 1)
+
+
+def refresh_child_counts(session, child_model, foreign_key, parent_model, count_attribute):
+    """Recompute materialized counts from scratch (after bulk loads or migrations)"""
+    child_table = child_model.__table__
+    parent_table = parent_model.__table__
+    counts = (select(func.count())
+              .where(child_table.c[foreign_key] == parent_table.c.id)
+              .scalar_subquery())
+    session.execute(parent_table.update().values({count_attribute: counts}))
@@ -0,0 +1,479 @@
+# reports.py - Scheduled per-site report generation
+# Builds daily/weekly site reports from precomputed rollups, renders sites in
+# parallel across a process pool, caches rendered sections by data version and
+# hands finished reports to a pluggable sender.
+
+import atexit
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import schedule
+from jinja2 import Environment
+
+# Readings further apart than this are not integrated into energy totals
+MAX_ENERGY_GAP = 300
+
+# Days of rollups kept (weekly reports need the last seven)
+ROLLUP_RETENTION_DAYS = 35
+
+# Seconds between rollup snapshots
+ROLLUP_SNAPSHOT_INTERVAL = 60
+
+# Seconds between attempts to take over the scheduler lock from another process
+SCHEDULER_LOCK_RETRY = 30
+
+REPORT_SECTIONS = ['energy', 'uptime', 'alerts', 'noise']
+
+SECTION_TEMPLATES = {
+    'energy': """
+<h2>Energy</h2>
+<p>Total consumption: <strong>{{ '%.2f'|format(total_kwh) }} kWh</strong></p>
+<table>
+  <tr><th>Device</th><th>kWh</th></tr>
+  {% for device, kwh in devices %}<tr><td>{{ device }}</td><td>{{ '%.2f'|format(kwh) }}</td></tr>{% endfor %}
+</table>""",
+    'uptime': """
+<h2>Uptime</h2>
+<p>Site average: <strong>{{ '%.1f'|format(average) }}%</strong></p>
+<table>
+  <tr><th>Device</th><th>Uptime</th></tr>
+  {% for device, pct in devices %}<tr><td>{{ device }}</td><td>{{ '%.1f'|format(pct) }}%</td></tr>{% endfor %}
+</table>""",
+    'alerts': """
+<h2>Alerts</h2>
+{% if rules %}<table>
+  <tr><th>Rule</th><th>Count</th></tr>
+  {% for rule, count in rules %}<tr><td>{{ rule }}</td><td>{{ count }}</td></tr>{% endfor %}
+</table>{% else %}<p>No alerts raised.</p>{% endif %}""",
+    'noise': """
+<h2>Noise Exceedances</h2>
+{% if devices %}<table>
+  <tr><th>Device</th><th>Exceedances</th></tr>
+  {% for device, count in devices %}<tr><td>{{ device }}</td><td>{{ count }}</td></tr>{% endfor %}
+</table>{% else %}<p>No noise limit exceedances.</p>{% endif %}"""
+}
+
+REPORT_TEMPLATE = """<html>
+<head><title>{{ site }} {{ period }} report</title></head>
+<body>
+<h1>{{ site }} - {{ period|capitalize }} Report</h1>
+<p>{{ start }} to {{ end }}</p>
+{% for section in sections %}{{ section|safe }}{% endfor %}
+<p><small>Generated {{ generated }}</small></p>
+</body>
+</html>"""
+
+_environment = Environment(autoescape=True)
+_templates = {}
+
+
+def _day_start(day):
+    """Timestamp of local midnight at the start of `day`"""
+    return datetime.combine(day, datetime.min.time()).timestamp()
+
+
+def _template(name, source):
+    if name not in _templates:
+        _templates[name] = _environment.from_string(source)
+    return _templates[name]
+
+
+class RollupStore:
+    """Per-device daily rollups updated incrementally as readings arrive.
+
+    Reports only ever read these counters, never raw history. Every update
+    bumps the version of that device's day, so a cached section for a closed
+    period stays valid while today's readings arrive. Uptime is the time
+    between presence transitions, not the time between messages, so
+    sensors that only publish on change still count as online. With
+    `path`, the rollups are snapshotted to that file and reloaded on start.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.days = {}
+        self.versions = {}
+        self.last_power = {}
+        self.online_since = {}
+        self.lock = threading.Lock()
+        self.snapshot_thread = None
+
+    def _day(self, device_name, day):
+        key = (device_name, day)
+        rollup = self.days.get(key)
+        if rollup is None:
+            rollup = {
+                'energy_wh': 0.0,
+                'online_seconds': 0.0,
+                'alerts': {},
+                'noise_exceedances': 0
+            }
+            self.days[key] = rollup
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return rollup
+
+    def _add_online(self, device_name, start, end):
+        # Split the interval at local midnights
+        while start < end:
+            day = datetime.fromtimestamp(start).date()
+            until = min(end, _day_start(day + timedelta(days=1)))
+            self._day(device_name, day)['online_seconds'] += until - start
+            start = until
+
+    def record_status(self, device_name, status, timestamp=None):
+        """Presence listener: open or close the device's online interval"""
+        timestamp = timestamp or time.time()
+        with self.lock:
+            if status == 'online':
+                self.online_since.setdefault(device_name, timestamp)
+                return
+            since = self.online_since.pop(device_name, None)
+            if since is not None:
+                self._add_online(device_name, since, timestamp)
+
+    def record_power(self, device_name, watts, timestamp=None):
+        """Integrate a power reading (W) into the daily energy total"""
+        timestamp = timestamp or time.time()
+        with self.lock:
+            previous = self.last_power.get(device_name)
+            self.last_power[device_name] = (timestamp, watts)
+            if previous is None:
+                return
+            elapsed = timestamp - previous[0]
+            if elapsed <= 0 or elapsed > MAX_ENERGY_GAP:
+                return
+            rollup = self._day(device_name, datetime.fromtimestamp(timestamp).date())
+            rollup['energy_wh'] += (previous[1] + watts) / 2.0 * elapsed / 3600.0
+
+    def record_alert(self, alert):
+        """Count a raised stream analytics alert"""
+        if alert['state'] != 'raised':
+            return
+        with self.lock:
+            rollup = self._day(alert['device'], datetime.fromtimestamp(alert['timestamp']).date())
+            rollup['alerts'][alert['rule']] = rollup['alerts'].get(alert['rule'], 0) + 1
+            if alert['sensor'].startswith('noise'):
+                rollup['noise_exceedances'] += 1
+
+    def version(self, device_names, start, end):
+        """Data version for a group of devices over [start, end] (dates)"""
+        days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+        with self.lock:
+            return tuple(self.versions.get((name, day), 0) for name in device_names for day in days)
+
+    def summarize(self, device_names, start, end, now=None):
+        """Aggregate rollups for the devices over [start, end] (dates)"""
+        now = now or time.time()
+        days = (end - start).days + 1
+        period_start, period_end = _day_start(start), _day_start(end + timedelta(days=1))
+        summary = {}
+        with self.lock:
+            for name in device_names:
+                totals = {'energy_wh': 0.0, 'online_seconds': 0.0, 'alerts': {}, 'noise_exceedances': 0}
+                for offset in range(days):
+                    rollup = self.days.get((name, start + timedelta(days=offset)))
+                    if rollup is None:
+                        continue
+                    totals['energy_wh'] += rollup['energy_wh']
+                    totals['online_seconds'] += rollup['online_seconds']
+                    totals['noise_exceedances'] += rollup['noise_exceedances']
+                    for rule, count in rollup['alerts'].items():
+                        totals['alerts'][rule] = totals['alerts'].get(rule, 0) + count
+                since = self.online_since.get(name)
+                if since is not None:
+                    # Still online: count the open interval up to now
+                    totals['online_seconds'] += max(0.0, min(now, period_end) - max(since, period_start))
+                totals['uptime_pct'] = 100.0 * totals['online_seconds'] / (period_end - period_start)
+                summary[name] = totals
+        return summary
+
+    # Persistence
+
+    def save(self):
+        """Snapshot the rollups to `path`, dropping days past the retention"""
+        if not self.path:
+            return
+        cutoff = date.today() - timedelta(days=ROLLUP_RETENTION_DAYS)
+        with self.lock:
+            for key in [key for key in self.days if key[1] < cutoff]:
+                del self.days[key]
+                self.versions.pop(key, None)
+            payload = json.dumps({
+                'saved_at': time.time(),
+                'days': [[name, day.isoformat(), rollup] for (name, day), rollup in self.days.items()],
+                'online_since': self.online_since
+            })
+        # Atomic replace, a worker starting up never reads a half-written snapshot
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        temp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_text(payload)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        """Restore the rollups from `path` (number of device days loaded).
+
+        Devices online when the snapshot was written count as online up to
+        that moment. The time since then is unknown and not counted.
+        """
+        if not self.path:
+            return 0
+        try:
+            data = json.loads(self.path.read_text())
+            days = {(name, date.fromisoformat(day)): rollup for name, day, rollup in data['days']}
+            online_since, saved_at = data['online_since'], data['saved_at']
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Failed to read rollups: {e}")
+            return 0
+
+        with self.lock:
+            for key, rollup in days.items():
+                self.days[key] = rollup
+                self.versions[key] = self.versions.get(key, 0) + 1
+            for name, since in online_since.items():
+                self._add_online(name, since, saved_at)
+        return len(days)
+
+    def start_snapshots(self, interval=ROLLUP_SNAPSHOT_INTERVAL):
+        """Save the rollups periodically and on exit"""
+        if not self.path or (self.snapshot_thread and self.snapshot_thread.is_alive()):
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except Exception as e:
+                    print(f"Rollup snapshot error: {e}")
+
+        atexit.register(self.save)
+        self.snapshot_thread = threading.Thread(target=run, name='rollup-snapshots', daemon=True)
+        self.snapshot_thread.start()
+
+
+def section_context(section, summary):
+    """Template context for one report section"""
+    names = sorted(summary)
+    if section == 'energy':
+        devices = [(name, summary[name]['energy_wh'] / 1000.0) for name in names]
+        return {'devices': devices, 'total_kwh': sum(kwh for _, kwh in devices)}
+    if section == 'uptime':
+        devices = [(name, summary[name]['uptime_pct']) for name in names]
+        average = sum(pct for _, pct in devices) / len(devices) if devices else 0.0
+        return {'devices': devices, 'average': average}
+    if section == 'alerts':
+        rules = {}
+        for name in names:
+            for rule, count in summary[name]['alerts'].items():
+                rules[rule] = rules.get(rule, 0) + count
+        return {'rules': sorted(rules.items())}
+    if section == 'noise':
+        return {'devices': [(name, summary[name]['noise_exceedances'])
+                            for name in names if summary[name]['noise_exceedances']]}
+    raise ValueError(f"Unknown report section: {section}")
+
+
+def render_sections(job):
+    """Render the requested sections for one site (runs in a worker process)"""
+    site, sections, summary = job
+    return site, {section: _template(section, SECTION_TEMPLATES[section]).render(**section_context(section, summary))
+                  for section in sections}
+
+
+class FileSender:
+    """Write reports to a local directory (development and tests)"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+
+    def send(self, report):
+        safe_site = ''.join(c if c.isalnum() else '_' for c in report['site'])
+        path = self.directory / f"{safe_site}_{report['period']}_{report['end']}.html"
+        with open(path, 'w') as f:
+            f.write(report['html'])
+        return str(path)
+
+
+class SendGridSender:
+    """Email reports through SendGrid"""
+
+    def __init__(self, api_key, from_email, recipients):
+        self.api_key = api_key
+        self.from_email = from_email
+        self.recipients = recipients
+
+    def send(self, report):
+        from sendgrid import SendGridAPIClient
+        from sendgrid.helpers.mail import Mail
+
+        message = Mail(
+            from_email=self.from_email,
+            to_emails=report.get('recipients') or self.recipients,
+            subject=f"{report['site']} {report['period']} report ({report['end']})",
+            html_content=report['html']
+        )
+        response = SendGridAPIClient(self.api_key).send(message)
+        return response.status_code
+
+
+def _acquire_lock(path):
+    """Open `path` and take an exclusive lock without blocking (None if another process holds it)"""
+    Path(path).parent.mkdir(exist_ok=True, parents=True)
+    lock_file = open(path, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class ReportGenerator:
+    """Render and deliver per-site reports from rollups"""
+
+    def __init__(self, rollups, get_sites, sender, workers=None, max_cached_sections=5000):
+        self.rollups = rollups
+        self.get_sites = get_sites
+        self.sender = sender
+        self.workers = workers or os.cpu_count() or 2
+        self.max_cached_sections = max_cached_sections
+        self.section_cache = {}
+        self.pool = None
+        self.scheduler_thread = None
+        self.lock = threading.Lock()
+
+    def _period_range(self, period, today=None):
+        today = today or date.today()
+        end = today - timedelta(days=1)
+        if period == 'daily':
+            return end, end
+        if period == 'weekly':
+            return end - timedelta(days=6), end
+        raise ValueError(f"Unknown report period: {period}")
+
+    def _cache_key(self, site, period, start, section, version):
+        digest = hashlib.sha1(repr(version).encode()).hexdigest()
+        return (site, period, start.isoformat(), section, digest)
+
+    def _get_pool(self):
+        if self.pool is None:
+            # Never fork the web process: its MQTT, presence and write-queue threads
+            # (and their held locks) would be copied into every render worker
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self.pool
+
+    def generate(self, period='daily', today=None, send=True):
+        """Build reports for every site, rendering only uncached sections"""
+        start, end = self._period_range(period, today)
+        sites = self.get_sites()
+        rendered = {}
+        jobs = []
+
+        with self.lock:
+            for site, devices in sites.items():
+                version = self.rollups.version(devices, start, end)
+                keys = {section: self._cache_key(site, period, start, section, version)
+                        for section in REPORT_SECTIONS}
+                rendered[site] = {section: self.section_cache.get(key) for section, key in keys.items()}
+                missing = [section for section, html in rendered[site].items() if html is None]
+                if missing:
+                    jobs.append((site, missing, self.rollups.summarize(devices, start, end), keys))
+
+        if len(jobs) > 1 and self.workers > 1:
+            results = self._get_pool().map(render_sections, [job[:3] for job in jobs],
+                                           chunksize=max(1, len(jobs) // (self.workers * 4)))
+        else:
+            results = map(render_sections, [job[:3] for job in jobs])
+
+        with self.lock:
+            keys_by_site = {job[0]: job[3] for job in jobs}
+            for site, sections in results:
+                for section, html in sections.items():
+                    rendered[site][section] = html
+                    self.section_cache[keys_by_site[site][section]] = html
+            if len(self.section_cache) > self.max_cached_sections:
+                # Drop the oldest entries, dicts keep insertion order
+                for key in list(self.section_cache)[:len(self.section_cache) - self.max_cached_sections]:
+                    del self.section_cache[key]
+
+        reports = []
+        generated = datetime.now().isoformat(timespec='seconds')
+        page = _template('report', REPORT_TEMPLATE)
+        for site in sites:
+            report = {
+                'site': site,
+                'period': period,
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+                'html': page.render(
+                    site=site, period=period, start=start, end=end, generated=generated,
+                    sections=[rendered[site][section] for section in REPORT_SECTIONS]
+                )
+            }
+            if send and self.sender:
+                try:
+                    report['delivery'] = self.sender.send(report)
+                except Exception as e:
+                    print(f"Report delivery failed for {site}: {e}")
+                    report['delivery'] = None
+            reports.append(report)
+
+        return reports
+
+    def start_scheduler(self, daily_at='06:00', weekly_day='monday', lock_path=None):
+        """Schedule daily and weekly reports in a background thread.
+
+        With `lock_path`, only the process holding an exclusive lock on that
+        file runs the schedule. Every gunicorn worker can call this; the
+        others keep retrying and one takes over if the owner exits.
+        """
+        if self.scheduler_thread and self.scheduler_thread.is_alive():
+            return
+
+        self.scheduler_thread = threading.Thread(target=self._run_scheduler, args=(daily_at, weekly_day, lock_path),
+                                                 name='report-scheduler', daemon=True)
+        self.scheduler_thread.start()
+
+    def _run_scheduled(self, period):
+        started = time.time()
+        try:
+            reports = self.generate(period)
+            print(f"Generated {len(reports)} {period} reports in {time.time() - started:.2f}s")
+        except Exception as e:
+            print(f"Scheduled {period} report generation failed: {e}")
+
+    def _run_scheduler(self, daily_at, weekly_day, lock_path):
+        if lock_path:
+            # Held (never closed) for the life of the process; the OS releases it on exit
+            lock_file = _acquire_lock(lock_path)
+            while lock_file is None:
+                time.sleep(SCHEDULER_LOCK_RETRY)
+                lock_file = _acquire_lock(lock_path)
+
+        # Jobs are created only once this process owns the schedule, so a takeover
+        # does not replay runs the previous owner already made
+        scheduler = schedule.Scheduler()
+        scheduler.every().day.at(daily_at).do(self._run_scheduled, 'daily')
+        getattr(scheduler.every(), weekly_day).at(daily_at).do(self._run_scheduled, 'weekly')
+        print(f"Report scheduler started (pid {os.getpid()})")
+        while True:
+            scheduler.run_pending()
+            time.sleep(1)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,325 @@
+# stream_analytics.py - Streaming sliding-window statistics and threshold alerting
+# Keeps per-entity rolling aggregates for continuous sensor readings (noise, air
+# quality, power) and raises compliance alerts without re-reading history.
+
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# Default compliance limits, keyed by sensor object id as published over MQTT
+# (e.g. smartsites/<device>/sensor/noise_level/state). Each rule evaluates one
+# statistic over a sliding window and alerts with hysteresis: it raises when the
+# statistic goes above `limit` and only clears once it drops below `clear`.
+DEFAULT_LIMITS = {
+    'noise_level': [
+        {
+            'name': 'LAeq,15min',
+            'stat': 'laeq',
+            'window': 900,
+            'limit': 75.0,
+            'clear': 72.0,
+            'min_samples': 12
+        },
+        {
+            'name': 'LAmax,1min',
+            'stat': 'max',
+            'window': 60,
+            'limit': 90.0,
+            'clear': 85.0,
+            'min_samples': 1
+        }
+    ],
+    'pm10': [
+        {
+            'name': 'PM10 1h mean',
+            'stat': 'mean',
+            'window': 3600,
+            'limit': 50.0,
+            'clear': 45.0,
+            'min_samples': 12
+        }
+    ]
+}
+
+# Window used for statistics on sensors that have no configured rules
+DEFAULT_WINDOW = 300
+
+# Histogram range and bucket count used for percentile estimates. The default
+# range suits dB and µg/m³ readings; sensors on other scales override it.
+HISTOGRAM_RANGE = (0.0, 140.0)
+HISTOGRAM_BUCKETS = 280
+SENSOR_RANGES = {
+    'temperature': (-20.0, 60.0),
+    'humidity': (0.0, 100.0),
+    'light_level': (0.0, 100.0),
+    'power_consumption': (0.0, 10000.0)
+}
+
+# Upper bound on samples kept per window, protects memory from chatty sensors
+MAX_WINDOW_SAMPLES = 20000
+
+
+class SlidingWindow:
+    """Time-based sliding window with O(1) amortised updates.
+
+    Maintains a running sum (mean), a monotonic deque (max), a fixed-bucket
+    histogram (percentiles) and, for acoustic readings in dB, a running energy
+    sum (LAeq).
+    """
+
+    def __init__(self, duration, hist_range=HISTOGRAM_RANGE, buckets=HISTOGRAM_BUCKETS,
+                 acoustic=False, max_samples=MAX_WINDOW_SAMPLES):
+        self.duration = duration
+        self.acoustic = acoustic
+        self.max_samples = max_samples
+        self.samples = deque()
+        self.max_candidates = deque()
+        self.total = 0.0
+        self.energy = 0.0
+        self.hist_low, self.hist_high = hist_range
+        self.resolution = (self.hist_high - self.hist_low) / float(buckets)
+        self.buckets = [0] * (buckets + 1)
+        self._evictions = 0
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _bucket(self, value):
+        index = int((value - self.hist_low) / self.resolution)
+        return min(max(index, 0), len(self.buckets) - 1)
+
+    def add(self, value, timestamp):
+        """Add a reading and expire readings older than the window"""
+        energy = 10 ** (value / 10.0) if self.acoustic else 0.0
+        self._sequence += 1
+        self.samples.append((self._sequence, timestamp, value, energy))
+        self.total += value
+        self.energy += energy
+        self.buckets[self._bucket(value)] += 1
+
+        while self.max_candidates and self.max_candidates[-1][1] <= value:
+            self.max_candidates.pop()
+        self.max_candidates.append((self._sequence, value))
+
+        self.expire(timestamp)
+
+    def expire(self, now):
+        """Drop readings that fell out of the window"""
+        cutoff = now - self.duration
+        while self.samples and (self.samples[0][1] <= cutoff or len(self.samples) > self.max_samples):
+            old_sequence, _, old_value, old_energy = self.samples.popleft()
+            self.total -= old_value
+            self.energy -= old_energy
+            self.buckets[self._bucket(old_value)] -= 1
+            if self.max_candidates and self.max_candidates[0][0] <= old_sequence:
+                self.max_candidates.popleft()
+            self._evictions += 1
+
+        # Re-sum periodically so floating point drift from add/subtract never accumulates
+        if self._evictions >= self.max_samples:
+            self.total = sum(sample[2] for sample in self.samples)
+            self.energy = sum(sample[3] for sample in self.samples)
+            self._evictions = 0
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return self.total / len(self.samples)
+
+    def max(self):
+        if not self.max_candidates:
+            return None
+        return self.max_candidates[0][1]
+
+    def laeq(self):
+        """Energy-equivalent level, 10*log10(mean(10^(L/10)))"""
+        if not self.acoustic or not self.samples or self.energy <= 0:
+            return None
+        return 10 * math.log10(self.energy / len(self.samples))
+
+    def percentile(self, pct):
+        """Approximate percentile from the bucket histogram"""
+        count = len(self.samples)
+        if not count:
+            return None
+        rank = max(1, int(math.ceil(count * pct / 100.0)))
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return self.hist_low + (index + 0.5) * self.resolution
+        return self.hist_high
+
+    def stat(self, name):
+        """Look up a statistic by name (mean, max, laeq, pNN, l10, l90)"""
+        if name == 'mean':
+            return self.mean()
+        if name == 'max':
+            return self.max()
+        if name == 'laeq':
+            return self.laeq()
+        if name == 'count':
+            return len(self.samples)
+        if name.startswith('p'):
+            return self.percentile(float(name[1:]))
+        if name.startswith('l'):
+            # Acoustic Ln: level exceeded n% of the time
+            return self.percentile(100.0 - float(name[1:]))
+        raise ValueError(f"Unknown statistic: {name}")
+
+    def summary(self):
+        return {
+            'window': self.duration,
+            'count': len(self.samples),
+            'mean': self.mean(),
+            'max': self.max(),
+            'laeq': self.laeq(),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'l10': self.stat('l10'),
+            'l90': self.stat('l90')
+        }
+
+
+class EntityStream:
+    """Sliding windows and alert state for one device sensor"""
+
+    def __init__(self, device_name, sensor_name, rules):
+        self.device_name = device_name
+        self.sensor_name = sensor_name
+        self.rules = rules
+        acoustic = 'noise' in sensor_name or any(rule['stat'] == 'laeq' for rule in rules)
+        hist_range = SENSOR_RANGES.get(sensor_name, HISTOGRAM_RANGE)
+        self.windows = {}
+        for duration in sorted({rule['window'] for rule in rules} or {DEFAULT_WINDOW}):
+            self.windows[duration] = SlidingWindow(duration, hist_range=hist_range, acoustic=acoustic)
+        self.active = {}
+        self.last_value = None
+        self.last_updated = None
+
+
+class StreamAnalytics:
+    """Per-entity streaming aggregates with hysteresis threshold alerts"""
+
+    def __init__(self, limits=None, max_alerts=500, alert_retention=86400):
+        self.limits = limits if limits is not None else DEFAULT_LIMITS
+        self.streams = {}
+        self.alerts = deque(maxlen=max_alerts)
+        self.alert_retention = alert_retention
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """Register a callback invoked with each raised or cleared alert"""
+        self.listeners.append(callback)
+
+    def _get_stream(self, device_name, sensor_name):
+        key = (device_name, sensor_name)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = EntityStream(device_name, sensor_name, self.limits.get(sensor_name, []))
+            self.streams[key] = stream
+        return stream
+
+    def ingest(self, device_name, sensor_name, value, timestamp=None):
+        """Feed one reading and return any alert transitions it caused.
+
+        Non-finite values (ESPHome publishes nan for an unavailable sensor)
+        are ignored, since one would poison the window sums for its lifetime.
+        """
+        if not math.isfinite(value):
+            return []
+        if timestamp is None:
+            timestamp = time.time()
+        events = []
+
+        with self.lock:
+            stream = self._get_stream(device_name, sensor_name)
+            stream.last_value = value
+            stream.last_updated = timestamp
+            for window in stream.windows.values():
+                window.add(value, timestamp)
+
+            for rule in stream.rules:
+                window = stream.windows[rule['window']]
+                if len(window) < rule.get('min_samples', 1):
+                    continue
+                current = window.stat(rule['stat'])
+                if current is None:
+                    continue
+
+                name = rule['name']
+                clear_at = rule.get('clear', rule['limit'])
+                if not stream.active.get(name) and current > rule['limit']:
+                    stream.active[name] = True
+                    events.append(self._alert(stream, rule, 'raised', current, timestamp))
+                elif stream.active.get(name) and current < clear_at:
+                    stream.active[name] = False
+                    events.append(self._alert(stream, rule, 'cleared', current, timestamp))
+
+            self.alerts.extend(events)
+
+        for event in events:
+            for callback in self.listeners:
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"Alert listener error: {e}")
+
+        return events
+
+    def _alert(self, stream, rule, state, value, timestamp):
+        return {
+            'device': stream.device_name,
+            'sensor': stream.sensor_name,
+            'rule': rule['name'],
+            'stat': rule['stat'],
+            'limit': rule['limit'],
+            'value': round(value, 2),
+            'state': state,
+            'timestamp': timestamp,
+            'time': datetime.utcfromtimestamp(timestamp).isoformat()
+        }
+
+    def get_stats(self, device_name, sensor_name, now=None):
+        """Current window summaries for one entity, or None if never seen"""
+        with self.lock:
+            stream = self.streams.get((device_name, sensor_name))
+            if stream is None:
+                return None
+            if now is None:
+                now = time.time()
+            windows = []
+            for window in stream.windows.values():
+                window.expire(now)
+                windows.append(window.summary())
+            return {
+                'device': device_name,
+                'sensor': sensor_name,
+                'last_value': stream.last_value,
+                'last_updated': stream.last_updated,
+                'windows': windows,
+                'active_alerts': [name for name, active in stream.active.items() if active]
+            }
+
+    def recent_alerts(self, since=None, now=None):
+        """Raised alerts within the retention period (newest first)"""
+        if now is None:
+            now = time.time()
+        if since is None:
+            since = now - self.alert_retention
+        with self.lock:
+            return [alert for alert in reversed(self.alerts)
+                    if alert['state'] == 'raised' and alert['timestamp'] >= since]
+
+    def active_alerts(self):
+        """Rules currently in the alerting state"""
+        with self.lock:
+            return [
+                {'device': stream.device_name, 'sensor': stream.sensor_name, 'rule': name}
+                for stream in self.streams.values()
+                for name, active in stream.active.items() if active
+            ]
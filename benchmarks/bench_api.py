@@ -0,0 +1,116 @@
+# bench_api.py - API latency under concurrent load against a seeded database
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.harness import benchmark, summarize
+
+DEVICE_TYPES = ['motion_sensor', 'light_sensor', 'air_quality', 'noise_monitor', 'power_monitor']
+
+_server = None
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+LOCATIONS = 40
+
+
+def _seed(app_module, rows):
+    """Create tables and insert `rows` devices and ESPHome devices across sites (deterministic)"""
+    rng = random.Random(42)
+    with app_module.app.app_context():
+        app_module.db.drop_all()
+        app_module.db.create_all()
+        app_module.db.session.bulk_insert_mappings(app_module.SiteLocation, [{
+            'id': i + 1,
+            'name': f"Site {i + 1}",
+            'description': f"Benchmark site {i + 1}"
+        } for i in range(LOCATIONS)])
+        app_module.db.session.bulk_insert_mappings(app_module.Device, [{
+            'name': f"device_{i}",
+            'device_type': DEVICE_TYPES[i % len(DEVICE_TYPES)],
+            'mac_address': f"AA:BB:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}:00",
+            'site_location_id': rng.randint(1, LOCATIONS),
+            'status': 'online' if rng.random() < 0.6 else 'offline'
+        } for i in range(rows)])
+        app_module.db.session.bulk_insert_mappings(app_module.ESPHomeDevice, [{
+            'name': f"esphome_device_{i}",
+            'device_type': DEVICE_TYPES[i % len(DEVICE_TYPES)],
+            'mac_address': f"CC:DD:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}:00",
+            'site_location_id': rng.randint(1, LOCATIONS),
+            'compilation_status': 'success',
+            'esphome_config': '# benchmark'
+        } for i in range(rows)])
+        app_module.create_tables()
+
+
+def _base_url(options):
+    """Start (once) a threaded server for the app on a free loopback port"""
+    global _server
+    if _server is None:
+        import app as app_module
+        _seed(app_module, options['scale'] * 500)
+        _server = make_server('127.0.0.1', 0, app_module.app, threaded=True,
+                              request_handler=_QuietHandler)
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{_server.server_port}"
+
+
+def _load(options, path):
+    url = _base_url(options) + path
+    concurrency = options['concurrency']
+    per_worker = options['repeat']
+    local = threading.local()
+
+    def worker(_):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        timings = []
+        for _ in range(per_worker):
+            started = time.perf_counter()
+            response = session.get(url)
+            response.raise_for_status()
+            timings.append(time.perf_counter() - started)
+        return timings
+
+    # Warm up caches and connections before timing
+    requests.get(url).raise_for_status()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [timing for timings in pool.map(worker, range(concurrency)) for timing in timings]
+    elapsed = time.perf_counter() - started
+    return summarize(samples, concurrency=concurrency, throughput=len(samples) / elapsed)
+
+
+@benchmark('api.devices')
+def bench_api_devices(options):
+    return _load(options, '/api/devices')
+
+
+@benchmark('api.esphome_devices')
+def bench_api_esphome_devices(options):
+    return _load(options, '/api/esphome/devices')
+
+
+@benchmark('api.devices_filtered')
+def bench_api_devices_filtered(options):
+    return _load(options, '/api/devices?status=online&type=noise_monitor&limit=50')
+
+
+@benchmark('api.locations')
+def bench_api_locations(options):
+    return _load(options, '/api/locations')
+
+
+@benchmark('api.dashboard_stats')
+def bench_api_dashboard_stats(options):
+    return _load(options, '/api/dashboard-stats')
@@ -0,0 +1,76 @@
+# bench_commands.py - Group command fan-out through a local broker stand-in
+
+import os
+import time
+
+from benchmarks.fakes import FakeMQTTBroker
+from benchmarks.harness import benchmark, summarize
+
+SITE_DEVICES = 500
+
+
+def _seed_site(app_module, devices):
+    """Add one site with `devices` switchable devices and return its id"""
+    with app_module.app.app_context():
+        app_module.db.create_all()
+        site = app_module.SiteLocation(name='Command Site', description='Group command benchmark')
+        app_module.db.session.add(site)
+        app_module.db.session.commit()
+        app_module.db.session.bulk_insert_mappings(app_module.Device, [{
+            'name': f"cmd_device_{i}",
+            'device_type': 'power_monitor',
+            'site_location_id': site.id,
+            'tags': 'lights' if i % 2 else 'lights,signage',
+            'status': 'online'
+        } for i in range(devices)])
+        app_module.bump_group_version(app_module.db.session, app_module.CommandGroupVersion.__table__)
+        app_module.db.session.commit()
+        return site.id
+
+
+def _wait(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError('Timed out waiting for MQTT benchmark')
+        time.sleep(0.01)
+
+
+@benchmark('mqtt.group_command')
+def bench_group_command(options):
+    import app as app_module
+
+    site_id = _seed_site(app_module, SITE_DEVICES)
+    with app_module.app.app_context():
+        devices = app_module.current_command_groups().resolve(location=site_id)
+
+    with FakeMQTTBroker() as broker:
+        # Every device switches and reports its new state straight away
+        def device_echo(topic, payload):
+            if topic.endswith('/command'):
+                broker.publish(topic[:-len('command')] + 'state', payload)
+
+        broker.add_hook(device_echo)
+        host, port = broker.address
+        os.environ['MQTT_BROKER'] = host
+        os.environ['MQTT_PORT'] = str(port)
+        app_module.init_mqtt()
+        client = app_module.mqtt_client
+        _wait(lambda: any(c.subscriptions for c in broker.clients))
+
+        samples = []
+        summary = None
+        try:
+            for i in range(max(3, options['repeat'] // 2)):
+                batch = app_module.command_dispatcher.send(devices, 'switch', 'relay', 'ON' if i % 2 else 'OFF')
+                summary = batch.summary()
+                if summary['completed'] != len(devices):
+                    raise RuntimeError(f"Only {summary['completed']} of {len(devices)} devices completed")
+                samples.append(batch.finished - batch.started)
+        finally:
+            client.loop_stop()
+            client.disconnect()
+
+    return summarize(samples, devices=len(devices),
+                     ack_latency_ms=summary['ack_latency_ms'],
+                     completion_latency_ms=summary['completion_latency_ms'])
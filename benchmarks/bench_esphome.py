@@ -0,0 +1,63 @@
+# bench_esphome.py - Config rendering, YAML generation and discovery benchmarks
+
+import tempfile
+
+import yaml
+
+from benchmarks.fakes import ESPHomeWebSwarm
+from benchmarks.harness import benchmark, measure
+from backend.services.esphome import ESPHOME_TEMPLATES, ESPHomeManager
+
+
+def _manager():
+    return ESPHomeManager(None, None, base_path=tempfile.mkdtemp(prefix='smart-sites-bench-'))
+
+
+def _device_data(index, device_type):
+    pins = {name: spec['default'] for name, spec in ESPHOME_TEMPLATES[device_type]['pins'].items()}
+    return {'name': f"Bench Device {index}", 'type': device_type, 'pins': pins}
+
+
+@benchmark('esphome.create_device_config')
+def bench_create_device_config(options):
+    manager = _manager()
+    devices = [_device_data(i, device_type)
+               for i, device_type in enumerate(sorted(ESPHOME_TEMPLATES) * 20)]
+
+    def render():
+        for device in devices:
+            manager.create_device_config(device)
+
+    return measure(render, repeat=options['repeat'], operations=len(devices))
+
+
+@benchmark('esphome.yaml_dump')
+def bench_yaml_dump(options):
+    manager = _manager()
+    configs = [manager.create_device_config(_device_data(i, device_type))
+               for i, device_type in enumerate(sorted(ESPHOME_TEMPLATES) * 5)]
+
+    def dump():
+        for config in configs:
+            yaml.dump(config, default_flow_style=False)
+
+    return measure(dump, repeat=options['repeat'], operations=len(configs))
+
+
+@benchmark('esphome.discover_devices')
+def bench_discover_devices(options):
+    manager = _manager()
+    swarm_size = options['scale'] * 10
+    with ESPHomeWebSwarm(swarm_size) as swarm:
+        found = []
+
+        def discover():
+            found[:] = manager.discover_devices(network=swarm.network, port=swarm.port)
+
+        result = measure(discover, repeat=max(3, options['repeat'] // 5), warmup=1)
+    if len(found) != swarm_size:
+        raise RuntimeError(f"Discovery found {len(found)} of {swarm_size} fake devices")
+    result['hosts'] = swarm_size
+    # Socket scans and reverse DNS are noisier than in-process benchmarks
+    result['threshold'] = 0.5
+    return result
@@ -0,0 +1,70 @@
+# bench_mqtt.py - MQTT ingestion throughput through a local broker stand-in
+
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from benchmarks.fakes import FakeMQTTBroker
+from benchmarks.harness import benchmark, summarize
+
+
+def _wait(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError('Timed out waiting for MQTT benchmark')
+        time.sleep(0.01)
+
+
+@benchmark('mqtt.ingest')
+def bench_mqtt_ingest(options):
+    import app as app_module
+
+    messages = options['scale'] * 2000
+    devices = options['scale'] * 100
+
+    with FakeMQTTBroker() as broker:
+        host, port = broker.address
+        os.environ['MQTT_BROKER'] = host
+        os.environ['MQTT_PORT'] = str(port)
+        app_module.init_mqtt()
+        client = app_module.mqtt_client
+
+        # Count messages as the app finishes handling them
+        handled = [0]
+        lock = threading.Lock()
+        handler = client.on_message
+
+        def counting_handler(mqtt_client, userdata, msg):
+            handler(mqtt_client, userdata, msg)
+            with lock:
+                handled[0] += 1
+
+        client.on_message = counting_handler
+        _wait(lambda: any(c.subscriptions for c in broker.clients))
+
+        publisher = mqtt.Client()
+        publisher.connect(host, port)
+        publisher.loop_start()
+
+        samples = []
+        try:
+            for _ in range(max(3, options['repeat'] // 4)):
+                target = handled[0] + messages
+                started = time.perf_counter()
+                for i in range(messages):
+                    publisher.publish(f"smartsites/device_{i % devices}/sensor/noise_level/state",
+                                      f"{55 + (i % 30)}.5")
+                _wait(lambda: handled[0] >= target)
+                samples.append((time.perf_counter() - started) / messages)
+        finally:
+            publisher.loop_stop()
+            publisher.disconnect()
+            client.loop_stop()
+            client.disconnect()
+
+    result = summarize(samples, messages=messages)
+    result['throughput'] = 1.0 / result['median']
+    return result
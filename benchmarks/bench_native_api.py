@@ -0,0 +1,64 @@
+# bench_native_api.py - Native API session setup, pooled state reads and commands
+
+import base64
+import contextlib
+
+from benchmarks.fakes import FakeESPHomeDevice
+from benchmarks.harness import benchmark, measure
+from backend.services.native_api import NativeAPIPool
+
+# Fixed key so runs are comparable; the Noise handshake is part of what is measured
+ENCRYPTION_KEY = base64.b64encode(bytes(range(32))).decode()
+
+
+@contextlib.contextmanager
+def _devices(count):
+    with contextlib.ExitStack() as stack:
+        yield [stack.enter_context(FakeESPHomeDevice(f"bench_device_{i}", encryption_key=ENCRYPTION_KEY))
+               for i in range(count)]
+
+
+@benchmark('native_api.connect')
+def bench_connect(options):
+    """A fresh encrypted session per read, the cost pooling avoids"""
+    with _devices(options['scale'] * 5) as devices:
+        def connect_all():
+            pool = NativeAPIPool(encryption_key=ENCRYPTION_KEY)
+            try:
+                for device in devices:
+                    pool.get_states(device.name, '127.0.0.1', device.port)
+            finally:
+                pool.stop()
+
+        return measure(connect_all, repeat=options['repeat'], operations=len(devices))
+
+
+@benchmark('native_api.state_read')
+def bench_state_read(options):
+    with _devices(options['scale'] * 5) as devices:
+        pool = NativeAPIPool(encryption_key=ENCRYPTION_KEY)
+        try:
+            def read_all():
+                for device in devices:
+                    pool.get_states(device.name, '127.0.0.1', device.port)
+
+            return measure(read_all, repeat=options['repeat'] * 5, operations=len(devices))
+        finally:
+            pool.stop()
+
+
+@benchmark('native_api.command')
+def bench_command(options):
+    """Switch command round trip, send to state echo"""
+    with _devices(options['scale'] * 5) as devices:
+        pool = NativeAPIPool(encryption_key=ENCRYPTION_KEY)
+        state = [False]
+        try:
+            def toggle_all():
+                state[0] = not state[0]
+                for device in devices:
+                    pool.command(device.name, '127.0.0.1', 'relay', state[0], port=device.port)
+
+            return measure(toggle_all, repeat=options['repeat'] * 2, operations=len(devices))
+        finally:
+            pool.stop()
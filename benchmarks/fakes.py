@@ -0,0 +1,507 @@
+# fakes.py - Local stand-ins for ESPHome devices and the MQTT broker
+# Everything binds to loopback so benchmarks never touch the real network.
+
+import json
+import socket
+import socketserver
+import struct
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aioesphomeapi import api_pb2 as pb
+from aioesphomeapi.core import MESSAGE_TYPE_TO_PROTO
+from cryptography.exceptions import InvalidTag
+from noise.connection import NoiseConnection
+
+from backend.services.native_api import decode_psk
+
+
+class _ESPHomeWebHandler(BaseHTTPRequestHandler):
+    """Mimics the ESPHome web_server component pages used by discovery"""
+
+    def do_GET(self):
+        if self.path == '/text_sensor/device_info':
+            body = json.dumps({
+                'id': 'text_sensor-device_info',
+                'state': f"{self.server.device_name} ESPHome 2023.12.0",
+                'value': 'ESPHome'
+            }).encode()
+            content_type = 'application/json'
+        else:
+            body = (f"<html><head><title>{self.server.device_name}</title></head>"
+                    f"<body><h1>ESPHome Web Server</h1></body></html>").encode()
+            content_type = 'text/html'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ESPHomeWebSwarm:
+    """Fake ESPHome web servers on 127.0.0.2, 127.0.0.3, ... (Linux loopback /8)"""
+
+    def __init__(self, count, port=18080, first_host=2):
+        self.count = count
+        self.port = port
+        self.first_host = first_host
+        self.servers = []
+        self.threads = []
+
+    @property
+    def network(self):
+        return '127.0.0.0/24'
+
+    def start(self):
+        for index in range(self.count):
+            address = f"127.0.0.{self.first_host + index}"
+            server = ThreadingHTTPServer((address, self.port), _ESPHomeWebHandler)
+            server.daemon_threads = True
+            server.device_name = f"fake_device_{index}"
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.servers.append(server)
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def topic_matches(topic_filter, topic):
+    """MQTT topic filter matching with + and # wildcards"""
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for index, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[index]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(value):
+    data = value.encode()
+    return struct.pack('!H', len(data)) + data
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """One MQTT 3.1.1 client connection"""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.request.makefile('rb')
+        self.send_lock = threading.Lock()
+        self.subscriptions = []
+
+    def send(self, data):
+        with self.send_lock:
+            self.request.sendall(data)
+
+    def _read_packet(self):
+        header = self.reader.read(1)
+        if not header:
+            return None, None
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self.reader.read(1)
+            if not byte:
+                return None, None
+            length += (byte[0] & 0x7F) * multiplier
+            if not byte[0] & 0x80:
+                break
+            multiplier *= 128
+        return header[0], self.reader.read(length)
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                header, body = self._read_packet()
+                if header is None:
+                    break
+                packet_type = header >> 4
+
+                if packet_type == 1:  # CONNECT
+                    self.send(b'\x20\x02\x00\x00')
+                    broker._add_client(self)
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        self.send(b'\x40\x02' + packet_id)
+                    broker._route(topic, body[offset:])
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id = body[:2]
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        filter_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        topic_filter = body[offset + 2:offset + 2 + filter_length].decode()
+                        offset += 2 + filter_length + 1
+                        self.subscriptions.append(topic_filter)
+                        granted.append(0)
+                    self.send(b'\x90' + _encode_length(2 + len(granted)) + packet_id + bytes(granted))
+                elif packet_type == 10:  # UNSUBSCRIBE
+                    self.send(b'\xb0\x02' + body[:2])
+                elif packet_type == 12:  # PINGREQ
+                    self.send(b'\xd0\x00')
+                elif packet_type == 14:  # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker._remove_client(self)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeMQTTBroker:
+    """Minimal in-process MQTT 3.1.1 broker.
+
+    Supports CONNECT, SUBSCRIBE (with wildcards), PUBLISH at QoS 0/1 (QoS 1
+    publishes are acknowledged, deliveries to subscribers are QoS 0),
+    PINGREQ and DISCONNECT. `on_publish(topic, payload)` hooks let a
+    benchmark play the part of devices reacting to commands.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = _ThreadingTCPServer((host, port), _BrokerHandler)
+        self.server.broker = self
+        self.clients = []
+        self.hooks = []
+        self.published = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def add_hook(self, callback):
+        self.hooks.append(callback)
+
+    def _add_client(self, handler):
+        with self.lock:
+            self.clients.append(handler)
+
+    def _remove_client(self, handler):
+        with self.lock:
+            if handler in self.clients:
+                self.clients.remove(handler)
+
+    def publish(self, topic, payload):
+        """Publish from the broker itself (e.g. a fake device state echo)"""
+        self._route(topic, payload if isinstance(payload, bytes) else str(payload).encode())
+
+    def _route(self, topic, payload):
+        with self.lock:
+            self.published += 1
+            targets = [client for client in self.clients
+                       if any(topic_matches(f, topic) for f in client.subscriptions)]
+        if targets:
+            body = _encode_string(topic) + payload
+            packet = b'\x30' + _encode_length(len(body)) + body
+            for client in targets:
+                try:
+                    client.send(packet)
+                except OSError:
+                    pass
+        for hook in self.hooks:
+            hook(topic, payload)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# Native API device
+
+DEFAULT_ENTITIES = [
+    {'object_id': 'noise_level', 'name': 'Noise Level', 'type': 'sensor', 'unit': 'dB', 'state': 55.0},
+    {'object_id': 'motion', 'name': 'Motion', 'type': 'binary_sensor', 'state': False},
+    {'object_id': 'relay', 'name': 'Relay', 'type': 'switch', 'state': False},
+    {'object_id': 'restart', 'name': 'Restart', 'type': 'button'}
+]
+
+_LIST_RESPONSES = {
+    'binary_sensor': pb.ListEntitiesBinarySensorResponse,
+    'sensor': pb.ListEntitiesSensorResponse,
+    'switch': pb.ListEntitiesSwitchResponse,
+    'button': pb.ListEntitiesButtonResponse
+}
+_STATE_RESPONSES = {
+    'binary_sensor': pb.BinarySensorStateResponse,
+    'sensor': pb.SensorStateResponse,
+    'switch': pb.SwitchStateResponse
+}
+_MESSAGE_IDS = {message_class: msg_type for msg_type, message_class in MESSAGE_TYPE_TO_PROTO.items()}
+
+NOISE_PROTOCOL = b'Noise_NNpsk0_25519_ChaChaPoly_SHA256'
+NOISE_PROLOGUE = b'NoiseAPIInit\x00\x00'
+
+
+def _varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+class _NativeAPIHandler(socketserver.BaseRequestHandler):
+    """One client session against a FakeESPHomeDevice"""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.request.makefile('rb')
+        self.send_lock = threading.Lock()
+        self.noise = None
+
+    def _read_exactly(self, length):
+        data = self.reader.read(length)
+        if len(data) < length:
+            raise EOFError
+        return data
+
+    def _read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self._read_exactly(1)[0]
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def _read_noise_frame(self):
+        header = self._read_exactly(3)
+        return self._read_exactly(int.from_bytes(header[1:], 'big'))
+
+    def _noise_frame(self, data):
+        return b'\x01' + len(data).to_bytes(2, 'big') + data
+
+    def _handshake(self, psk):
+        if self.reader.peek(1)[:1] != b'\x01':
+            # Plaintext client: answer with an encrypted frame so it knows a key is needed
+            self.request.sendall(b'\x01\x00\x00')
+            raise EOFError
+        self._read_noise_frame()  # empty client hello
+        message = self._read_noise_frame()
+        hello = self._noise_frame(b'\x01' + self.server.device.name.encode() + b'\x00')
+        noise = NoiseConnection.from_name(NOISE_PROTOCOL)
+        noise.set_as_responder()
+        noise.set_psks(psk)
+        noise.set_prologue(NOISE_PROLOGUE)
+        noise.start_handshake()
+        try:
+            noise.read_message(message[1:])
+        except InvalidTag:
+            self.request.sendall(hello + self._noise_frame(b'\x01Handshake MAC failure'))
+            raise EOFError
+        self.request.sendall(hello + self._noise_frame(b'\x00' + noise.write_message()))
+        self.noise = noise
+
+    def read(self):
+        if self.noise:
+            data = self.noise.decrypt(self._read_noise_frame())
+            msg_type, length = struct.unpack('>HH', data[:4])
+            payload = data[4:4 + length]
+        else:
+            if self._read_exactly(1) != b'\x00':
+                raise EOFError
+            length = self._read_varint()
+            msg_type = self._read_varint()
+            payload = self._read_exactly(length)
+        message_class = MESSAGE_TYPE_TO_PROTO.get(msg_type)
+        return message_class.FromString(payload) if message_class else None
+
+    def send(self, message):
+        msg_type = _MESSAGE_IDS[type(message)]
+        payload = message.SerializeToString()
+        with self.send_lock:
+            if self.noise:
+                frame = self._noise_frame(self.noise.encrypt(struct.pack('>HH', msg_type, len(payload)) + payload))
+            else:
+                frame = b'\x00' + _varint(len(payload)) + _varint(msg_type) + payload
+            self.request.sendall(frame)
+
+    def handle(self):
+        device = self.server.device
+        try:
+            if device.psk:
+                self._handshake(device.psk)
+            while True:
+                message = self.read()
+                if isinstance(message, pb.HelloRequest):
+                    self.send(pb.HelloResponse(api_version_major=1, api_version_minor=9, name=device.name,
+                                               server_info=f"{device.name} (ESPHome 2023.12.0)"))
+                elif isinstance(message, pb.ConnectRequest):
+                    self.send(pb.ConnectResponse(invalid_password=message.password != device.password))
+                elif isinstance(message, pb.DeviceInfoRequest):
+                    self.send(pb.DeviceInfoResponse(name=device.name, mac_address=device.mac_address,
+                                                    esphome_version='2023.12.0', model='esp32dev'))
+                elif isinstance(message, pb.ListEntitiesRequest):
+                    for entity in device.entities.values():
+                        response = _LIST_RESPONSES[entity['type']](
+                            object_id=entity['object_id'], key=entity['key'], name=entity['name'])
+                        if entity.get('unit'):
+                            response.unit_of_measurement = entity['unit']
+                        self.send(response)
+                    self.send(pb.ListEntitiesDoneResponse())
+                elif isinstance(message, pb.SubscribeStatesRequest):
+                    device._add_subscriber(self)
+                    for entity in device.entities.values():
+                        if entity['type'] in _STATE_RESPONSES:
+                            self.send(device._state_message(entity))
+                elif isinstance(message, pb.SwitchCommandRequest):
+                    device.set_state(device.keys[message.key], message.state)
+                elif isinstance(message, pb.ButtonCommandRequest):
+                    device.pressed.append(device.keys[message.key])
+                elif isinstance(message, pb.PingRequest):
+                    self.send(pb.PingResponse())
+                elif isinstance(message, pb.DisconnectRequest):
+                    self.send(pb.DisconnectResponse())
+                    break
+        except (EOFError, ConnectionError, OSError, ValueError, InvalidTag):
+            pass
+        finally:
+            device._remove_subscriber(self)
+
+
+class FakeESPHomeDevice:
+    """In-process ESPHome native API server.
+
+    Speaks plaintext or Noise-encrypted frames (when `encryption_key` is set),
+    answers hello/connect/device info/list entities, streams states to
+    subscribers and applies switch and button commands, echoing the new state
+    the way real firmware does. `set_state` pushes a change to every
+    subscribed client and `drop_connections` simulates a device reboot.
+    """
+
+    def __init__(self, name='fake_device', host='127.0.0.1', port=0, encryption_key=None, password='',
+                 entities=None):
+        self.name = name
+        self.password = password
+        self.psk = decode_psk(encryption_key) if encryption_key else None
+        self.mac_address = ':'.join(f"{b:02X}" for b in zlib.crc32(name.encode()).to_bytes(6, 'big'))
+        self.entities = {}
+        for entity in entities or DEFAULT_ENTITIES:
+            entity = dict(entity)
+            entity['key'] = zlib.crc32(entity['object_id'].encode())
+            self.entities[entity['object_id']] = entity
+        self.keys = {entity['key']: object_id for object_id, entity in self.entities.items()}
+        self.pressed = []
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def _state_message(self, entity):
+        return _STATE_RESPONSES[entity['type']](key=entity['key'], state=entity['state'])
+
+    def _add_subscriber(self, handler):
+        with self.lock:
+            self.subscribers.append(handler)
+
+    def _remove_subscriber(self, handler):
+        with self.lock:
+            if handler in self.subscribers:
+                self.subscribers.remove(handler)
+
+    def set_state(self, object_id, state):
+        entity = self.entities[object_id]
+        entity['state'] = state
+        message = self._state_message(entity)
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for handler in subscribers:
+            try:
+                handler.send(message)
+            except OSError:
+                pass
+
+    def drop_connections(self):
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for handler in subscribers:
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self):
+        self.server = _ThreadingTCPServer((self.host, self.port), _NativeAPIHandler)
+        self.server.device = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,114 @@
+# harness.py - Benchmark registry, timing and baseline comparison
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+
+BENCHMARKS = {}
+
+# A benchmark regresses when its median is this much slower than the baseline
+DEFAULT_THRESHOLD = 0.20
+
+
+def benchmark(name):
+    """Register a benchmark function.
+
+    The function receives the run options and returns a dict of timing samples
+    as produced by `summarize`.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def summarize(samples, **extra):
+    """Summarise per-operation timings (seconds, lower is better)"""
+    ordered = sorted(samples)
+    mean = statistics.fmean(ordered)
+    result = {
+        'unit': 's',
+        'samples': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'mean': mean,
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'ops_per_sec': 1.0 / mean if mean else None
+    }
+    result.update(extra)
+    return result
+
+
+def measure(func, repeat=20, warmup=3, operations=1):
+    """Time func() repeatedly and summarise the per-operation cost"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) / operations)
+    return summarize(samples)
+
+
+def environment():
+    """Metadata stored with every result file"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, timeout=10).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """Compare medians against a baseline run, returning one row per benchmark"""
+    rows = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or not base.get('median'):
+            rows.append({'name': name, 'median': result['median'], 'baseline': None,
+                         'ratio': None, 'status': 'new'})
+            continue
+        ratio = result['median'] / base['median']
+        allowed = result.get('threshold', threshold)
+        if ratio > 1 + allowed:
+            status = 'regression'
+        elif ratio < 1 - allowed:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'name': name, 'median': result['median'], 'baseline': base['median'],
+                     'ratio': ratio, 'status': status})
+    return rows
+
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    if value < 1e-3:
+        return f"{value * 1e6:.1f}us"
+    if value < 1:
+        return f"{value * 1e3:.2f}ms"
+    return f"{value:.2f}s"
@@ -0,0 +1,81 @@
+# run.py - Run the backend benchmark suite and compare against a baseline
+#
+#   python -m benchmarks.run                      # run everything, compare to baseline
+#   python -m benchmarks.run --filter api.        # only the API benchmarks
+#   python -m benchmarks.run --save-baseline      # record a new baseline
+
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BENCHMARK_DIR / 'baseline.json'
+DEFAULT_OUTPUT = BENCHMARK_DIR / 'results' / 'latest.json'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Smart Sites backend benchmarks')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--output', default=str(DEFAULT_OUTPUT), help='Where to write results JSON')
+    parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='Baseline results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Also write results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=None, help='Allowed slowdown before failing (0.2 = 20%%)')
+    parser.add_argument('--scale', type=int, default=10, help='Data size multiplier (rows, hosts, messages)')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed repetitions per benchmark')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients for API load')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Benchmarks get a throwaway database; the app reads this at import time
+    os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp(prefix='smart-sites-bench-')}/bench.db"
+    os.environ.pop('MQTT_BROKER', None)
+    os.environ.pop('REPORT_SCHEDULER', None)
+
+    from benchmarks import bench_api, bench_commands, bench_esphome, bench_mqtt, bench_native_api  # noqa: F401 (registers benchmarks)
+    from benchmarks.harness import (BENCHMARKS, DEFAULT_THRESHOLD, compare, environment,
+                                    format_seconds, load_results, save_results)
+
+    options = {'scale': args.scale, 'repeat': args.repeat, 'concurrency': args.concurrency}
+    results = {'meta': dict(environment(), options=options), 'results': {}}
+
+    for name, func in sorted(BENCHMARKS.items()):
+        if args.filter not in name:
+            continue
+        print(f"Running {name}...", flush=True)
+        results['results'][name] = func(options)
+        result = results['results'][name]
+        print(f"  median {format_seconds(result['median'])}  p95 {format_seconds(result['p95'])}")
+
+    Path(args.output).parent.mkdir(exist_ok=True, parents=True)
+    save_results(args.output, results)
+    print(f"Results written to {args.output}")
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        baseline = load_results(args.baseline)
+        threshold = args.threshold if args.threshold is not None else DEFAULT_THRESHOLD
+        print(f"\nComparison with {args.baseline} (threshold {threshold:.0%}):")
+        for row in compare(results, baseline, threshold):
+            ratio = f"{row['ratio']:.2f}x" if row['ratio'] is not None else '-'
+            print(f"  {row['name']:<32} {format_seconds(row['median']):>10} "
+                  f"{format_seconds(row['baseline']):>10} {ratio:>7}  {row['status']}")
+            if row['status'] == 'regression':
+                regressions.append(row['name'])
+
+    if args.save_baseline:
+        save_results(args.baseline, results)
+        print(f"Baseline written to {args.baseline}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -85,8 +85,8 @@ class ESPHomeBuilder {
         try {
             const response = await fetch('/api/esphome/devices');
             if (response.ok) {
-                const devices = await response.json();
-                this.renderDevices(devices);
+                const data = await response.json();
+                this.renderDevices(data.devices);
             } else {
                 // API not available - show empty state for demo
                 this.renderDevices([]);
@@ -0,0 +1,21 @@
+# conftest.py - Shared fixtures
+
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app.py against a temp SQLite database, with no broker, scheduler or ESPHome manager"""
+    root = tmp_path_factory.mktemp('app')
+    os.environ['DATABASE_URL'] = f"sqlite:///{root / 'smart_sites.db'}"
+    os.environ['PROFILE_DIR'] = str(root / 'profiles')
+    os.environ['REPORT_DIR'] = str(root / 'reports')
+    for name in ('MQTT_BROKER', 'ESPHOME_MANAGER', 'NATIVE_API_SUBSCRIBE', 'REPORT_SCHEDULER', 'PROFILING_TOKEN'):
+        os.environ.pop(name, None)
+
+    import app
+    with app.app.app_context():
+        app.create_tables()
+    return app
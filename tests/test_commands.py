@@ -0,0 +1,245 @@
+# test_commands.py - Device groups and batched MQTT command fan-out
+
+import itertools
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from benchmarks.fakes import FakeMQTTBroker
+from backend.services.commands import (CommandDispatcher, DispatchError, GroupIndex, group_version, track_groups)
+
+Base = declarative_base()
+
+
+class GroupVersion(Base):
+    __tablename__ = 'group_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class Member(Base):
+    __tablename__ = 'member'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    site_location_id = Column(Integer)
+    device_type = Column(String(20))
+    tags = Column(String(100))
+    status = Column(String(20))
+
+
+track_groups(Member, ('name', 'site_location_id', 'device_type', 'tags'), GroupVersion.__table__)
+
+ROWS = [
+    (1, 'light_1', 1, 'power_monitor', 'lights'),
+    (2, 'light_2', 1, 'power_monitor', 'lights, signage'),
+    (3, 'sign_1', 2, 'power_monitor', 'signage'),
+    (4, 'noise_1', 1, 'noise_sensor', None),
+]
+
+
+def test_group_index_resolves_intersections():
+    index = GroupIndex()
+    index.rebuild(ROWS, version=1)
+    assert len(index) == 4
+    assert index.resolve(location=1) == ['light_1', 'light_2', 'noise_1']
+    assert index.resolve(location=1, tag='signage') == ['light_2']
+    assert index.resolve(tag=['lights', 'signage']) == ['light_1', 'light_2', 'sign_1']
+    assert index.resolve(location=1, type='power_monitor', tag=None) == ['light_1', 'light_2']
+    assert index.resolve(location=3) == []
+    assert index.resolve() == []
+    with pytest.raises(ValueError):
+        index.resolve(colour='red')
+
+
+def test_group_version_bumps_only_on_group_changes():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        def version():
+            return group_version(session.connection(), GroupVersion.__table__)
+
+        assert version() is None
+        session.add(Member(id=1, name='light_1', site_location_id=1, device_type='power_monitor', tags='lights'))
+        session.commit()
+        assert version() == 1
+
+        member = session.get(Member, 1)
+        member.status = 'online'
+        session.commit()
+        assert version() == 1
+
+        member.tags = 'lights,signage'
+        session.commit()
+        assert version() == 2
+
+        member.site_location_id = 2
+        session.rollback()
+        assert version() == 2
+
+        session.delete(session.get(Member, 1))
+        session.commit()
+        assert version() == 3
+
+
+class StubClient:
+    """Records publishes; PUBACKs only arrive when a test calls dispatcher.on_publish"""
+
+    def __init__(self, ack_immediately=False):
+        self.mids = itertools.count(1)
+        self.published = []
+        self.ack_immediately = ack_immediately
+        self.dispatcher = None
+
+    def max_inflight_messages_set(self, value):
+        pass
+
+    def publish(self, topic, payload, qos=0):
+        info = mqtt.MQTTMessageInfo(next(self.mids))
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        self.published.append((info.mid, topic, payload))
+        if self.ack_immediately:
+            # PUBACK handled before publish() returns, as paho can do under load
+            self.dispatcher.on_publish(self, None, info.mid)
+        return info
+
+
+def test_send_without_client():
+    with pytest.raises(DispatchError):
+        CommandDispatcher().send(['light_1'], 'switch', 'relay', 'ON')
+
+
+def test_unacknowledged_and_silent_devices_time_out():
+    dispatcher = CommandDispatcher(timeout=0.2)
+    client = StubClient()
+    dispatcher.attach(client)
+    batch = dispatcher.send(['light_1', 'light_2'], 'switch', 'relay', 'ON')
+    summary = batch.summary()
+    assert [r['error'] for r in summary['results']] == ['not acknowledged', 'not acknowledged']
+    assert summary['failed'] == 2 and summary['completed'] == 0
+    assert dispatcher.by_mid == {} and not dispatcher.waiting
+
+
+def test_early_puback_counts_as_acked():
+    dispatcher = CommandDispatcher(timeout=0.2)
+    client = StubClient(ack_immediately=True)
+    client.dispatcher = dispatcher
+    dispatcher.attach(client)
+    batch = dispatcher.send(['light_1'], 'switch', 'relay', 'ON')
+    summary = batch.summary()
+    assert summary['acked'] == 1
+    assert summary['results'][0]['error'] == 'timeout'
+    assert dispatcher.early_acks == {}
+
+
+def test_stale_early_ack_is_not_reused():
+    dispatcher = CommandDispatcher(timeout=0.1)
+    client = StubClient()
+    dispatcher.attach(client)
+    # A PUBACK for mid 1 left over from before this publish
+    dispatcher.on_publish(client, None, 1)
+    time.sleep(0.01)
+    batch = dispatcher.send(['light_1'], 'switch', 'relay', 'ON')
+    assert batch.summary()['results'][0]['error'] == 'not acknowledged'
+
+
+def test_state_echo_completes_only_matching_payload():
+    dispatcher = CommandDispatcher(timeout=0.3)
+    client = StubClient()
+    dispatcher.attach(client)
+
+    original_publish = client.publish
+
+    def publish(topic, payload, qos=0):
+        info = original_publish(topic, payload, qos)
+        dispatcher.on_publish(client, None, info.mid)
+        state_topic = topic[:-len('command')] + 'state'
+        dispatcher.handle_state(state_topic, b'OFF')  # a stale state does not complete an ON command
+        if 'light_1' in topic:
+            dispatcher.handle_state(state_topic, payload.encode())
+        return info
+
+    client.publish = publish
+    summary = dispatcher.send(['light_1', 'light_2'], 'switch', 'relay', 'ON').summary()
+    assert [(r['device'], r['error']) for r in summary['results']] == [('light_1', None), ('light_2', 'timeout')]
+    assert summary['acked'] == 2 and summary['completed'] == 1
+
+
+@pytest.fixture
+def broker_client():
+    dispatcher = CommandDispatcher(timeout=2)
+    with FakeMQTTBroker() as broker:
+        client = mqtt.Client()
+        client.on_message = lambda c, userdata, msg: dispatcher.handle_state(msg.topic, msg.payload)
+        dispatcher.attach(client)
+        host, port = broker.address
+        client.connect(host, port, 60)
+        client.subscribe('smartsites/#')
+        client.loop_start()
+        deadline = time.time() + 5
+        while not any(c.subscriptions for c in broker.clients):
+            assert time.time() < deadline, 'MQTT client did not subscribe'
+            time.sleep(0.01)
+        try:
+            yield broker, dispatcher
+        finally:
+            client.loop_stop()
+            client.disconnect()
+
+
+def test_fan_out_through_broker(broker_client):
+    broker, dispatcher = broker_client
+    devices = [f"device_{i}" for i in range(50)]
+
+    def device_echo(topic, payload):
+        if topic.endswith('/command') and '/device_13/' not in topic:
+            broker.publish(topic[:-len('command')] + 'state', payload)
+
+    broker.add_hook(device_echo)
+    batch = dispatcher.send(devices, 'switch', 'relay', 'ON', timeout=1)
+    summary = batch.summary()
+    assert summary['devices'] == 50
+    assert summary['acked'] == 50
+    assert summary['completed'] == 49
+    assert [r['device'] for r in summary['results'] if r['error']] == ['device_13']
+    assert summary['results'][13]['error'] == 'timeout'
+    assert dispatcher.by_mid == {} and not dispatcher.waiting
+
+
+def test_expect_empty_completes_on_any_state(broker_client):
+    broker, dispatcher = broker_client
+
+    def device_toggle(topic, payload):
+        if topic.endswith('/command'):
+            broker.publish(topic[:-len('command')] + 'state', 'ON')
+
+    broker.add_hook(device_toggle)
+    summary = dispatcher.send(['device_1'], 'switch', 'relay', 'TOGGLE', expect='').summary()
+    assert summary['completed'] == 1
+
+
+def test_display_names_publish_on_node_topics(broker_client):
+    broker, dispatcher = broker_client
+    # Devices only listen under their ESPHome node name
+    listening = {'smartsites/light_0/switch/relay/command', 'smartsites/sign_2/switch/relay/command'}
+
+    def device_echo(topic, payload):
+        if topic in listening:
+            broker.publish(topic[:-len('command')] + 'state', payload)
+
+    broker.add_hook(device_echo)
+    summary = dispatcher.send(['Light 0', 'Sign #2'], 'switch', 'relay', 'ON', timeout=1).summary()
+    assert [(r['device'], r['error']) for r in summary['results']] == [('Light 0', None), ('Sign #2', None)]
+
+
+def test_invalid_topic_fails_targets_without_raising():
+    dispatcher = CommandDispatcher(timeout=0.2)
+    dispatcher.attach(mqtt.Client())
+    batch = dispatcher.send(['light_0', 'light_1'], 'switch', 'relay/#', 'ON')
+    summary = batch.summary()
+    assert summary['failed'] == 2
+    assert all(r['error'] for r in summary['results'])
+    assert batch.done.is_set()
+    assert not dispatcher.waiting and dispatcher.by_mid == {}
@@ -0,0 +1,154 @@
+# test_config_sync.py - Fragment index and incremental config regeneration
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services import esphome
+from backend.services.config_sync import ConfigIndex, ConfigSync
+from backend.services.esphome import ESPHomeManager, fragment_hashes
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.delenv('ESPHOME_API_KEY', raising=False)
+    return ESPHomeManager(None, None, base_path=tmp_path / 'esphome')
+
+
+def change_template(monkeypatch, device_type):
+    config = dict(esphome.ESPHOME_TEMPLATES[device_type]['config'])
+    config['logger'] = {'level': 'DEBUG'}
+    monkeypatch.setitem(esphome.ESPHOME_TEMPLATES[device_type], 'config', config)
+
+
+def stored_device(manager, device_id, name, device_type, pins=None):
+    """A device as the database holds it after a render with the current fragments"""
+    params = {'name': name, 'type': device_type, 'pins': pins or {}}
+    config_yaml, hashes = manager.render_device(params)
+    device = SimpleNamespace(id=device_id, name=name, device_type=device_type,
+                             config_params=json.dumps(params), esphome_config=config_yaml)
+    return device, hashes
+
+
+def test_fragment_change_selects_only_its_dependents(monkeypatch):
+    index = ConfigIndex()
+    index.track(1, fragment_hashes('power_monitor'))
+    index.track(2, fragment_hashes('power_monitor'))
+    index.track(3, fragment_hashes('motion_sensor'))
+    assert index.affected(fragment_hashes()) == set()
+
+    change_template(monkeypatch, 'power_monitor')
+    assert index.affected(fragment_hashes()) == {1, 2}
+
+    index.track(1, fragment_hashes('power_monitor'))
+    index.remove(2)
+    assert index.affected(fragment_hashes()) == set()
+    assert len(index) == 2
+
+
+def test_added_and_removed_base_sections_affect_every_device(monkeypatch):
+    index = ConfigIndex()
+    index.track(1, fragment_hashes('power_monitor'))
+    index.track(2, fragment_hashes('motion_sensor'))
+
+    monkeypatch.setitem(esphome.BASE_CONFIG, 'status_led', {'pin': 'GPIO2'})
+    assert index.affected(fragment_hashes()) == {1, 2}
+    monkeypatch.delitem(esphome.BASE_CONFIG, 'status_led')
+
+    monkeypatch.delitem(esphome.BASE_CONFIG, 'web_server')
+    assert index.affected(fragment_hashes()) == {1, 2}
+
+
+def test_dry_run_writes_nothing(manager, monkeypatch):
+    sync = ConfigSync(manager)
+    device, hashes = stored_device(manager, 1, 'Meter 1', 'power_monitor')
+    sync.track(1, hashes)
+    change_template(monkeypatch, 'power_monitor')
+
+    result, = sync.regenerate([device], dry_run=True)
+    assert result['changed'] and not result['written']
+    assert 'DEBUG' in result['diff']
+    assert not manager.config_path.joinpath('meter_1.yaml').exists()
+    # Still affected: a dry run does not move the index
+    assert sync.affected() == {1}
+
+
+def test_unchanged_render_writes_no_file(manager):
+    sync = ConfigSync(manager)
+    device, _ = stored_device(manager, 1, 'Meter 1', 'power_monitor')
+    config_file, written = manager.write_device_config('meter_1', device.esphome_config)
+    assert written
+    mtime = manager.config_path.joinpath('meter_1.yaml').stat().st_mtime_ns
+
+    result, = sync.regenerate([device])
+    assert (result['changed'], result['written'], result['config_file']) == (False, False, config_file)
+    assert manager.config_path.joinpath('meter_1.yaml').stat().st_mtime_ns == mtime
+
+
+def test_render_errors_keep_the_stored_config(manager):
+    sync = ConfigSync(manager)
+    device = SimpleNamespace(id=1, config_params=json.dumps({'name': 'x', 'type': 'toaster', 'pins': {}}),
+                             esphome_config='esphome: {}\n')
+    result, = sync.regenerate([device])
+    assert 'toaster' in result['error'] and not result['changed']
+
+
+def test_backfill_recovers_only_exact_default_renders(manager):
+    sync = ConfigSync(manager)
+    default, hashes = stored_device(manager, 1, 'Meter 1', 'power_monitor')
+    custom, _ = stored_device(manager, 2, 'Meter 2', 'power_monitor', pins={'ct_pin': 'A3'})
+    unknown = SimpleNamespace(id=3, name='Old', device_type='toaster', esphome_config='')
+
+    recovered = sync.backfill([default, custom, unknown])
+    assert recovered == {1: ({'name': 'Meter 1', 'type': 'power_monitor', 'pins': {}}, hashes)}
+    assert set(sync.skipped) == {2, 3}
+
+
+@pytest.fixture
+def esphome_app(app_module, manager, monkeypatch):
+    compiles = []
+    monkeypatch.setattr(app_module, 'esphome_manager', manager)
+    monkeypatch.setattr(app_module, 'config_sync', ConfigSync(manager))
+    monkeypatch.setattr(app_module, 'start_compile', lambda device_id, name: compiles.append(name) or True)
+    return app_module, compiles
+
+
+def test_created_device_is_written_tracked_and_compiled(esphome_app):
+    app, compiles = esphome_app
+    response = app.app.test_client().post('/api/esphome/devices', json={'name': 'Site Meter', 'type': 'power_monitor'})
+    assert response.status_code == 200
+    device_id = response.get_json()['id']
+    assert compiles == ['site_meter']
+    assert app.esphome_manager.config_path.joinpath('site_meter.yaml').exists()
+    assert device_id in app.config_sync.index.devices
+
+    bad = app.app.test_client().post('/api/esphome/devices', json={'name': 'Toaster', 'type': 'toaster'})
+    assert bad.status_code == 400
+
+
+def test_regenerate_compiles_only_changed_devices(esphome_app, monkeypatch):
+    app, compiles = esphome_app
+    client = app.app.test_client()
+    ids = [client.post('/api/esphome/devices', json={'name': name, 'type': device_type}).get_json()['id']
+           for name, device_type in [('Meter A', 'power_monitor'), ('Door A', 'door_window_sensor')]]
+    compiles.clear()
+
+    # A hash change that renders the same YAML: no write and no compile
+    door_id = ids[1]
+    stale = dict(app.config_sync.index.devices[door_id], **{'template:door_window_sensor': 'old'})
+    app.config_sync.track(door_id, stale)
+    results = app.regenerate_configs()
+    assert [(r['id'], r['changed'], r['written']) for r in results] == [(door_id, False, False)]
+    assert compiles == []
+
+    change_template(monkeypatch, 'power_monitor')
+    dry = app.regenerate_configs(dry_run=True)
+    assert [r['name'] for r in dry if r['changed']] == ['Meter A'] and compiles == []
+
+    results = app.regenerate_configs()
+    assert [r['name'] for r in results if r['changed']] == ['Meter A']
+    assert compiles == ['meter_a']
+    with app.app.app_context():
+        meter = app.ESPHomeDevice.query.filter_by(name='Meter A').one()
+        assert 'DEBUG' in meter.esphome_config and meter.compilation_status == 'pending'
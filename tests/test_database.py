@@ -0,0 +1,171 @@
+# test_database.py - Write-behind queue and read routing against a SQLite file
+
+import sqlite3
+import threading
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from backend.services.database import READ_BIND, WriteQueue, database_config, init_database, routing_session_class
+
+db = SQLAlchemy(session_options={'class_': routing_session_class()})
+
+
+class Reading(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / 'test.db'
+    url = f"sqlite:///{path}"
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config.update(database_config(url))
+    db.init_app(app)
+    write_queue = init_database(app, db)
+    with app.app_context():
+        db.create_all()
+        commits = []
+        event.listen(db.engines[None], 'commit', lambda conn: commits.append(threading.current_thread().name))
+    return app, write_queue, path, commits
+
+
+def add_reading(session, name, id=None):
+    session.add(Reading(id=id, name=name))
+    session.flush()
+    return name
+
+
+def hold_writer(write_queue):
+    """Park the writer thread on a job so later submissions queue up into one batch"""
+    started, release = threading.Event(), threading.Event()
+
+    def block(session):
+        started.set()
+        release.wait(5)
+
+    future = write_queue.submit(block)
+    assert started.wait(5)
+    return release, future
+
+
+def names(app):
+    with app.app_context():
+        return sorted(name for (name,) in db.session.query(Reading.name))
+
+
+def test_writes_arriving_together_share_one_commit(database):
+    app, write_queue, _, commits = database
+    release, blocker = hold_writer(write_queue)
+    futures = [write_queue.submit(add_reading, f"r{i}") for i in range(10)]
+    release.set()
+
+    assert [future.result(5) for future in futures] == [f"r{i}" for i in range(10)]
+    assert blocker.result(5) is None
+    assert commits == ['db-write-queue', 'db-write-queue']
+    assert names(app) == sorted(f"r{i}" for i in range(10))
+
+
+def test_batches_are_capped(database):
+    app, _, _, commits = database
+    write_queue = WriteQueue(app, db, max_batch=4, begin_immediate=True)
+    release, _ = hold_writer(write_queue)
+    futures = [write_queue.submit(add_reading, f"r{i}") for i in range(10)]
+    release.set()
+    for future in futures:
+        future.result(5)
+    # The blocker, then 4 + 4 + 2
+    assert len(commits) == 4
+
+
+def test_failed_batch_is_retried_one_write_at_a_time(database):
+    app, write_queue, _, commits = database
+
+    def broken(session):
+        session.add(Reading(name='never'))
+        raise ValueError('bad payload')
+
+    release, _ = hold_writer(write_queue)
+    good = write_queue.submit(add_reading, 'good', 1)
+    bad = write_queue.submit(broken)
+    duplicate = write_queue.submit(add_reading, 'duplicate', 1)
+    also_good = write_queue.submit(add_reading, 'also good')
+    release.set()
+
+    assert good.result(5) == 'good'
+    assert also_good.result(5) == 'also good'
+    with pytest.raises(ValueError, match='bad payload'):
+        bad.result(5)
+    # Fails only once the batch is split and 'good' has claimed the id
+    with pytest.raises(IntegrityError):
+        duplicate.result(5)
+    assert names(app) == ['also good', 'good']
+
+    # The queue keeps working afterwards
+    assert write_queue.submit(add_reading, 'later').result(5) == 'later'
+    write_queue.flush(5)
+    assert 'later' in names(app)
+
+
+def probe_write_lock(path):
+    """Job reporting whether another connection can take the write lock right now"""
+    def probe(session):
+        session.execute(text('SELECT 1'))
+        other = sqlite3.connect(path, timeout=0)
+        try:
+            other.execute('BEGIN IMMEDIATE')
+            other.rollback()
+            return None
+        except sqlite3.OperationalError as e:
+            return str(e)
+        finally:
+            other.close()
+    return probe
+
+
+def test_batches_take_the_write_lock_up_front(database):
+    app, write_queue, path, _ = database
+    assert write_queue.begin_immediate
+    assert write_queue.submit(probe_write_lock(path)).result(5) == 'database is locked'
+
+    # A deferred transaction has taken no lock before its first write
+    deferred = WriteQueue(app, db, begin_immediate=False)
+    assert deferred.submit(probe_write_lock(path)).result(5) is None
+
+
+def test_get_requests_read_from_the_readonly_engine(database):
+    app, write_queue, _, _ = database
+    write_queue.submit(add_reading, 'stored').result(5)
+    with app.app_context():
+        primary, readonly = db.engines[None], db.engines[READ_BIND]
+        mapper = Reading.__mapper__
+
+        with app.test_request_context('/api/readings', method='GET'):
+            assert db.session.get_bind(mapper=mapper) is readonly
+            assert [row.name for row in Reading.query] == ['stored']
+            db.session.remove()
+        with app.test_request_context('/api/readings', method='POST'):
+            assert db.session.get_bind(mapper=mapper) is primary
+            db.session.remove()
+        # Background threads and CLI commands write through the primary engine
+        assert db.session.get_bind(mapper=mapper) is primary
+
+        # The read-only connections refuse writes outright
+        with readonly.connect() as connection, pytest.raises(OperationalError):
+            connection.execute(text("INSERT INTO reading (name) VALUES ('sneaky')"))
+
+
+def test_flushes_during_get_go_to_the_primary_engine(database):
+    app, _, _, commits = database
+    with app.app_context(), app.test_request_context('/api/readings', method='GET'):
+        # e.g. a GET handler that records a last-viewed timestamp
+        db.session.add(Reading(name='written in a GET'))
+        db.session.commit()
+        db.session.remove()
+    assert commits == ['MainThread']
+    assert names(app) == ['written in a GET']
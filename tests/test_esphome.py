@@ -0,0 +1,71 @@
+# test_esphome.py - ESPHome device routes in app.py against a stand-in manager
+
+import time
+
+import pytest
+
+
+class StubManager:
+    """Records uploads and discovery sweeps instead of running the esphome CLI"""
+
+    def __init__(self, upload_ok=True):
+        self.upload_ok = upload_ok
+        self.uploads = []
+
+    def upload_device(self, device_name, device_ip=None):
+        self.uploads.append((device_name, device_ip))
+        return {'success': self.upload_ok, 'error': '' if self.upload_ok else 'OTA refused'}
+
+    def discover_devices(self):
+        return [{'ip': '10.0.0.7', 'hostname': None, 'info': 'ESPHome', 'status': 'discovered'}]
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'esphome_manager', StubManager())
+    return app_module.app.test_client()
+
+
+def add_esphome_device(app, name, status='success'):
+    with app.app.app_context():
+        device = app.ESPHomeDevice(name=name, device_type='power_monitor', ip_address='10.0.0.9',
+                                   compilation_status=status)
+        app.db.session.add(device)
+        app.db.session.commit()
+        return device.id
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.02)
+
+
+def test_upload_records_metrics_and_registers_device(app_module, client):
+    app = app_module
+    device_id = add_esphome_device(app, 'Gate Light')
+    before = app.UPLOADS.values.get(('success',), 0)
+
+    assert client.post(f"/api/esphome/devices/{device_id}/upload").status_code == 200
+    wait_for(lambda: app.UPLOADS.values.get(('success',), 0) == before + 1)
+    assert app.esphome_manager.uploads == [('gate_light', '10.0.0.9')]
+    app.write_queue.flush()
+    with app.app.app_context():
+        device = app.Device.query.filter_by(name='Gate Light').one()
+        assert (device.device_type, device.ip_address) == ('power_monitor', '10.0.0.9')
+
+
+def test_upload_requires_a_successful_compile(app_module, client):
+    device_id = add_esphome_device(app_module, 'Pump 2', status='pending')
+    assert client.post(f"/api/esphome/devices/{device_id}/upload").status_code == 400
+    assert app_module.esphome_manager.uploads == []
+
+
+def test_discover_uses_the_manager(client):
+    assert client.get('/api/esphome/discover').get_json()[0]['ip'] == '10.0.0.7'
+
+
+def test_routes_without_manager(app_module):
+    client = app_module.app.test_client()
+    assert client.get('/api/esphome/discover').status_code == 503
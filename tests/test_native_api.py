@@ -0,0 +1,181 @@
+# test_native_api.py - Pooled native API sessions against an in-process fake device
+
+import base64
+import contextlib
+import fcntl
+import time
+
+import pytest
+import yaml
+
+from benchmarks.fakes import FakeESPHomeDevice
+from backend.services.esphome import load_secrets
+from backend.services.native_api import (CommandError, NativeAPIError, NativeAPIPool, PoolExhausted,
+                                         parse_switch_state)
+
+KEY = base64.b64encode(bytes(range(32))).decode()
+WRONG_KEY = base64.b64encode(bytes(range(1, 33))).decode()
+
+
+class SilentDevice(FakeESPHomeDevice):
+    """Applies switch commands but never reports the new state"""
+
+    def set_state(self, object_id, state):
+        self.entities[object_id]['state'] = state
+
+
+@pytest.fixture
+def pool():
+    pool = NativeAPIPool(encryption_key=KEY, connect_timeout=2, command_timeout=0.5,
+                         min_backoff=0.05, max_backoff=0.2)
+    yield pool
+    pool.stop()
+
+
+@pytest.fixture
+def device():
+    with FakeESPHomeDevice('test_device', encryption_key=KEY) as device:
+        yield device
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.02)
+
+
+def test_encrypted_session_reads_states(pool, device):
+    states = pool.get_states(device.name, '127.0.0.1', device.port)
+    assert states['noise_level']['state'] == pytest.approx(55.0)
+    assert states['noise_level']['unit'] == 'dB'
+    assert states['relay'] == {'name': 'Relay', 'type': 'switch', 'unit': None, 'state': False}
+    assert states['restart']['state'] is None
+    status, = pool.status()
+    assert status['connected'] and status['device_info']['mac_address'] == device.mac_address
+
+
+def test_session_is_reused(pool, device):
+    pool.get_states(device.name, '127.0.0.1', device.port)
+    device.set_state('noise_level', 70.0)
+    wait_for(lambda: pool.get_states(device.name, '127.0.0.1', device.port)['noise_level']['state'] == 70.0)
+    assert len(pool.sessions) == 1
+
+
+def test_wrong_key_is_reported(device):
+    pool = NativeAPIPool(encryption_key=WRONG_KEY, connect_timeout=2)
+    try:
+        with pytest.raises(NativeAPIError):
+            pool.get_states(device.name, '127.0.0.1', device.port)
+        # Backoff: the next call fails fast without reconnecting
+        with pytest.raises(NativeAPIError, match='retrying'):
+            pool.get_states(device.name, '127.0.0.1', device.port)
+    finally:
+        pool.stop()
+
+
+def test_plaintext_client_against_encrypted_device(device):
+    pool = NativeAPIPool(connect_timeout=2)
+    try:
+        with pytest.raises(NativeAPIError):
+            pool.get_states(device.name, '127.0.0.1', device.port)
+    finally:
+        pool.stop()
+
+
+def test_subscription_reconnects_after_drop(pool, device):
+    heard = []
+    pool.add_listener(lambda name, entity, state: heard.append((name, entity['object_id'], state)))
+    pool.subscribe(device.name, '127.0.0.1', device.port)
+    wait_for(lambda: pool.status()[0]['connected'])
+
+    device.drop_connections()
+    wait_for(lambda: device.subscribers and pool.status()[0]['connected'])
+    device.set_state('noise_level', 81.5)
+    wait_for(lambda: (device.name, 'noise_level', 81.5) in heard)
+
+
+def test_lru_eviction_skips_subscribed_sessions():
+    with contextlib.ExitStack() as stack:
+        devices = [stack.enter_context(FakeESPHomeDevice(f"device_{i}", encryption_key=KEY)) for i in range(4)]
+        pool = NativeAPIPool(encryption_key=KEY, max_connections=2, connect_timeout=2)
+        stack.callback(pool.stop)
+
+        pool.subscribe(devices[0].name, '127.0.0.1', devices[0].port)
+        pool.get_states(devices[1].name, '127.0.0.1', devices[1].port)
+        pool.get_states(devices[2].name, '127.0.0.1', devices[2].port)
+        assert list(pool.sessions) == ['device_0', 'device_2']
+
+        pool.subscribe(devices[3].name, '127.0.0.1', devices[3].port)
+        assert list(pool.sessions) == ['device_0', 'device_3']
+        with pytest.raises(PoolExhausted):
+            pool.get_states(devices[1].name, '127.0.0.1', devices[1].port)
+
+
+def test_switch_command_waits_for_echo(pool, device):
+    assert pool.command(device.name, '127.0.0.1', 'relay', 'ON', port=device.port) is True
+    assert device.entities['relay']['state'] is True
+    assert pool.command(device.name, '127.0.0.1', 'relay', False, port=device.port) is False
+    assert pool.command(device.name, '127.0.0.1', 'restart', port=device.port) is None
+    wait_for(lambda: device.pressed == ['restart'])
+
+
+def test_command_times_out_without_echo(pool):
+    with SilentDevice('silent', encryption_key=KEY) as device:
+        with pytest.raises(NativeAPIError, match='did not report'):
+            pool.command(device.name, '127.0.0.1', 'relay', True, port=device.port)
+        assert device.entities['relay']['state'] is True
+
+
+def test_command_errors(pool, device):
+    with pytest.raises(CommandError):
+        pool.command(device.name, '127.0.0.1', 'noise_level', True, port=device.port)
+    with pytest.raises(CommandError):
+        pool.command(device.name, '127.0.0.1', 'relay', port=device.port)
+    with pytest.raises(CommandError):
+        pool.command(device.name, '127.0.0.1', 'relay', 'OFFF', port=device.port)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), ('ON', True), ('off', False), (' true ', True), ('FALSE', False),
+])
+def test_parse_switch_state(value, expected):
+    assert parse_switch_state(value) is expected
+
+
+@pytest.mark.parametrize('value', ['OFFF', '', 'toggle', 1, 0, None])
+def test_parse_switch_state_rejects(value):
+    with pytest.raises(CommandError):
+        parse_switch_state(value)
+
+
+def test_secrets_keep_existing_key(tmp_path, monkeypatch):
+    monkeypatch.delenv('ESPHOME_API_KEY', raising=False)
+    secrets_file = tmp_path / 'secrets.yaml'
+    secrets_file.write_text(yaml.dump({'api_encryption_key': KEY, 'wifi_ssid': 'site'}))
+    assert load_secrets(secrets_file)['api_encryption_key'] == KEY
+    assert load_secrets(secrets_file)['api_encryption_key'] == KEY
+    stored = yaml.safe_load(secrets_file.read_text())
+    assert stored['api_encryption_key'] == KEY and stored['wifi_ssid'] == 'site' and stored['ota_password']
+
+
+def test_secrets_generate_once(tmp_path, monkeypatch):
+    monkeypatch.delenv('ESPHOME_API_KEY', raising=False)
+    first = load_secrets(tmp_path / 'secrets.yaml')['api_encryption_key']
+    assert len(base64.b64decode(first)) == 32
+    assert load_secrets(tmp_path / 'secrets.yaml')['api_encryption_key'] == first
+
+
+def test_only_the_lock_holder_subscribes(app_module, tmp_path, monkeypatch):
+    subscribed = []
+    monkeypatch.setattr(app_module, 'init_native_api', lambda: subscribed.append(True))
+    lock_path = tmp_path / 'native-api.lock'
+
+    # Another worker holds the lock
+    with open(lock_path, 'w') as owner:
+        fcntl.flock(owner, fcntl.LOCK_EX)
+        app_module.start_native_api_subscriber(str(lock_path))
+        time.sleep(0.2)
+        assert subscribed == []
+    # It exits, and this worker takes over
+    wait_for(lambda: subscribed == [True])
@@ -0,0 +1,157 @@
+# test_presence.py - Timer wheel and in-memory presence tracking
+
+import calendar
+import time
+from datetime import datetime
+
+from backend.services.presence import PresenceTracker, TimerWheel
+
+
+def test_wheel_expires_at_deadline():
+    wheel = TimerWheel(tick=1.0, slots=8, now=0)
+    wheel.schedule('a', 3.0)
+    wheel.schedule('b', 5.0)
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ['a']
+    assert wheel.advance(5.0) == ['b']
+    assert len(wheel) == 0
+
+
+def test_wheel_reschedule_moves_deadline():
+    wheel = TimerWheel(tick=1.0, slots=8, now=0)
+    wheel.schedule('a', 3.0)
+    wheel.schedule('a', 6.0)
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(6.0) == ['a']
+
+
+def test_wheel_deadline_beyond_one_turn():
+    wheel = TimerWheel(tick=1.0, slots=4, now=0)
+    wheel.schedule('a', 10.0)
+    for now in range(1, 10):
+        assert wheel.advance(float(now)) == []
+    assert wheel.advance(10.0) == ['a']
+
+
+def test_wheel_cancel_and_long_pause():
+    wheel = TimerWheel(tick=1.0, slots=4, now=0)
+    wheel.schedule('a', 2.0)
+    wheel.schedule('b', 3.0)
+    wheel.cancel('a')
+    # Jumping far ahead still visits every slot once
+    assert wheel.advance(1000.0) == ['b']
+    assert len(wheel) == 0
+
+
+def test_heartbeat_timeout_and_recovery():
+    # The tracker's wheel starts at the current time
+    start = time.time()
+    tracker = PresenceTracker(timeout=10)
+    transitions = []
+    tracker.add_listener(lambda name, status: transitions.append((name, status)))
+
+    tracker.heartbeat('dev', timestamp=start)
+    tracker.heartbeat('dev', timestamp=start + 5)
+    assert tracker.expire(now=start + 12) == []
+    assert tracker.expire(now=start + 15.5) == ['dev']
+    assert tracker.get_status('dev') == 'offline'
+
+    tracker.heartbeat('dev', timestamp=start + 20)
+    assert transitions == [('dev', 'online'), ('dev', 'offline'), ('dev', 'online')]
+    assert tracker.counts() == {'online': 1, 'offline': 0}
+
+
+def test_availability_will_marks_offline_immediately():
+    start = time.time()
+    tracker = PresenceTracker(timeout=10)
+    tracker.availability('dev', 'online', timestamp=start)
+    tracker.availability('dev', 'offline', timestamp=start + 1)
+    assert tracker.get_status('dev') == 'offline'
+    # The cancelled timer does not fire a second transition
+    assert tracker.expire(now=start + 100) == []
+
+
+def test_flush_coalesces_last_seen():
+    flushed = []
+    tracker = PresenceTracker(flush_callback=flushed.append, timeout=300, last_seen_resolution=60)
+    tracker.heartbeat('dev', timestamp=1000.0)
+    for offset in range(1, 30):
+        tracker.heartbeat('dev', timestamp=1000.0 + offset)
+    # One write with the newest value
+    assert tracker.flush() == 1
+    assert flushed[0] == {'dev': {'status': 'online', 'last_seen': datetime.utcfromtimestamp(1029.0)}}
+
+    # Heartbeats within the resolution of the flushed value write nothing; a later one does
+    tracker.heartbeat('dev', timestamp=1060.0)
+    assert tracker.flush() == 0
+    tracker.heartbeat('dev', timestamp=1090.0)
+    assert tracker.flush() == 1
+    assert flushed[1] == {'dev': {'last_seen': datetime.utcfromtimestamp(1090.0)}}
+
+
+def test_failed_flush_is_retried():
+    calls = []
+
+    def flaky(changes):
+        calls.append(changes)
+        if len(calls) == 1:
+            raise RuntimeError('database locked')
+
+    tracker = PresenceTracker(flush_callback=flaky, timeout=300)
+    tracker.heartbeat('dev', timestamp=1000.0)
+    assert tracker.flush() == 0
+    assert tracker.flush() == 1
+    assert calls[0] == calls[1]
+
+
+def test_track_reads_stored_last_seen_as_utc():
+    tracker = PresenceTracker(timeout=300)
+    stored = datetime(2024, 1, 1, 12, 0, 0)  # naive UTC, as the flush writes it
+    tracker.track('dev', 'online', stored, now=0)
+    assert tracker.last_seen['dev'] == calendar.timegm(stored.timetuple())
+    assert tracker.dirty == {}
+
+
+def test_tracked_online_device_gets_one_timeout():
+    start = time.time()
+    tracker = PresenceTracker(timeout=30)
+    tracker.track('dev', 'online', None, now=start)
+    assert tracker.expire(now=start + 29) == []
+    assert tracker.expire(now=start + 31) == ['dev']
+
+
+def test_app_matches_rows_by_node_name(app_module):
+    app = app_module
+    with app.app.app_context():
+        app.db.session.add(app.Device(name='Light 1', device_type='power_monitor', status='offline'))
+        app.db.session.add(app.ESPHomeDevice(name='Light 1', device_type='power_monitor'))
+        app.db.session.commit()
+
+    seen = datetime(2024, 1, 1, 12, 0, 0)
+    app.flush_presence({'light_1': {'status': 'online', 'last_seen': seen}})
+    with app.app.app_context():
+        device = app.Device.query.filter_by(name='Light 1').one()
+        assert (device.status, device.last_seen) == ('online', seen)
+        assert app.ESPHomeDevice.query.filter_by(name='Light 1').one().last_seen == seen
+
+    # Seeded under the node name its heartbeats arrive on
+    app.init_presence()
+    app.presence_tracker.stop()
+    assert app.presence_tracker.get_status('light_1') == 'online'
+    assert app.presence_tracker.get_status('Light 1') is None
+
+
+def test_announced_devices_do_not_time_out():
+    start = time.time()
+    tracker = PresenceTracker(timeout=10)
+    # A door sensor announces itself, then only publishes on state changes
+    tracker.availability('door', 'online', timestamp=start)
+    tracker.heartbeat('door', timestamp=start + 1)
+    assert tracker.expire(now=start + 300) == []
+    assert tracker.get_status('door') == 'online'
+
+    # Its last will takes it offline; after that plain timeouts apply again
+    tracker.availability('door', 'offline', timestamp=start + 301)
+    tracker.heartbeat('door', timestamp=start + 302)
+    assert tracker.get_status('door') == 'online'
+    assert tracker.expire(now=start + 313) == ['door']
@@ -0,0 +1,116 @@
+# test_profiling.py - Profiling window, slow-request capture and admin access
+
+import json
+import time
+
+import pytest
+
+from backend.services import profiling
+from backend.services.profiling import RequestProfiler
+
+
+@pytest.fixture(autouse=True)
+def no_window_cache(monkeypatch):
+    # Re-read the window file on every check instead of once a second
+    monkeypatch.setattr(profiling, 'WINDOW_CHECK_INTERVAL', 0.0)
+
+
+def test_window_is_shared_through_the_file(tmp_path):
+    admin, worker = RequestProfiler(tmp_path), RequestProfiler(tmp_path)
+    assert not worker.should_track(None)
+
+    admin.enable_window(60)
+    assert worker.should_track(None)
+    assert worker.begin('GET', '/api/devices').profile
+    worker.end(200)
+    assert 55 < worker.status()['window_remaining'] <= 60
+    assert not list(tmp_path.glob('*.tmp'))
+
+    admin.disable_window()
+    assert not worker.should_track(None)
+
+    # A damaged file keeps the last deadline that could be read
+    admin.enable_window(60)
+    assert worker.should_track(None)
+    (tmp_path / profiling.WINDOW_FILE).write_text('not a deadline')
+    assert worker.should_track(None)
+    (tmp_path / profiling.WINDOW_FILE).unlink()
+    assert not worker.should_track(None)
+
+
+def test_header_token_profiles_one_request(tmp_path):
+    profiler = RequestProfiler(tmp_path, token='secret')
+    assert not profiler.should_track('wrong')
+    assert not RequestProfiler(tmp_path).should_track('secret')
+    assert profiler.should_track('secret')
+    profiler.begin('GET', '/api/devices', 'secret')
+    name = profiler.end(200, '/api/devices')
+    assert json.loads((tmp_path / f"{name}.json").read_text())['reason'] == 'profile'
+
+
+def test_only_slow_requests_are_captured(tmp_path):
+    profiler = RequestProfiler(tmp_path, slow_threshold=0.05, interval=0.001)
+    assert profiler.should_track(None)
+
+    profiler.begin('GET', '/api/fast')
+    assert profiler.end(200) is None
+
+    profiler.begin('GET', '/api/devices/7')
+    time.sleep(0.15)
+    name = profiler.end(200, '/api/devices/<int:device_id>')
+    summary = json.loads((tmp_path / f"{name}.json").read_text())
+    assert summary['reason'] == 'slow'
+    assert summary['route'] == '/api/devices/<int:device_id>'
+    assert summary['duration_ms'] >= 150
+    # Sampling starts once the request crosses the threshold
+    assert summary['samples'] > 0
+    assert (tmp_path / f"{name}.folded").read_text().count('test_only_slow_requests_are_captured') > 0
+    assert profiler.list_profiles() == [name]
+
+
+def test_profile_path_stays_in_the_profile_directory(tmp_path):
+    profiles = tmp_path / 'profiles'
+    profiler = RequestProfiler(profiles, token='secret')
+    profiler.begin('GET', '/', 'secret')
+    name = profiler.end(200)
+    (tmp_path / 'secret.json').write_text('{}')
+
+    assert profiler.profile_path('../secret', 'json') is None
+    assert profiler.profile_path('..', 'json') is None
+    assert profiler.profile_path('profiles/../../secret', 'json') is None
+    assert profiler.profile_path('.hidden', 'json') is None
+    assert profiler.profile_path('secret', 'py') is None
+    assert profiler.profile_path('missing', 'json') is None
+
+    assert profiler.profile_path(name, 'json') == profiles / f"{name}.json"
+    assert profiler.profile_path(name, 'folded') == profiles / f"{name}.folded"
+
+
+@pytest.fixture
+def admin_client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.request_profiler, 'token', 'secret')
+    return app_module.app.test_client()
+
+
+def test_admin_endpoints_require_the_token_header(app_module, admin_client, monkeypatch):
+    assert admin_client.get('/api/admin/profiling').status_code == 403
+    assert admin_client.get('/api/admin/profiling?token=secret').status_code == 403
+    assert admin_client.get('/api/admin/profiling', headers={'X-Profile-Token': 'wrong'}).status_code == 403
+    assert admin_client.get('/api/admin/profiling/x.json?token=secret').status_code == 403
+
+    # Debug mode is no exception
+    monkeypatch.setattr(app_module.app, 'debug', True)
+    assert admin_client.get('/api/admin/profiling').status_code == 403
+
+    response = admin_client.get('/api/admin/profiling', headers={'X-Profile-Token': 'secret'})
+    assert response.status_code == 200
+    assert response.get_json()['header_enabled'] is True
+    assert admin_client.get('/api/admin/profiling/missing.json',
+                            headers={'X-Profile-Token': 'secret'}).status_code == 404
+
+
+def test_admin_endpoints_closed_without_a_configured_token(app_module):
+    client = app_module.app.test_client()
+    assert app_module.request_profiler.token is None
+    assert client.get('/api/admin/profiling', headers={'X-Profile-Token': ''}).status_code == 403
+    assert client.get('/api/admin/profiling', headers={'X-Profile-Token': 'None'}).status_code == 403
@@ -0,0 +1,150 @@
+# test_queries.py - Filters, keyset pagination and materialized child counts
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, create_engine
+from sqlalchemy.orm import Session, declarative_base, relationship
+
+from backend.services.queries import (QueryError, apply_filters, decode_cursor, encode_cursor, keyset_paginate,
+                                      refresh_child_counts, track_child_count)
+
+Base = declarative_base()
+
+
+class Site(Base):
+    __tablename__ = 'site'
+    id = Column(Integer, primary_key=True)
+    device_count = Column(Integer, default=0, nullable=False)
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    kind = Column(String(20))
+    site_id = Column(Integer, ForeignKey('site.id'))
+    created_at = Column(DateTime)
+
+    # Like Device.site_location, orders site inserts before their items in a flush
+    site = relationship(Site)
+
+
+track_child_count(Item, 'site_id', Site, 'device_count')
+
+SORTS = {'name': Item.name, 'created_at': Item.created_at}
+START = datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all([Site(id=1), Site(id=2)])
+        # Duplicate names and timestamps so the id tie-breaker matters
+        session.add_all([Item(id=i, name=f"item_{i // 3:02d}", kind='sensor' if i % 2 else 'switch',
+                              site_id=1 + i % 2, created_at=START + timedelta(minutes=i // 4))
+                         for i in range(1, 41)])
+        session.commit()
+        yield session
+
+
+def all_pages(session, args, sort_default='name'):
+    ids = []
+    args = dict(args)
+    while True:
+        rows, page = keyset_paginate(session.query(Item), args, SORTS, Item.id, sort_default)
+        ids.extend(row.id for row in rows)
+        if not page['has_more']:
+            assert page['next_cursor'] is None
+            return ids
+        args['cursor'] = page['next_cursor']
+
+
+@pytest.mark.parametrize('sort', ['name', '-name', 'created_at', '-created_at'])
+def test_pages_match_a_full_ordered_query(session, sort):
+    column = SORTS[sort.lstrip('-')]
+    if sort.startswith('-'):
+        expected = [row.id for row in session.query(Item).order_by(column.desc(), Item.id.desc())]
+    else:
+        expected = [row.id for row in session.query(Item).order_by(column, Item.id)]
+    assert all_pages(session, {'sort': sort, 'limit': '7'}) == expected
+
+
+def test_filters_combine_with_pagination(session):
+    query = apply_filters(session.query(Item), {'kind': 'sensor', 'site_id': '2'},
+                          {'kind': Item.kind, 'site_id': (Item.site_id, int)})
+    rows, page = keyset_paginate(query, {'limit': '100'}, SORTS, Item.id, 'name')
+    assert rows and all(row.kind == 'sensor' and row.site_id == 2 for row in rows)
+    assert page['has_more'] is False
+
+    query = apply_filters(session.query(Item), {'kind': 'sensor,switch'}, {'kind': Item.kind})
+    assert query.count() == 40
+
+
+def test_limit_is_clamped(session):
+    _, page = keyset_paginate(session.query(Item), {'limit': '0'}, SORTS, Item.id, 'name')
+    assert page['limit'] == 1
+    _, page = keyset_paginate(session.query(Item), {'limit': '100000'}, SORTS, Item.id, 'name')
+    assert page['limit'] == 500
+
+
+@pytest.mark.parametrize('args', [
+    {'sort': 'secret'},
+    {'limit': 'ten'},
+])
+def test_bad_sort_or_limit(session, args):
+    with pytest.raises(QueryError):
+        keyset_paginate(session.query(Item), args, SORTS, Item.id, 'name')
+
+
+def test_bad_filter_value(session):
+    with pytest.raises(QueryError):
+        apply_filters(session.query(Item), {'site_id': 'abc'}, {'site_id': (Item.site_id, int)})
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64 !',
+    encode_cursor({'a': 1}),
+    encode_cursor([1, 2, 3]),
+    encode_cursor([['x'], 1]),
+    encode_cursor([{'x': 1}, 1]),
+    encode_cursor(['item', 'one']),
+    encode_cursor(['item', True]),
+])
+def test_tampered_cursors_are_rejected(cursor):
+    with pytest.raises(QueryError):
+        decode_cursor(cursor)
+
+
+def test_tampered_datetime_cursor(session):
+    with pytest.raises(QueryError):
+        keyset_paginate(session.query(Item), {'sort': 'created_at', 'cursor': encode_cursor(['yesterday', 3])},
+                        SORTS, Item.id, 'created_at')
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(['item_01', 4])) == ['item_01', 4]
+    assert decode_cursor(encode_cursor([None, 4])) == [None, 4]
+
+
+def test_child_counts_follow_inserts_moves_and_deletes(session):
+    def counts():
+        return {site.id: site.device_count for site in session.query(Site).populate_existing()}
+
+    assert counts() == {1: 20, 2: 20}
+    item = session.get(Item, 1)
+    item.site_id = 1
+    session.commit()
+    assert counts() == {1: 21, 2: 19}
+
+    session.delete(item)
+    session.add(Item(id=100, name='new', kind='sensor', site_id=2))
+    session.commit()
+    assert counts() == {1: 20, 2: 20}
+
+    session.query(Site).update({Site.device_count: 0})
+    refresh_child_counts(session, Item, 'site_id', Site, 'device_count')
+    session.commit()
+    assert counts() == {1: 20, 2: 20}
@@ -0,0 +1,272 @@
+# test_reports.py - Rollups, report sites, persistence and render workers
+
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from backend.services.presence import PresenceTracker
+from backend.services import reports
+from backend.services.reports import MAX_ENERGY_GAP, REPORT_SECTIONS, FileSender, ReportGenerator, RollupStore
+
+DAY = date(2024, 1, 1)
+
+
+def at(day, hour, minute=0):
+    return datetime(day.year, day.month, day.day, hour, minute).timestamp()
+
+
+def test_energy_is_integrated_between_readings():
+    store = RollupStore()
+    store.record_power('meter', 0.0, at(DAY, 12))
+    store.record_power('meter', 1200.0, at(DAY, 12, 1))  # trapezoid: 600 W for a minute
+    store.record_power('meter', 1200.0, at(DAY, 12, 1))  # same timestamp, nothing to add
+    assert store.summarize(['meter'], DAY, DAY)['meter']['energy_wh'] == pytest.approx(10.0)
+
+    # A gap longer than MAX_ENERGY_GAP is not bridged, integration resumes after it
+    resumed = at(DAY, 12, 1) + MAX_ENERGY_GAP + 1
+    store.record_power('meter', 1200.0, resumed)
+    assert store.summarize(['meter'], DAY, DAY)['meter']['energy_wh'] == pytest.approx(10.0)
+    store.record_power('meter', 1200.0, resumed + 60)
+    assert store.summarize(['meter'], DAY, DAY)['meter']['energy_wh'] == pytest.approx(30.0)
+
+
+def test_versions_bump_per_device_day():
+    store = RollupStore()
+    next_day = DAY + timedelta(days=1)
+    assert store.version(['meter', 'noise'], DAY, next_day) == (0, 0, 0, 0)
+
+    store.record_power('meter', 100.0, at(DAY, 10))
+    assert store.version(['meter'], DAY, DAY) == (0,)  # first reading adds nothing
+    store.record_power('meter', 100.0, at(DAY, 10, 1))
+    store.record_alert({'state': 'raised', 'device': 'noise', 'sensor': 'noise_level', 'rule': 'LAmax',
+                        'timestamp': at(next_day, 9)})
+    store.record_alert({'state': 'cleared', 'device': 'noise', 'sensor': 'noise_level', 'rule': 'LAmax',
+                        'timestamp': at(next_day, 10)})
+    assert store.version(['meter', 'noise'], DAY, next_day) == (1, 0, 0, 1)
+
+    summary = store.summarize(['noise'], next_day, next_day)['noise']
+    assert (summary['alerts'], summary['noise_exceedances']) == ({'LAmax': 1}, 1)
+
+
+class CountingRenders:
+    def __init__(self):
+        self.jobs = []
+        self.render = reports.render_sections
+
+    def __call__(self, job):
+        self.jobs.append((job[0], list(job[1])))
+        return self.render(job)
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    renders = CountingRenders()
+    monkeypatch.setattr(reports, 'render_sections', renders)
+    return renders
+
+
+def test_generate_renders_only_uncached_sections(counted):
+    store = RollupStore()
+    sites = {'Depot': ['meter'], 'Yard': ['pump']}
+    generator = ReportGenerator(store, lambda: sites, None, workers=1)
+    today = DAY + timedelta(days=1)
+    store.record_power('meter', 6000.0, at(DAY, 8))
+    store.record_power('meter', 6000.0, at(DAY, 8, 1))
+
+    first = generator.generate('daily', today=today)
+    assert [report['site'] for report in first] == ['Depot', 'Yard']
+    assert counted.jobs == [('Depot', REPORT_SECTIONS), ('Yard', REPORT_SECTIONS)]
+    assert '0.10' in first[0]['html'] and 'meter' in first[0]['html']
+
+    # Readings today do not touch yesterday's report
+    counted.jobs.clear()
+    store.record_power('meter', 6000.0, at(today, 8))
+    store.record_power('meter', 6000.0, at(today, 8, 1))
+    second = generator.generate('daily', today=today)
+    assert counted.jobs == []
+    assert [report['html'].split('<small>')[0] for report in second] == \
+        [report['html'].split('<small>')[0] for report in first]
+
+    # A late alert for yesterday re-renders only that site
+    store.record_alert({'state': 'raised', 'device': 'pump', 'sensor': 'pressure', 'rule': 'High pressure',
+                        'timestamp': at(DAY, 23)})
+    generator.generate('daily', today=today)
+    assert counted.jobs == [('Yard', REPORT_SECTIONS)]
+
+    # The weekly period is cached separately
+    counted.jobs.clear()
+    generator.generate('weekly', today=today)
+    assert len(counted.jobs) == 2
+
+
+def test_section_cache_is_bounded():
+    store = RollupStore()
+    generator = ReportGenerator(store, lambda: {f"site_{i}": [f"dev_{i}"] for i in range(5)}, None,
+                                workers=1, max_cached_sections=8)
+    generator.generate('daily', today=DAY)
+    assert len(generator.section_cache) == 8
+
+
+def test_sites_render_in_worker_processes():
+    store = RollupStore()
+    sites = {f"Site {i}": [f"meter_{i}"] for i in range(4)}
+    for i in range(4):
+        store.record_power(f"meter_{i}", 100.0 * i, at(DAY, 8))
+        store.record_power(f"meter_{i}", 100.0 * i, at(DAY, 8, 1))
+    pooled = ReportGenerator(store, lambda: sites, None, workers=2)
+    try:
+        parallel = pooled.generate('daily', today=DAY + timedelta(days=1), send=False)
+        assert pooled.pool is not None
+    finally:
+        pooled.shutdown()
+    serial = ReportGenerator(store, lambda: sites, None, workers=1).generate('daily', today=DAY + timedelta(days=1),
+                                                                             send=False)
+    assert [report['html'].split('<small>')[0] for report in parallel] == \
+        [report['html'].split('<small>')[0] for report in serial]
+
+
+def test_file_sender_writes_one_file_per_report(tmp_path):
+    sender = FileSender(tmp_path / 'out')
+    generator = ReportGenerator(RollupStore(), lambda: {'North/East Site': ['meter']}, sender, workers=1)
+    report, = generator.generate('weekly', today=DAY)
+    path = tmp_path / 'out' / 'North_East_Site_weekly_2023-12-31.html'
+    assert report['delivery'] == str(path)
+    html = path.read_text()
+    assert html == report['html']
+    assert '<h1>North/East Site - Weekly Report</h1>' in html
+    assert '2023-12-25 to 2023-12-31' in html
+
+
+def test_failed_delivery_does_not_stop_other_sites():
+    class FlakySender:
+        def send(self, report):
+            if report['site'] == 'Depot':
+                raise ConnectionError('smtp down')
+            return 'sent'
+
+    generator = ReportGenerator(RollupStore(), lambda: {'Depot': [], 'Yard': []}, FlakySender(), workers=1)
+    assert [report['delivery'] for report in generator.generate(today=DAY)] == [None, 'sent']
+
+
+def test_uptime_follows_presence_transitions():
+    store = RollupStore()
+    store.record_status('door', 'online', at(DAY, 6))
+    # Repeated online transitions do not restart the interval
+    store.record_status('door', 'online', at(DAY, 7))
+    store.record_status('door', 'offline', at(DAY, 18))
+    assert store.summarize(['door'], DAY, DAY)['door']['uptime_pct'] == pytest.approx(50.0)
+
+    # An interval over midnight is split between the days
+    next_day = DAY + timedelta(days=1)
+    store.record_status('door', 'online', at(DAY, 21))
+    store.record_status('door', 'offline', at(next_day, 3))
+    assert store.summarize(['door'], DAY, DAY)['door']['online_seconds'] == pytest.approx(15 * 3600)
+
+    # Still online: counted up to now, and never past the end of the period
+    store.record_status('door', 'online', at(next_day, 12))
+    summary = store.summarize(['door'], next_day, next_day, now=at(next_day, 18))
+    assert summary['door']['online_seconds'] == pytest.approx(9 * 3600)
+    summary = store.summarize(['door'], next_day, next_day, now=at(next_day + timedelta(days=3), 0))
+    assert summary['door']['online_seconds'] == pytest.approx(15 * 3600)
+
+
+def test_silent_announced_device_stays_up():
+    store = RollupStore()
+    start = time.time()
+    tracker = PresenceTracker(timeout=10)
+    tracker.add_listener(store.record_status)
+    # A door sensor that only publishes on change, covered by its last will
+    tracker.availability('door', 'online', timestamp=start)
+    tracker.expire(now=start + 3600)
+    assert store.online_since == {'door': pytest.approx(start, abs=1)}
+
+    tracker.availability('door', 'offline', timestamp=start + 3600)
+    assert store.online_since == {}
+    today = date.today()
+    summary = store.summarize(['door'], today - timedelta(days=1), today)
+    assert summary['door']['online_seconds'] > 0
+
+
+def test_rollups_survive_a_restart(tmp_path):
+    path = tmp_path / 'rollups.json'
+    store = RollupStore(path)
+    now = time.time()
+    store.record_power('meter', 1000.0, now - 120)
+    store.record_power('meter', 1000.0, now - 60)
+    store.record_alert({'state': 'raised', 'device': 'noise', 'sensor': 'noise_level', 'rule': 'LAmax',
+                        'timestamp': now})
+    store.record_status('door', 'online', now - 30)
+    store.save()
+    saved_at = json.loads(path.read_text())['saved_at']
+
+    restarted = RollupStore(path)
+    assert restarted.load() == 2
+    today = date.today()
+    start = today - timedelta(days=1)
+    before = store.summarize(['meter', 'noise'], start, today)
+    assert restarted.summarize(['meter', 'noise'], start, today) == before
+    assert before['meter']['energy_wh'] == pytest.approx(1000.0 / 60)
+    # The open interval counts up to the snapshot, not across the downtime
+    assert restarted.online_since == {}
+    assert restarted.summarize(['door'], start, today)['door']['online_seconds'] == pytest.approx(saved_at - now + 30)
+    assert restarted.version(['meter'], today, today) != (0,)
+
+
+def test_snapshot_drops_expired_days_and_tolerates_bad_files(tmp_path):
+    path = tmp_path / 'rollups.json'
+    store = RollupStore(path)
+    store.record_power('meter', 100.0, time.time() - 90 * 86400 - 10)
+    store.record_power('meter', 100.0, time.time() - 90 * 86400)
+    store.save()
+    assert store.days == {}
+    assert RollupStore(path).load() == 0
+
+    path.write_text('{"days": [["meter"')
+    assert RollupStore(path).load() == 0
+    assert RollupStore(tmp_path / 'missing.json').load() == 0
+
+
+def test_report_sites_follow_site_locations(app_module, monkeypatch):
+    app = app_module
+    monkeypatch.setenv('SITE_NAME', 'Head Office')
+    with app.app.app_context():
+        depot, yard = app.SiteLocation(name='Depot'), app.SiteLocation(name='Yard')
+        app.db.session.add_all([depot, yard])
+        app.db.session.flush()
+        app.db.session.add_all([
+            app.Device(name='Depot Light', device_type='power_monitor', site_location_id=depot.id),
+            app.Device(name='Depot Noise', device_type='noise_sensor', site_location_id=depot.id),
+            app.Device(name='Yard Light', device_type='power_monitor', site_location_id=yard.id),
+            app.Device(name='Loose Meter', device_type='power_monitor'),
+        ])
+        app.db.session.commit()
+
+    sites = app.get_report_sites()
+    # Keyed by node name, as readings and alerts are recorded
+    assert sites['Depot'] == ['depot_light', 'depot_noise']
+    assert sites['Yard'] == ['yard_light']
+    assert 'loose_meter' in sites['Head Office']
+    assert not any(name.startswith(('depot', 'yard')) for name in sites['Head Office'])
+
+
+def test_render_workers_do_not_rerun_startup(tmp_path):
+    # How multiprocessing prepares a forkserver child under `python app.py`
+    script = (
+        "import runpy\n"
+        "module = runpy.run_path('app.py', run_name='__mp_main__')\n"
+        "print(module['report_generator'].scheduler_thread, module['rollup_store'].snapshot_thread)\n"
+    )
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'worker.db'}", REPORT_DIR=str(tmp_path / 'reports'),
+               PROFILE_DIR=str(tmp_path / 'profiles'), REPORT_SCHEDULER='1')
+    for name in ('MQTT_BROKER', 'ESPHOME_MANAGER', 'NATIVE_API_SUBSCRIBE'):
+        env.pop(name, None)
+    result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(__file__)), env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-1] == 'None None'
+    assert 'Report scheduler started' not in result.stdout
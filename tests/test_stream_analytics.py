@@ -0,0 +1,117 @@
+# test_stream_analytics.py - Sliding windows and hysteresis alerts
+
+import math
+
+import pytest
+
+from backend.services.stream_analytics import SlidingWindow, StreamAnalytics
+
+RULE = {'name': 'PM10 mean', 'stat': 'mean', 'window': 60, 'limit': 50.0, 'clear': 45.0, 'min_samples': 1}
+
+
+def states(events):
+    return [event['state'] for event in events]
+
+
+def test_window_expires_old_readings():
+    window = SlidingWindow(10)
+    for t, value in enumerate([5.0, 1.0, 3.0]):
+        window.add(value, 100 + t)
+    assert len(window) == 3
+    assert window.mean() == pytest.approx(3.0)
+    assert window.max() == 5.0
+
+    # 5.0 at t=100 falls out once the window has moved past it
+    window.add(2.0, 110)
+    assert len(window) == 3
+    assert window.max() == 3.0
+    assert window.mean() == pytest.approx(2.0)
+
+    window.expire(200)
+    assert len(window) == 0
+    assert window.mean() is None
+    assert window.max() is None
+
+
+def test_laeq_is_energy_average():
+    window = SlidingWindow(60, acoustic=True)
+    window.add(60.0, 0)
+    window.add(70.0, 1)
+    expected = 10 * math.log10((10 ** 6 + 10 ** 7) / 2)
+    assert window.laeq() == pytest.approx(expected)
+    assert SlidingWindow(60).laeq() is None
+
+
+def test_sample_cap_bounds_memory():
+    window = SlidingWindow(3600, max_samples=100)
+    for i in range(1000):
+        window.add(float(i), i * 0.001)
+    assert len(window) == 100
+    assert window.max() == 999.0
+    assert window.mean() == pytest.approx(sum(range(900, 1000)) / 100)
+
+
+def test_alert_raises_above_limit_and_clears_below_clear():
+    analytics = StreamAnalytics(limits={'pm10': [RULE]})
+    assert analytics.ingest('dev', 'pm10', 40.0, timestamp=0) == []
+
+    raised = analytics.ingest('dev', 'pm10', 80.0, timestamp=1)  # mean 60
+    assert states(raised) == ['raised']
+    assert raised[0]['rule'] == 'PM10 mean'
+    assert analytics.active_alerts() == [{'device': 'dev', 'sensor': 'pm10', 'rule': 'PM10 mean'}]
+
+
+def test_hysteresis_band_does_not_flap():
+    analytics = StreamAnalytics(limits={'pm10': [RULE]})
+    analytics.ingest('dev', 'pm10', 60.0, timestamp=0)
+
+    # Between clear (45) and limit (50): still active, no new events
+    events = []
+    for t in range(1, 20):
+        events += analytics.ingest('dev', 'pm10', 46.0, timestamp=60 + t)
+        events += analytics.ingest('dev', 'pm10', 49.0, timestamp=60 + t + 0.5)
+    assert events == []
+    assert analytics.get_stats('dev', 'pm10', now=80)['active_alerts'] == ['PM10 mean']
+
+    # Dropping below clear ends it exactly once
+    cleared = []
+    for t in range(200, 210):
+        cleared += analytics.ingest('dev', 'pm10', 10.0, timestamp=t)
+    assert states(cleared) == ['cleared']
+    assert analytics.active_alerts() == []
+
+
+def test_min_samples_defers_alert():
+    rule = dict(RULE, min_samples=3)
+    analytics = StreamAnalytics(limits={'pm10': [rule]})
+    assert analytics.ingest('dev', 'pm10', 90.0, timestamp=0) == []
+    assert analytics.ingest('dev', 'pm10', 90.0, timestamp=1) == []
+    assert states(analytics.ingest('dev', 'pm10', 90.0, timestamp=2)) == ['raised']
+
+
+def test_recent_alerts_and_listeners():
+    analytics = StreamAnalytics(limits={'pm10': [RULE]}, alert_retention=100)
+    heard = []
+    analytics.add_listener(heard.append)
+    analytics.ingest('dev', 'pm10', 90.0, timestamp=1000)
+    assert [alert['state'] for alert in heard] == ['raised']
+    assert len(analytics.recent_alerts(now=1050)) == 1
+    assert analytics.recent_alerts(now=1200) == []
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_readings_are_ignored(value):
+    analytics = StreamAnalytics(limits={'noise_level': [
+        {'name': 'LAmax', 'stat': 'max', 'window': 60, 'limit': 90.0, 'clear': 85.0, 'min_samples': 1},
+        {'name': 'LAeq', 'stat': 'laeq', 'window': 900, 'limit': 75.0, 'clear': 72.0, 'min_samples': 1},
+    ]})
+    analytics.ingest('dev', 'noise_level', 60.0, timestamp=0)
+    assert analytics.ingest('dev', 'noise_level', value, timestamp=1) == []
+
+    stats = analytics.get_stats('dev', 'noise_level', now=2)
+    assert stats['last_value'] == 60.0
+    assert [window['count'] for window in stats['windows']] == [1, 1]
+    assert all(math.isfinite(window['mean']) and math.isfinite(window['laeq']) for window in stats['windows'])
+
+    # Alerts still fire afterwards
+    assert states(analytics.ingest('dev', 'noise_level', 95.0, timestamp=3)) == ['raised', 'raised']